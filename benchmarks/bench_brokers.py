@@ -0,0 +1,144 @@
+"""
+Ingests from several remote brokers at once: checks copies of a packet delivered by more than one broker are forwarded once, reports per broker throughput and lag, and measures what each added broker costs next to the node table they share.
+
+`coalesce` replays packets from senders in range of a client, paced in real time. The official broker carries 90% of them within 50 ms, one community broker 50% after 100-300 ms and another 30% after 0.5-1.5 s, overlapping at random. `memory` prepares a multiplexer with 100k nodes in the table and 1 to 8 remote brokers, and measures the heap with tracemalloc.
+
+  python benchmarks/bench_brokers.py [packets]
+"""
+import gc
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import sqlalchemy
+
+import meshmtx.storage
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.mqtt.loopback import LoopbackBroker
+from meshmtx.storage import NodeState
+from meshmtx.utils import PacketUtilities
+
+from bench_loop import envelope
+
+PACKETS = 3000
+SENDERS = 200
+CLIENT = 0x10000000
+SENDER_BASE = 0x20000000
+NODES = 100000
+# name: (share of packets carried, delay range in seconds)
+BROKERS = {
+  'remote': (0.9, (0.0, 0.05)),
+  'community': (0.5, (0.1, 0.3)),
+  'hobby': (0.3, (0.5, 1.5)),
+}
+RATE = 1000 # packets per second
+
+
+def make_config(brokers) -> dict:
+  return {
+    'clients': [{'id': PacketUtilities.user_to_node_id(CLIENT), 'max_distance': 30000}],
+    'telemetry': {'id': 'Telemetry', 'key': 'AQ=='},
+    'imports': [],
+    'mqtt': {'local': {}, 'remote': [{'name': name, 'subscriptions': ['msh/EU_868/2/e/#']} for name in brokers]},
+    'geocoder': {'cache': {'enabled': False}},
+    'pipeline': {'workers': 0},
+  }
+
+
+def coalesce(directory: str, packets: int):
+  rng = random.Random(1)
+  storage = meshmtx.storage.get_engine(os.path.join(directory, 'coalesce.db'))
+  meshmtx.storage.Base.metadata.create_all(storage)
+  multiplexer = Multiplexer(make_config(BROKERS), storage)
+  multiplexer.prepare()
+  multiplexer._geocoder.maybe_update_nodes([(CLIENT, 55.0, -3.0, None)] + [(SENDER_BASE + i, 55.0 + rng.uniform(-0.1, 0.1), -3.0, None) for i in range(SENDERS)])
+  broker = LoopbackBroker()
+  multiplexer.local.attach_client(broker.client(multiplexer.local.on_message))
+  for remote in multiplexer.remotes:
+    remote.attach_client(broker.client())
+
+  # every packet is carried by at least one broker
+  events = []
+  carried = set()
+  for i in range(packets):
+    sent = i / RATE
+    payload = envelope(SENDER_BASE + rng.randrange(SENDERS), i + 1)
+    for name, (share, (low, high)) in BROKERS.items():
+      if rng.random() < share:
+        events.append((sent + rng.uniform(low, high), name, payload))
+        carried.add(i)
+  events.sort(key=lambda event: event[0])
+  remotes = {remote.key: remote for remote in multiplexer.remotes}
+
+  published = broker.published
+  started = time.perf_counter()
+  for at, name, payload in events:
+    delay = at - (time.perf_counter() - started)
+    if delay > 0:
+      time.sleep(delay)
+    remotes[name].handle_message('msh/EU_868/2/e/LongFast/!abcdef01', payload, time.time())
+    broker.drain()
+  elapsed = time.perf_counter() - started
+  storage.dispose()
+
+  print(f'{len(events)} copies of {len(carried)} packets over {elapsed:.1f}s, {broker.published - published} forwarded')
+  print(f'{"broker":>10} {"copies":>7} {"msgs/s":>7} {"first":>6} {"dupes":>6} {"late":>6} {"lag ms":>7}')
+  for remote in multiplexer.remotes:
+    stats = remote.stats()
+    late = stats['dedup_late']
+    lag = stats['dedup_lag_seconds'] / late * 1e3 if late else 0.0
+    print(f'{remote.key:>10} {stats["dedup_processed"]:>7} {stats["dedup_processed"] / elapsed:>7.0f} {stats["dedup_first"]:>6} {stats["dedup_duplicates"]:>6} {late:>6} {lag:>7.0f}')
+
+
+def build_state(path: str):
+  rng = random.Random(2)
+  storage = meshmtx.storage.get_engine(path)
+  meshmtx.storage.Base.metadata.create_all(storage)
+  timestamp = datetime.fromtimestamp(1700000000)
+  rows = [{'id': CLIENT, 'timestamp': timestamp, 'latitude': 55.0, 'longitude': -3.0}]
+  rows += [{'id': SENDER_BASE + i, 'timestamp': timestamp, 'latitude': rng.uniform(50, 58), 'longitude': rng.uniform(-6, 2)} for i in range(NODES)]
+  with storage.begin() as connection:
+    connection.execute(sqlalchemy.insert(NodeState), rows)
+  return storage
+
+
+def heap(storage, count: int) -> int:
+  gc.collect()
+  tracemalloc.start()
+  multiplexer = Multiplexer(make_config([f'broker{i}' for i in range(count)]), storage)
+  multiplexer.prepare()
+  multiplexer.nodes_loaded.wait()
+  current = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return current
+
+
+def memory(directory: str):
+  storage = build_state(os.path.join(directory, 'memory.db'))
+  # the first run also pays for caches filled once per process, so it is not counted
+  heap(storage, 1)
+  baseline = heap(storage, 1)
+  print()
+  print(f'{"brokers":>8} {"heap MB":>8} {"per added broker KB":>20}')
+  print(f'{1:>8} {baseline / 1e6:>8.1f}')
+  for count in (2, 4, 8):
+    current = heap(storage, count)
+    print(f'{count:>8} {current / 1e6:>8.1f} {(current - baseline) / (count - 1) / 1e3:>20.1f}')
+  storage.dispose()
+
+
+def main():
+  logging.basicConfig(level=logging.ERROR)
+  packets = int(sys.argv[1]) if len(sys.argv) > 1 else PACKETS
+  with tempfile.TemporaryDirectory() as directory:
+    coalesce(directory, packets)
+    memory(directory)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,86 @@
+"""
+Compares decrypts/second of the original per-packet key expansion against the precomputed key ring.
+
+  python benchmarks/bench_crypto.py
+"""
+import base64
+import time
+
+import cryptography.hazmat.backends
+import cryptography.hazmat.primitives.ciphers
+import cryptography.hazmat.primitives.ciphers.algorithms
+import cryptography.hazmat.primitives.ciphers.modes
+import meshtastic
+import meshtastic.protobuf
+
+from meshmtx.crypto import ChannelKey, KeyRing, decode_psk
+
+PACKETS = 20000
+CHANNELS = [{'name': f'Channel{i}', 'key': base64.b64encode(bytes([i]) * 16).decode()} for i in range(1, 8)] + [{'name': 'LongFast', 'key': 'AQ=='}]
+
+
+def legacy_expand_key(key: str) -> str:
+  if key == "AQ==":
+    key = "1PG7OiApB1nwvP+rz05pAQ=="
+  padded_key = key.ljust(len(key) + ((4 - (len(key) % 4)) % 4), '=')
+  return padded_key.replace('-', '+').replace('_', '/')
+
+
+def legacy_decrypt(mp, key) -> bool:
+  # the per-packet path the key ring replaces
+  key = legacy_expand_key(key)
+  try:
+    key_bytes = base64.b64decode(key.encode('ascii'))
+    nonce = getattr(mp, "id").to_bytes(8, "little") + getattr(mp, "from").to_bytes(8, "little")
+    cipher = cryptography.hazmat.primitives.ciphers.Cipher(
+      cryptography.hazmat.primitives.ciphers.algorithms.AES(key_bytes),
+      cryptography.hazmat.primitives.ciphers.modes.CTR(nonce), backend=cryptography.hazmat.backends.default_backend()
+    )
+    decryptor = cipher.decryptor()
+    decrypted_bytes = decryptor.update(getattr(mp, "encrypted")) + decryptor.finalize()
+    data = meshtastic.mesh_pb2.Data()
+    data.ParseFromString(decrypted_bytes)
+    mp.decoded.CopyFrom(data)
+  except Exception:
+    return False
+  return True
+
+
+def make_packets():
+  key = ChannelKey('LongFast', decode_psk('AQ=='))
+  data = meshtastic.mesh_pb2.Data(portnum=meshtastic.portnums_pb2.TEXT_MESSAGE_APP, payload=b'hello world').SerializeToString()
+  packets = []
+  for i in range(PACKETS):
+    packet = meshtastic.mesh_pb2.MeshPacket(id=i + 1, channel=key.hash)
+    setattr(packet, 'from', 0x1000 + i % 500)
+    packet.encrypted = key.crypt(getattr(packet, 'from'), packet.id, data)
+    packets.append(packet)
+  return packets
+
+
+def measure(name: str, packets, decrypt):
+  started = time.perf_counter()
+  decoded = sum(1 for packet in packets if decrypt(packet))
+  elapsed = time.perf_counter() - started
+  assert decoded == len(packets)
+  print(f'{name:<36} {len(packets) / elapsed:>10.0f} decrypts/s')
+
+
+def main():
+  ring = KeyRing(CHANNELS)
+  measure('per-packet key expansion', make_packets(), lambda packet: legacy_decrypt(packet, 'AQ=='))
+  measure(f'key ring ({len(ring)} channels)', make_packets(), ring.decrypt_packet)
+
+  # packets for channels we have no key for are skipped without decrypting
+  unknown = make_packets()
+  for packet in unknown:
+    packet.channel = 0xff
+  started = time.perf_counter()
+  for packet in unknown:
+    ring.decrypt_packet(packet)
+  elapsed = time.perf_counter() - started
+  print(f'{"key ring, unknown channel":<36} {len(unknown) / elapsed:>10.0f} packets/s skipped')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,38 @@
+"""
+Compares the threaded and asyncio engines on the same replays, with decoding inline and offloaded to an executor.
+
+Replays feed one message at a time and wait for it to be fully handled, so these are per-message costs rather than concurrent throughput.
+
+  python benchmarks/bench_engine.py
+"""
+import gc
+import os
+import tempfile
+
+import meshmtx.storage
+from meshmtx.replay import ReplayDriver
+
+import traffic
+
+PACKETS = 5000
+ENGINES = (('threads', 0), ('asyncio', 0), ('asyncio', 2))
+
+
+def main():
+  print(f'{"mix":>16} {"engine":>8} {"workers":>8} {"published":>10} {"msgs/s":>9} {"p50 us":>8} {"p99 us":>8}')
+  with tempfile.TemporaryDirectory() as directory:
+    for mix in traffic.MIXES:
+      config, records = traffic.generate(mix, PACKETS)
+      for engine, workers in ENGINES:
+        gc.collect()
+        storage = meshmtx.storage.get_engine(os.path.join(directory, f'{mix}-{engine}-{workers}.db'))
+        meshmtx.storage.Base.metadata.create_all(storage)
+        driver = ReplayDriver({**config, 'pipeline': {'executor_workers': workers}}, storage, engine=engine)
+        report = driver.replay(records)
+        driver.close()
+        storage.dispose()
+        print(f'{mix:>16} {engine:>8} {workers:>8} {report.published:>10} {report.rate:>9.0f} {report.percentile(50) * 1e6:>8.1f} {report.percentile(99) * 1e6:>8.1f}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,82 @@
+"""
+Replays the many-clients traffic mix with and without per-client filters, and compares what is published to the local broker and the CPU spent handling it.
+
+Filtered, every client only wants text messages and positions. The capture starts with a position from every node so routes exist, which passes any such filter and is replayed before measuring. The first run of each kind pays for caches filled once per process and is not counted; the others are interleaved, so drift in machine speed hits both alike.
+
+  python benchmarks/bench_filters.py [packets]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import meshmtx.storage
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.mqtt.loopback import LoopbackBroker
+
+from traffic import generate
+
+PACKETS = 20000
+REPEAT = 3
+
+
+def with_filters(config: dict) -> dict:
+  clients = [{**client, 'filter': {'portnums': ['TEXT_MESSAGE_APP', 'POSITION_APP']}} for client in config['clients']]
+  return {**config, 'clients': clients}
+
+
+def run(directory: str, config: dict, records, skip: int, name: str):
+  config = {**config, 'pipeline': {'workers': 0}}
+  storage = meshmtx.storage.get_engine(os.path.join(directory, f'{name}.db'))
+  meshmtx.storage.Base.metadata.create_all(storage)
+  multiplexer = Multiplexer(config, storage)
+  multiplexer.prepare()
+  multiplexer.nodes_loaded.wait()
+  broker = LoopbackBroker()
+  multiplexer.local.attach_client(broker.client())
+  multiplexer.remote.attach_client(broker.client())
+  handlers = {'local': multiplexer.local, 'remote': multiplexer.remote}
+  for record in records[:skip]:
+    handlers[record.source].handle_message(record.topic, record.payload, record.timestamp)
+    broker.drain()
+
+  published = broker.published
+  cpu = 0.0
+  for record in records[skip:]:
+    started = time.process_time()
+    handlers[record.source].handle_message(record.topic, record.payload, record.timestamp)
+    cpu += time.process_time() - started
+    broker.drain()
+  storage.dispose()
+  return cpu, broker.published - published
+
+
+def main():
+  logging.basicConfig(level=logging.ERROR)
+  packets = int(sys.argv[1]) if len(sys.argv) > 1 else PACKETS
+  config, records = generate('many-clients', packets)
+  configs = {'none': config, 'filtered': with_filters(config)}
+  # the initial positions, one from every client and remote sender
+  skip = len(records) - packets
+  print(f'{packets} packets, {len(config["clients"])} clients')
+
+  results = {name: [] for name in configs}
+  with tempfile.TemporaryDirectory() as directory:
+    for attempt in range(REPEAT + 1):
+      for name, variant in configs.items():
+        result = run(directory, variant, records, skip, f'{name}-{attempt}')
+        if attempt:
+          results[name].append(result)
+
+  print(f'{"filters":>9} {"cpu s":>7} {"us/packet":>10} {"published":>10}')
+  for name in configs:
+    cpu = min(result[0] for result in results[name])
+    print(f'{name:>9} {cpu:>7.2f} {cpu / packets * 1e6:>10.1f} {results[name][0][1]:>10}')
+  cpu = {name: min(result[0] for result in results[name]) for name in configs}
+  published = {name: results[name][0][1] for name in configs}
+  print(f'{1 - published["filtered"] / max(published["none"], 1):.0%} fewer publishes, {1 - cpu["filtered"] / cpu["none"]:.0%} CPU saved')
+
+
+if __name__ == '__main__':
+  main()
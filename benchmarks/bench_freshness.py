@@ -0,0 +1,128 @@
+"""
+Replays position-heavy remote traffic with the freshness gate off and on, and compares the CPU spent handling it, what the gate dropped and what was still forwarded.
+
+Every 30 simulated seconds each sender beacons its position and a telemetry packet. Most senders sit still, some move 200 m per beacon, and only part of them are in range of a client. CPU is the process time spent in `handle_message` plus writing positions to storage once per beacon period, which the gate saves by skipping decryption for senders out of range and storing repeated positions once per interval. The gate runs on a simulated clock, so the replay covers the same minutes either way.
+
+  python benchmarks/bench_freshness.py [senders]
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+import meshtastic
+import meshtastic.protobuf
+
+import meshmtx.storage
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.mqtt.loopback import LoopbackBroker
+from meshmtx.utils import PacketUtilities
+
+from traffic import envelope, position
+
+SENDERS = 5000
+CLIENTS = 100
+ROUNDS = 10
+PERIOD = 30.0 # seconds between beacons
+MOVING = 0.1 # share of senders moving
+STEP = 0.0018 # degrees of latitude a moving sender covers per beacon, about 200 m
+CLIENT_BASE = 0x10000000
+SENDER_BASE = 0x20000000
+START = 1700000000.0
+REPEAT = 3
+
+PORTNUMS = meshtastic.portnums_pb2
+
+
+def make_traffic(sender_count: int):
+  rng = random.Random(1)
+  clients = [(CLIENT_BASE + i, rng.uniform(50, 58), rng.uniform(-6, 2)) for i in range(CLIENTS)]
+  senders = [(SENDER_BASE + i, rng.uniform(50, 58), rng.uniform(-6, 2), rng.random() < MOVING) for i in range(sender_count)]
+  rounds = []
+  packet_id = 0
+  for round in range(ROUNDS):
+    timestamp = START + round * PERIOD
+    packets = []
+    for id, latitude, longitude, moving in senders:
+      if moving:
+        latitude += round * STEP
+      packet_id += 1
+      packets.append(envelope(id, packet_id, PORTNUMS.POSITION_APP, position(latitude, longitude, timestamp)))
+      packet_id += 1
+      packets.append(envelope(id, packet_id, PORTNUMS.TELEMETRY_APP, rng.randbytes(40)))
+    rng.shuffle(packets)
+    rounds.append(packets)
+  config = {
+    'clients': [{'id': PacketUtilities.user_to_node_id(id), 'max_distance': 30000} for id, _, _ in clients],
+    'telemetry': {'id': 'Telemetry', 'key': 'AQ=='},
+    'channels': [{'name': 'LongFast', 'key': 'AQ=='}],
+    'imports': [],
+    'mqtt': {'local': {}, 'remote': {}},
+    'geocoder': {'cache': {'enabled': False}},
+    'pipeline': {'workers': 0},
+  }
+  return config, clients, rounds
+
+
+def run(directory: str, config: dict, clients, rounds, gated: bool, attempt: int):
+  config = {**config, 'freshness': {'enabled': gated, 'interval': 60, 'distance': 50}}
+  storage = meshmtx.storage.get_engine(os.path.join(directory, f'state-{gated}-{attempt}.db'))
+  meshmtx.storage.Base.metadata.create_all(storage)
+  multiplexer = Multiplexer(config, storage)
+  multiplexer.prepare()
+  multiplexer.nodes_loaded.wait()
+  multiplexer._geocoder.maybe_update_nodes([(id, latitude, longitude, None) for id, latitude, longitude in clients])
+  clock = [0.0]
+  if multiplexer.freshness:
+    multiplexer.freshness._clock = lambda: clock[0]
+
+  broker = LoopbackBroker()
+  multiplexer.local.attach_client(broker.client(multiplexer.local.on_message))
+  remote = multiplexer.remote
+  published = broker.published
+  cpu = 0.0
+  for round, packets in enumerate(rounds):
+    clock[0] = round * PERIOD
+    for payload in packets:
+      started = time.process_time()
+      remote.handle_message('msh/EU_868/2/e/LongFast/!abcdef01', payload, START)
+      cpu += time.process_time() - started
+      broker.drain()
+    started = time.process_time()
+    multiplexer.positions.flush()
+    cpu += time.process_time() - started
+
+  stats = multiplexer.freshness.stats() if multiplexer.freshness else {}
+  written = multiplexer.positions.written
+  storage.dispose()
+  return cpu, broker.published - published, written, stats
+
+
+def main():
+  logging.basicConfig(level=logging.ERROR)
+  sender_count = int(sys.argv[1]) if len(sys.argv) > 1 else SENDERS
+  config, clients, rounds = make_traffic(sender_count)
+  packets = sum(len(packets) for packets in rounds)
+  print(f'{packets} packets from {sender_count} senders over {ROUNDS} beacons, {CLIENTS} clients')
+
+  results = {False: [], True: []}
+  with tempfile.TemporaryDirectory() as directory:
+    # interleaved, so drift in machine speed hits both alike
+    for attempt in range(REPEAT):
+      for gated in (False, True):
+        results[gated].append(run(directory, config, clients, rounds, gated, attempt))
+
+  print(f'{"gate":>5} {"cpu s":>7} {"us/packet":>10} {"published":>10} {"stored":>7}')
+  for gated in (False, True):
+    cpu = min(result[0] for result in results[gated])
+    _, published, written, stats = results[gated][0]
+    print(f'{"on" if gated else "off":>5} {cpu:>7.2f} {cpu / packets * 1e6:>10.1f} {published:>10} {written:>7}')
+  stats = results[True][0][3]
+  saved = 1 - min(result[0] for result in results[True]) / min(result[0] for result in results[False])
+  print(f'redundant positions {stats["redundant"]} of {stats["positions"]} ({stats["redundant"] / max(stats["positions"], 1):.0%}), decryption skipped for {stats["skipped"]} of {packets} packets ({stats["skipped"] / packets:.0%}), {saved:.0%} CPU saved')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,84 @@
+"""
+Compares per-client fan-out with geo-topic routing as the client count grows, counting what the local broker is handed for the same remote traffic.
+
+In `clients` mode a packet is published once per client in range of its sender, under msh/router/<client>/...; in `geo` mode it is published once under the sender's region, msh/geo/<country>/<state>/<city>/..., and clients subscribe to the regions they want. Senders are reverse geocoded offline against the synthetic boundaries of bench_gis.
+
+  python benchmarks/bench_geo.py [packets]
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+import meshmtx.storage
+from meshmtx.gis import OfflineBackend
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.mqtt.loopback import LoopbackBroker
+from meshmtx.utils import PacketUtilities
+
+from bench_gis import make_boundaries
+from bench_loop import envelope
+
+PACKETS = 2000
+SENDERS = 500
+CLIENT_BASE = 0x10000000
+SENDER_BASE = 0x20000000
+MAX_DISTANCE = 30000
+
+
+def run(boundaries: str, directory: str, mode: str, client_count: int, packets: int):
+  rng = random.Random(client_count)
+  clients = [(CLIENT_BASE + i, rng.uniform(49, 59), rng.uniform(-8, 2)) for i in range(client_count)]
+  senders = [(SENDER_BASE + i, rng.uniform(49, 59), rng.uniform(-8, 2)) for i in range(SENDERS)]
+  config = {
+    'clients': [{'id': PacketUtilities.user_to_node_id(id), 'max_distance': MAX_DISTANCE} for id, _, _ in clients],
+    'telemetry': {'id': 'Telemetry', 'key': 'AQ=='},
+    'imports': [],
+    'mqtt': {'local': {'protocol': 5}, 'remote': {}},
+    'geocoder': {'backends': [{'type': 'offline', 'path': boundaries}], 'cache': {'enabled': False}},
+    'pipeline': {'workers': 0},
+    'routing': {'mode': mode, 'precision': 'city'},
+  }
+  storage = meshmtx.storage.get_engine(os.path.join(directory, f'{mode}-{client_count}.db'))
+  meshmtx.storage.Base.metadata.create_all(storage)
+  multiplexer = Multiplexer(config, storage)
+  multiplexer.prepare()
+  multiplexer._geocoder.maybe_update_nodes([(id, latitude, longitude, None) for id, latitude, longitude in clients + senders])
+  # steady state, senders are reverse geocoded once and keep their region until they move
+  for id, _, _ in senders:
+    multiplexer._geocoder.get_node(id, needs_gis=True)
+
+  broker = LoopbackBroker()
+  multiplexer.local.attach_client(broker.client(multiplexer.local.on_message))
+  traffic = [(rng.randrange(SENDERS), i + 1) for i in range(packets)]
+  published = broker.published
+  started = time.perf_counter()
+  for sender, packet_id in traffic:
+    multiplexer.remote.handle_message('msh/EU_868/2/e/LongFast/!abcdef01', envelope(SENDER_BASE + sender, packet_id), 0)
+    broker.drain()
+  elapsed = time.perf_counter() - started
+  storage.dispose()
+  return broker.published - published, packets / elapsed
+
+
+def main():
+  logging.basicConfig(level=logging.ERROR)
+  packets = int(sys.argv[1]) if len(sys.argv) > 1 else PACKETS
+  with tempfile.TemporaryDirectory() as directory:
+    geojson = os.path.join(directory, 'boundaries.geojson')
+    boundaries = os.path.join(directory, 'boundaries.npz')
+    make_boundaries(geojson)
+    OfflineBackend.pack(geojson, boundaries)
+
+    print(f'{packets} packets from {SENDERS} senders')
+    print(f'{"clients":>8} {"mode":>8} {"publishes":>10} {"per packet":>11} {"msgs/s":>9}')
+    for client_count in (100, 1000, 10000):
+      for mode in ('clients', 'geo'):
+        count, rate = run(boundaries, directory, mode, client_count, packets)
+        print(f'{client_count:>8} {mode:>8} {count:>10} {count / packets:>11.2f} {rate:>9.0f}')
+
+
+if __name__ == '__main__':
+  main()
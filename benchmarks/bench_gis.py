@@ -0,0 +1,61 @@
+"""
+Measures offline reverse geocoding latency over a synthetic boundary set: one country, a grid of states and a grid of city polygons within them.
+
+  python benchmarks/bench_gis.py
+"""
+import json
+import os
+import random
+import tempfile
+import time
+
+from meshmtx.gis import OfflineBackend
+
+LOOKUPS = 20000
+
+
+def square(lon: float, lat: float, size: float, points: int = 32):
+  # many vertices per ring, closer to real boundaries than a four point box
+  ring = []
+  for side in range(4):
+    for i in range(points // 4):
+      t = i / (points // 4) * size
+      ring.append([(lon + t, lat), (lon + size, lat + t), (lon + size - t, lat + size), (lon, lat + size - t)][side])
+  ring.append(ring[0])
+  return [ring]
+
+
+def make_boundaries(path: str):
+  features = [{'type': 'Feature', 'properties': {'country_iso3': 'GBR'}, 'geometry': {'type': 'Polygon', 'coordinates': square(-8, 49, 10)}}]
+  for x in range(10):
+    for y in range(10):
+      features.append({'type': 'Feature', 'properties': {'state': f'State {x}.{y}'}, 'geometry': {'type': 'Polygon', 'coordinates': square(-8 + x, 49 + y, 1)}})
+      for cx in range(5):
+        for cy in range(5):
+          features.append({'type': 'Feature', 'properties': {'city': f'City {x}.{y}.{cx}.{cy}'}, 'geometry': {'type': 'Polygon', 'coordinates': square(-8 + x + cx * 0.2, 49 + y + cy * 0.2, 0.1)}})
+  with open(path, 'w') as f:
+    json.dump({'type': 'FeatureCollection', 'features': features}, f)
+  return len(features)
+
+
+def main():
+  with tempfile.TemporaryDirectory() as directory:
+    geojson = os.path.join(directory, 'boundaries.geojson')
+    packed = os.path.join(directory, 'boundaries.npz')
+    count = make_boundaries(geojson)
+    OfflineBackend.pack(geojson, packed)
+    backend = OfflineBackend(packed)
+
+  result = backend.reverse(49.05, -7.95)
+  assert result and result.country_iso3 == 'GBR' and result.state == 'State 0.0' and result.city == 'City 0.0.0.0', result and result.as_dict()
+
+  rng = random.Random(1)
+  points = [(rng.uniform(49, 59), rng.uniform(-8, 2)) for _ in range(LOOKUPS)]
+  started = time.perf_counter()
+  resolved = sum(1 for latitude, longitude in points if backend.reverse(latitude, longitude))
+  elapsed = time.perf_counter() - started
+  print(f'{count} features, {LOOKUPS} lookups ({resolved} resolved): {elapsed / LOOKUPS * 1e6:.1f} us/lookup')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,87 @@
+"""
+Counts local broker publishes per ingress packet for N clients, against an in-process loopback broker, to check each packet is fanned out exactly once.
+
+  python benchmarks/bench_loop.py
+"""
+import os
+import tempfile
+
+import meshtastic
+import meshtastic.protobuf
+
+import meshmtx.storage
+from meshmtx.crypto import ChannelKey, decode_psk
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.mqtt.loopback import LoopbackBroker
+from meshmtx.utils import PacketUtilities
+
+PACKETS = 50
+REMOTE_SENDER = 0x7ffffff0
+
+# cap on broker deliveries, in case loop suppression regresses
+DELIVERY_LIMIT = 100000
+
+
+def envelope(sender: int, packet_id: int, channel: str = 'LongFast') -> bytes:
+  key = ChannelKey(channel, decode_psk('AQ=='))
+  packet = meshtastic.mesh_pb2.MeshPacket()
+  setattr(packet, 'from', sender)
+  packet.id = packet_id
+  packet.to = 0xffffffff
+  packet.channel = key.hash
+  data = meshtastic.mesh_pb2.Data(portnum=meshtastic.portnums_pb2.TEXT_MESSAGE_APP, payload=b'hello')
+  packet.encrypted = key.crypt(sender, packet_id, data.SerializeToString())
+  return meshtastic.mqtt_pb2.ServiceEnvelope(packet=packet, channel_id=channel, gateway_id=f'!{sender:08x}').SerializeToString()
+
+
+def run(client_count: int, protocol: int) -> None:
+  clients = [{'id': PacketUtilities.user_to_node_id(0x10000000 + i), 'max_distance': 10000} for i in range(client_count)]
+  config = {
+    'clients': clients,
+    'telemetry': {'id': 'Telemetry', 'key': 'AQ=='},
+    'imports': [],
+    'mqtt': {'local': {'protocol': protocol}, 'remote': {}},
+    'pipeline': {'workers': 0},
+  }
+
+  with tempfile.TemporaryDirectory() as directory:
+    storage = meshmtx.storage.get_engine(os.path.join(directory, 'state.db'))
+    meshmtx.storage.Base.metadata.create_all(storage)
+    multiplexer = Multiplexer(config, storage)
+    multiplexer.prepare()
+
+    # clients spread 50 km apart, the remote sender is only in range of the first one
+    for i in range(client_count):
+      multiplexer._geocoder.maybe_update_node(0x10000000 + i, 55.0 + i * 0.5, -3.0)
+    multiplexer._geocoder.maybe_update_node(REMOTE_SENDER, 55.0, -3.0)
+
+    broker = LoopbackBroker()
+    multiplexer.local.attach_client(broker.client(multiplexer.local.on_message))
+    device = broker.client()
+
+    # local uplinks from the first client
+    for i in range(PACKETS):
+      device.publish(f'msh/router/{clients[0]["id"]}/2/e/LongFast/!{clients[0]["id"]}', envelope(0x10000000, i + 1))
+    ingress = broker.published
+    broker.drain(DELIVERY_LIMIT)
+    local_fanout = (broker.published - ingress) / PACKETS
+
+    # packets from the remote broker, forwarded to the client in range
+    published = broker.published
+    for i in range(PACKETS):
+      multiplexer.remote.handle_message('msh/EU_868/2/e/LongFast/!abcdef01', envelope(REMOTE_SENDER, i + 1), 0)
+    broker.drain(DELIVERY_LIMIT)
+    remote_fanout = (broker.published - published) / PACKETS
+
+    print(f'{client_count:>8} {"v5" if protocol == 5 else "v3.1.1":>8} {local_fanout:>22.1f} {client_count - 1:>9} {remote_fanout:>23.1f} {1:>9}')
+
+
+def main():
+  print(f'{"clients":>8} {"protocol":>8} {"local publishes/packet":>22} {"expected":>9} {"remote publishes/packet":>23} {"expected":>9}')
+  for client_count in (2, 10, 50):
+    for protocol in (3, 5):
+      run(client_count, protocol)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,75 @@
+"""
+Measures the cost of the hot path instrumentation, disabled and enabled, by replaying synthetic traffic mixes.
+
+The disabled cost is the `lap()` call and the `if lap:` checks left on the hot path. It is timed on its own and compared to the per-message time, as it is too small to separate from run to run noise in a replay.
+
+  python benchmarks/bench_metrics.py
+"""
+import gc
+import os
+import tempfile
+import timeit
+
+import meshmtx.storage
+from meshmtx.metrics import Metrics, NULL_METRICS
+from meshmtx.replay import ReplayDriver
+
+import traffic
+
+PACKETS = 5000
+REPEAT = 5
+
+
+def replay(config, records, path: str, metrics: Metrics) -> float:
+  gc.collect()
+  storage = meshmtx.storage.get_engine(path)
+  meshmtx.storage.Base.metadata.create_all(storage)
+  driver = ReplayDriver(config, storage, metrics)
+  report = driver.replay(records)
+  driver.close()
+  storage.dispose()
+  return report.rate
+
+
+def disabled_cost() -> float:
+  # the longest path through handle_message, with its `if lap:` checks
+  def hot_path():
+    lap = NULL_METRICS.lap()
+    if lap:
+      pass
+    if lap:
+      pass
+    if lap:
+      pass
+    if lap:
+      pass
+    if lap:
+      pass
+    if lap:
+      pass
+    if lap:
+      pass
+
+  def baseline():
+    pass
+
+  return (timeit.timeit(hot_path, number=1000000) - timeit.timeit(baseline, number=1000000)) / 1000000
+
+
+def main():
+  cost = disabled_cost()
+  print(f'disabled instrumentation: {cost * 1e9:.0f} ns/msg')
+  print(f'{"mix":>16} {"disabled msgs/s":>16} {"enabled msgs/s":>15} {"enabled overhead":>17} {"disabled overhead":>18}')
+  with tempfile.TemporaryDirectory() as directory:
+    for mix in ('position-heavy', 'text-heavy', 'duplicate-heavy'):
+      config, records = traffic.generate(mix, PACKETS)
+      # alternate the runs, so drift between them affects both alike
+      disabled = enabled = 0.0
+      for i in range(REPEAT):
+        disabled = max(disabled, replay(config, records, os.path.join(directory, f'{mix}-disabled-{i}.db'), NULL_METRICS))
+        enabled = max(enabled, replay(config, records, os.path.join(directory, f'{mix}-enabled-{i}.db'), Metrics()))
+      print(f'{mix:>16} {disabled:>16.0f} {enabled:>15.0f} {(disabled / enabled - 1) * 100:>16.1f}% {cost * disabled * 100:>17.2f}%')
+
+
+if __name__ == '__main__':
+  main()
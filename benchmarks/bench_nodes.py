@@ -0,0 +1,88 @@
+"""
+Measures the memory held by the node table at 10k, 100k and 1M nodes: per entry for the original dict-backed NodeEntry against the slotted one, and for the whole table (entries plus the spatial index) unbounded and with the default capacity.
+
+Also times `NodeGeocoder.heard`, which runs for every forwarded packet.
+
+  python benchmarks/bench_nodes.py [nodes ...]
+"""
+import gc
+import random
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime
+
+from meshmtx.geocoder import NodeEntry, NodeGeocoder, DEFAULT_NODE_CAPACITY
+
+SIZES = (10000, 100000, 1000000)
+CHUNK = 10000
+
+
+class LegacyNodeEntry:
+  """
+  NodeEntry before it was slotted, every instance carries a __dict__.
+  """
+  gis_dirty: bool = True
+
+  def __init__(self, id: int, latitude: float, longitude: float):
+    self.id = id
+    self.latitude = latitude
+    self.longitude = longitude
+
+
+def updates(count: int, seed: int = 1):
+  rng = random.Random(seed)
+  for i in range(count):
+    yield (0x10000000 + i, 50.0 + rng.uniform(0, 10), -5.0 + rng.uniform(0, 10), datetime.fromtimestamp(1700000000 + i))
+
+
+def traced(build) -> int:
+  gc.collect()
+  tracemalloc.start()
+  kept = build()
+  gc.collect()
+  size = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  del kept
+  return size
+
+
+def build_entries(cls, count: int):
+  entries = {}
+  for id, latitude, longitude, timestamp in updates(count):
+    entry = cls(id, latitude, longitude)
+    entry.timestamp = timestamp
+    entries[id] = entry
+  return entries
+
+
+def build_table(count: int, capacity: int):
+  geocoder = NodeGeocoder(capacity=capacity, ttl=0, loader=lambda id: None)
+  batch = []
+  for update in updates(count):
+    batch.append(update)
+    if len(batch) == CHUNK:
+      geocoder.maybe_update_nodes(batch)
+      batch = []
+  geocoder.maybe_update_nodes(batch)
+  return geocoder
+
+
+def main():
+  sizes = [int(size) for size in sys.argv[1:]] or SIZES
+  print(f'{"nodes":>9} {"legacy B/node":>14} {"slots B/node":>13} {"table MB":>9} {"bounded MB":>11} {"heard ns":>9}')
+  for count in sizes:
+    legacy = traced(lambda: build_entries(LegacyNodeEntry, count)) / count
+    slots = traced(lambda: build_entries(NodeEntry, count)) / count
+    unbounded = traced(lambda: build_table(count, 0)) / 1e6
+    bounded = traced(lambda: build_table(count, DEFAULT_NODE_CAPACITY)) / 1e6
+
+    geocoder = build_table(min(count, DEFAULT_NODE_CAPACITY), 0)
+    ids = [0x10000000 + i for i in range(0, min(count, DEFAULT_NODE_CAPACITY), 7)]
+    heard = geocoder.heard
+    seconds = min(timeit.repeat(lambda: [heard(id) for id in ids], number=1, repeat=5)) / len(ids)
+    print(f'{count:>9} {legacy:>14.0f} {slots:>13.0f} {unbounded:>9.1f} {bounded:>11.1f} {seconds * 1e9:>9.0f}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,225 @@
+"""
+Publishes fan-out through a real paho client to a minimal in-process broker over TCP, comparing the original single publish queue (one FIFO, one lock hold per message) with the output stage (per-client queues, deficit round robin, batched publishes).
+
+`throughput` spreads messages evenly over the clients and reports the rate the broker receives them at, for QoS 0 and QoS 1 at two inflight limits. `fairness` has one client take a burst far larger than its queue while the others send a trickle, and reports how long the quiet clients' messages took to reach the broker and how many of them arrived.
+
+  python benchmarks/bench_output.py [messages]
+"""
+import logging
+import os
+import socket
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import meshmtx.storage
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.pipeline import BoundedQueue, DropPolicy
+from meshmtx.utils import PacketUtilities
+
+MESSAGES = 50000
+CLIENTS = 20
+PRODUCERS = 2
+PAYLOAD = 120
+BURST_QUEUE_SIZE = 10000
+QUIET_MESSAGES = 200
+
+_stamp = struct.Struct('<d')
+
+
+class SinkBroker(threading.Thread):
+  """
+  Just enough of an MQTT 3.1.1 broker for one publishing client: acknowledges the connection, subscriptions and QoS 1 publishes, and records when each publish arrived.
+  """
+  def __init__(self):
+    threading.Thread.__init__(self, name='bench:broker', daemon=True)
+    self._server = socket.create_server(('127.0.0.1', 0))
+    self.port = self._server.getsockname()[1]
+    self.received = []
+    self.done = threading.Event()
+    self.expected = None
+
+  def run(self):
+    connection, _ = self._server.accept()
+    buffer = b''
+    while True:
+      try:
+        data = connection.recv(1 << 16)
+      except ConnectionResetError:
+        return
+      if not data:
+        return
+      buffer += data
+      while True:
+        packet = self._split(buffer)
+        if packet is None:
+          break
+        header, body, buffer = packet
+        self._handle(connection, header, body)
+
+  def _split(self, buffer: bytes):
+    if len(buffer) < 2:
+      return None
+    length = 0
+    shift = 0
+    for i in range(1, min(len(buffer), 5)):
+      length |= (buffer[i] & 0x7f) << shift
+      shift += 7
+      if not buffer[i] & 0x80:
+        end = i + 1 + length
+        if len(buffer) < end:
+          return None
+        return buffer[0], buffer[i + 1:end], buffer[end:]
+    return None
+
+  def _handle(self, connection: socket.socket, header: int, body: bytes):
+    kind = header >> 4
+    if kind == 1:
+      connection.sendall(b'\x20\x02\x00\x00')
+    elif kind == 8:
+      connection.sendall(b'\x90\x03' + body[:2] + b'\x00')
+    elif kind == 12:
+      connection.sendall(b'\xd0\x00')
+    elif kind == 3:
+      qos = (header >> 1) & 3
+      topic_end = 2 + struct.unpack_from('>H', body)[0]
+      offset = topic_end
+      if qos:
+        connection.sendall(b'\x40\x02' + body[offset:offset + 2])
+        offset += 2
+      self.received.append((time.perf_counter(), body[2:topic_end], body[offset:offset + _stamp.size]))
+      if self.expected is not None and len(self.received) >= self.expected:
+        self.done.set()
+
+
+class LegacyOutput:
+  """
+  The publish stage as it was before per-client queues: one FIFO for all clients, one publish and lock hold per message.
+  """
+  def __init__(self, multiplexer: Multiplexer, queue_size: int):
+    self._local = multiplexer.local
+    self._queue = BoundedQueue('publish', queue_size, DropPolicy.OLDEST)
+    self._thread = threading.Thread(target=self._publish, daemon=True)
+
+  def start(self):
+    self._thread.start()
+
+  def stop(self):
+    self._queue.close()
+    self._thread.join()
+
+  def publish(self, client, topic, payload, portnum=None, received=None) -> bool:
+    return self._queue.put((topic, payload, received))
+
+  def _publish(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      self._local.publish(item[0], item[1])
+
+  def stats(self):
+    return {'dropped': self._queue.dropped}
+
+
+def setup(directory: str, legacy: bool, qos: int, max_inflight: int, queue_size: int):
+  broker = SinkBroker()
+  broker.start()
+  clients = [{'id': PacketUtilities.user_to_node_id(0x10000000 + i), 'max_distance': 10000} for i in range(CLIENTS)]
+  config = {
+    'clients': clients,
+    'telemetry': {'id': 'Telemetry', 'key': 'AQ=='},
+    'imports': [],
+    'mqtt': {'local': {'address': '127.0.0.1', 'port': broker.port, 'username': None, 'password': None}, 'remote': {}},
+    'geocoder': {'cache': {'enabled': False}},
+    'pipeline': {'workers': 1},
+    'output': {'qos': qos, 'max_inflight': max_inflight, 'queue_size': queue_size},
+  }
+  storage = meshmtx.storage.get_engine(os.path.join(directory, 'state.db'))
+  meshmtx.storage.Base.metadata.create_all(storage)
+  multiplexer = Multiplexer(config, storage)
+  multiplexer.prepare()
+  if legacy:
+    multiplexer.output = LegacyOutput(multiplexer, queue_size * CLIENTS)
+  multiplexer.output.start()
+  multiplexer.local.start()
+  while not multiplexer.local.connected:
+    time.sleep(0.01)
+  return broker, multiplexer, [client['id'] for client in clients]
+
+
+def teardown(multiplexer: Multiplexer):
+  multiplexer.output.stop()
+  multiplexer.local.stop()
+  multiplexer.local.join()
+
+
+def produce(multiplexer: Multiplexer, plan):
+  local = multiplexer.local
+  filler = b'\x00' * (PAYLOAD - _stamp.size)
+  def work(items):
+    for client, pause in items:
+      local.publish_client(client, _stamp.pack(time.perf_counter()) + filler, 'x')
+      if pause:
+        time.sleep(pause)
+  threads = [threading.Thread(target=work, args=(items,)) for items in plan]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+
+def throughput(legacy: bool, messages: int, qos: int, max_inflight: int) -> float:
+  with tempfile.TemporaryDirectory() as directory:
+    broker, multiplexer, ids = setup(directory, legacy, qos, max_inflight, messages)
+    broker.expected = messages
+    plan = [[(ids[i % CLIENTS], 0) for i in range(p, messages, PRODUCERS)] for p in range(PRODUCERS)]
+    started = time.perf_counter()
+    produce(multiplexer, plan)
+    broker.done.wait(60)
+    elapsed = broker.received[-1][0] - started
+    teardown(multiplexer)
+  return len(broker.received) / elapsed
+
+
+def fairness(legacy: bool, messages: int):
+  with tempfile.TemporaryDirectory() as directory:
+    queue_size = BURST_QUEUE_SIZE // CLIENTS
+    broker, multiplexer, ids = setup(directory, legacy, 0, 20, queue_size)
+    hot = ids[0]
+    quiet = [(ids[1 + i % (CLIENTS - 1)], 0.0005) for i in range(QUIET_MESSAGES)]
+    produce(multiplexer, [[(hot, 0)] * messages, quiet])
+    time.sleep(1)
+    teardown(multiplexer)
+
+  quiet_topics = {f'msh/router/{id}/x'.encode() for id in ids[1:]}
+  latencies = [received - _stamp.unpack(stamp)[0] for received, topic, stamp in broker.received if topic in quiet_topics]
+  latencies.sort()
+  p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0.0
+  return statistics.median(latencies) if latencies else 0.0, p99, len(latencies), len(broker.received) - len(latencies)
+
+
+def main():
+  logging.basicConfig(level=logging.ERROR)
+  messages = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+
+  print('throughput')
+  print(f'{"stage":>8} {"qos":>4} {"inflight":>9} {"msgs/s":>9}')
+  for qos, max_inflight in ((0, 20), (1, 20), (1, 100)):
+    for legacy in (True, False):
+      rate = throughput(legacy, messages, qos, max_inflight)
+      print(f'{"legacy" if legacy else "output":>8} {qos:>4} {max_inflight:>9} {rate:>9.0f}')
+
+  print()
+  print(f'fairness, a burst of {messages} for one client while {CLIENTS - 1} others send {QUIET_MESSAGES} between them')
+  print(f'{"stage":>8} {"quiet p50 ms":>13} {"quiet p99 ms":>13} {"quiet kept":>11} {"hot kept":>9}')
+  for legacy in (True, False):
+    p50, p99, kept, hot = fairness(legacy, messages)
+    print(f'{"legacy" if legacy else "output":>8} {p50 * 1e3:>13.1f} {p99 * 1e3:>13.1f} {kept:>11} {hot:>9}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,102 @@
+"""
+Measures what flood control costs per forwarded message with 100k senders tracked, and what it sheds when one node floods telemetry next to normal traffic.
+
+`cost` times the pre-decryption check, the sender bucket and the buckets of the clients a message is routed to, against the table filled with 100k senders, and the sweep of that table. `flood` replays a minute of traffic at simulated time: one node sending telemetry at 20 messages/s with a position every 10s, next to 1000 nodes sending a position or text message every 30s, and counts what each class got through.
+
+  python benchmarks/bench_ratelimit.py
+"""
+import random
+import timeit
+
+import meshtastic
+import meshtastic.protobuf
+
+from meshmtx.ratelimit import FloodControl
+from meshmtx.routing import ClientRoute
+from meshmtx.utils import PacketUtilities
+
+SENDERS = 100000
+CLIENTS = 1000
+ROUTES = 4
+NUMBER = 200000
+REPEAT = 5
+
+PORTNUMS = meshtastic.portnums_pb2
+PRIORITIES = {'TEXT_MESSAGE_APP': 2, 'POSITION_APP': 1}
+CONFIG = {'sender': {'rate': 1, 'burst': 20}, 'client': {'rate': 50, 'burst': 500}, 'reserve': 0.5}
+
+
+def cost():
+  rng = random.Random(1)
+  # sweeps are timed on their own
+  limits = FloodControl({**CONFIG, 'sweep_interval': 1e9}, PRIORITIES)
+  for sender in range(SENDERS):
+    limits.admit_sender(sender, PORTNUMS.POSITION_APP, 0.0)
+  clients = [ClientRoute({'id': PacketUtilities.user_to_node_id(0x10000000 + i)}) for i in range(CLIENTS)]
+  routes = [tuple(rng.sample(clients, ROUTES)) for _ in range(256)]
+  messages = [(rng.randrange(SENDERS), rng.choice((PORTNUMS.POSITION_APP, PORTNUMS.TEXT_MESSAGE_APP, PORTNUMS.TELEMETRY_APP)), routes[i % len(routes)]) for i in range(NUMBER)]
+
+  # a message every millisecond leaves the buckets topped up, so messages pass and take the full path
+  clock = [1000.0]
+  def limited():
+    now = clock[0]
+    for sender, portnum, routed in messages:
+      now += 0.001
+      if limits.may_send(sender, now) and limits.admit_sender(sender, portnum, now):
+        limits.admit_clients(routed, portnum, now)
+    clock[0] = now
+
+  def baseline():
+    now = clock[0]
+    for sender, portnum, routed in messages:
+      now += 0.001
+
+  # interleaved, so drift in machine speed hits both alike
+  limited_times = []
+  baseline_times = []
+  for _ in range(REPEAT):
+    baseline_times.append(timeit.timeit(baseline, number=1))
+    limited_times.append(timeit.timeit(limited, number=1))
+  per_message = (min(limited_times) - min(baseline_times)) / NUMBER
+  stats = limits.stats()
+  sweep = timeit.timeit(lambda: limits._senders.sweep(0.0), number=REPEAT) / REPEAT
+  print(f'{stats["senders"]} senders and {stats["clients"]} clients tracked, {ROUTES} routes per message: {per_message * 1e6:.2f} us/msg, {stats["shed_sender"] + stats["shed_client"]} shed, sweep {sweep * 1e3:.1f} ms')
+
+
+def flood():
+  limits = FloodControl(CONFIG, PRIORITIES)
+  rng = random.Random(2)
+  events = []
+  for step in range(60 * 20):
+    now = step / 20
+    events.append((now, 1, PORTNUMS.TELEMETRY_APP))
+    if step % 200 == 0:
+      events.append((now, 1, PORTNUMS.POSITION_APP))
+  for sender in range(2, 1002):
+    offset = rng.uniform(0, 30)
+    for period in range(2):
+      events.append((offset + period * 30, sender, rng.choice((PORTNUMS.POSITION_APP, PORTNUMS.TEXT_MESSAGE_APP))))
+  events.sort()
+
+  sent = {}
+  passed = {}
+  for now, sender, portnum in events:
+    key = ('flood' if sender == 1 else 'normal', PORTNUMS.PortNum.Name(portnum))
+    sent[key] = sent.get(key, 0) + 1
+    if limits.may_send(sender, now) and limits.admit_sender(sender, portnum, now):
+      passed[key] = passed.get(key, 0) + 1
+
+  print()
+  print(f'{"node":>7} {"portnum":>17} {"sent":>6} {"passed":>7}')
+  for key in sorted(sent):
+    print(f'{key[0]:>7} {key[1]:>17} {sent[key]:>6} {passed.get(key, 0):>7}')
+  print(limits.stats())
+
+
+def main():
+  cost()
+  flood()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,154 @@
+"""
+Measures how long a config reload takes with thousands of clients and 100k nodes in the node table, against what a restart has to redo, and checks that no packet is lost while reloads happen under traffic.
+
+`reload` applies one change at a time: clients added (loaded from storage), removed, moved to a new max distance, a channel key rotated and a remote subscription added. `restart` is the part of a restart a reload avoids: building the multiplexer and routing table from scratch and streaming the node table back in from storage, with the connections left out. `traffic` forwards remote packets from one thread while another reloads client changes far from the sender, and counts what reached the broker.
+
+  python benchmarks/bench_reload.py [clients ...]
+"""
+import copy
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import sqlalchemy
+
+import meshmtx.storage
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.mqtt.loopback import LoopbackBroker
+from meshmtx.storage import NodeState
+from meshmtx.utils import PacketUtilities
+
+from bench_loop import envelope
+
+SIZES = (1000, 5000)
+NODES = 100000
+CHANGED = 10
+CLIENT_BASE = 0x10000000
+SENDER_BASE = 0x20000000
+TRAFFIC_PACKETS = 5000
+RELOADS = 20
+
+
+def make_config(client_count: int) -> dict:
+  return {
+    'clients': [{'id': PacketUtilities.user_to_node_id(CLIENT_BASE + i), 'max_distance': 30000} for i in range(client_count)],
+    'telemetry': {'id': 'Telemetry', 'key': 'AQ=='},
+    'channels': [{'name': 'LongFast', 'key': 'AQ=='}],
+    'imports': [],
+    'mqtt': {'local': {}, 'remote': {'subscriptions': ['msh/EU_868/2/e/#']}},
+    'geocoder': {'cache': {'enabled': False}},
+    'pipeline': {'workers': 0},
+  }
+
+
+def build_state(path: str, client_count: int):
+  rng = random.Random(client_count)
+  storage = meshmtx.storage.get_engine(path)
+  meshmtx.storage.Base.metadata.create_all(storage)
+  timestamp = datetime.fromtimestamp(1700000000)
+  # room for the clients added by the benchmark
+  rows = [{'id': CLIENT_BASE + i, 'timestamp': timestamp, 'latitude': rng.uniform(50, 58), 'longitude': rng.uniform(-6, 2)} for i in range(client_count + CHANGED)]
+  rows += [{'id': SENDER_BASE + i, 'timestamp': timestamp, 'latitude': rng.uniform(50, 58), 'longitude': rng.uniform(-6, 2)} for i in range(NODES)]
+  with storage.begin() as connection:
+    connection.execute(sqlalchemy.insert(NodeState), rows)
+  return storage
+
+
+def start(storage, config: dict):
+  multiplexer = Multiplexer(config, storage)
+  multiplexer.prepare()
+  multiplexer.nodes_loaded.wait()
+  broker = LoopbackBroker()
+  multiplexer.local.attach_client(broker.client(multiplexer.local.on_message))
+  multiplexer.remote.attach_client(broker.client())
+  return multiplexer, broker
+
+
+def changes(config: dict, client_count: int):
+  clients = config['clients']
+  added = copy.deepcopy(config)
+  added['clients'] = clients + [{'id': PacketUtilities.user_to_node_id(CLIENT_BASE + client_count + i), 'max_distance': 30000} for i in range(CHANGED)]
+  removed = copy.deepcopy(config)
+  removed['clients'] = clients[CHANGED:]
+  moved = copy.deepcopy(config)
+  for client in moved['clients'][:CHANGED]:
+    client['max_distance'] = 60000
+  keys = copy.deepcopy(config)
+  keys['channels'] = [{'name': 'LongFast', 'key': 'AQ=='}, {'name': 'Private', 'key': 'c2VjcmV0c2VjcmV0c2VjcmV0'}]
+  subscriptions = copy.deepcopy(config)
+  subscriptions['mqtt']['remote']['subscriptions'] = ['msh/EU_868/2/e/#', 'msh/US/2/e/#']
+  return [('add clients', added), ('remove clients', removed), ('max distance', moved), ('channel key', keys), ('subscription', subscriptions)]
+
+
+def reload(storage, config: dict, client_count: int):
+  multiplexer, _ = start(storage, config)
+  results = []
+  for name, changed in changes(config, client_count):
+    started = time.perf_counter()
+    multiplexer.reload(changed)
+    applied = time.perf_counter() - started
+    # and back, so each change starts from the same config
+    multiplexer.reload(config)
+    results.append((name, applied))
+  return results
+
+
+def restart(storage, config: dict) -> float:
+  started = time.perf_counter()
+  multiplexer = Multiplexer(config, storage)
+  multiplexer.prepare()
+  multiplexer.nodes_loaded.wait()
+  return time.perf_counter() - started
+
+
+def traffic(storage, config: dict, client_count: int):
+  # the sender is next to the first client, the clients added and removed are out of its range
+  config = copy.deepcopy(config)
+  multiplexer, broker = start(storage, config)
+  latitudes, longitudes = multiplexer._geocoder.index.positions([CLIENT_BASE])
+  multiplexer._geocoder.maybe_update_nodes([(SENDER_BASE + NODES, float(latitudes[0]), float(longitudes[0]), None)])
+  expected = len(multiplexer.routing.lookup(SENDER_BASE + NODES))
+
+  far = [{'id': PacketUtilities.user_to_node_id(CLIENT_BASE + client_count + i), 'max_distance': 1} for i in range(CHANGED)]
+  variants = [config, {**config, 'clients': config['clients'] + far}]
+  done = threading.Event()
+  reloads = [0]
+  def reloader():
+    while not done.is_set() and reloads[0] < RELOADS:
+      multiplexer.reload(variants[reloads[0] % 2])
+      reloads[0] += 1
+
+  published = broker.published
+  thread = threading.Thread(target=reloader)
+  thread.start()
+  for i in range(TRAFFIC_PACKETS):
+    multiplexer.remote.handle_message('msh/EU_868/2/e/LongFast/!abcdef01', envelope(SENDER_BASE + NODES, i + 1), time.time())
+    broker.drain()
+  done.set()
+  thread.join()
+  return broker.published - published, TRAFFIC_PACKETS * expected, reloads[0]
+
+
+def main():
+  logging.basicConfig(level=logging.ERROR)
+  sizes = [int(size) for size in sys.argv[1:]] or SIZES
+  with tempfile.TemporaryDirectory() as directory:
+    for client_count in sizes:
+      storage = build_state(os.path.join(directory, f'state-{client_count}.db'), client_count)
+      config = make_config(client_count)
+      print(f'{client_count} clients, {NODES} nodes')
+      for name, applied in reload(storage, config, client_count):
+        print(f'  reload {name:>15}: {applied * 1e3:8.1f} ms')
+      print(f'  {"restart":>22}: {restart(storage, config) * 1e3:8.1f} ms, without reconnecting')
+      published, expected, reloads = traffic(storage, config, client_count)
+      print(f'  {"traffic":>22}: {published} of {expected} packets published across {reloads} reloads')
+      storage.dispose()
+
+
+if __name__ == '__main__':
+  main()
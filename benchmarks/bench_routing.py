@@ -0,0 +1,58 @@
+"""
+Compares the per-message cost of the original per-client geodesic loop against a routing table lookup as the client count grows.
+
+  python benchmarks/bench_routing.py
+"""
+import random
+import timeit
+
+from meshmtx.geocoder import NodeGeocoder
+from meshmtx.routing import RoutingTable
+from meshmtx.utils import PacketUtilities, DEFAULT_MAX_DISTANCE
+
+SENDER_ID = 0x7fffffff
+ITERATIONS = 200
+
+
+def make_geocoder(client_count: int):
+  rng = random.Random(client_count)
+  geocoder = NodeGeocoder()
+
+  clients = []
+  for i in range(client_count):
+    node_id = 0x10000000 + i
+    geocoder.maybe_update_node(node_id, 55.95 + rng.uniform(-2, 2), -3.19 + rng.uniform(-2, 2))
+    clients.append({'id': PacketUtilities.user_to_node_id(node_id), 'max_distance': DEFAULT_MAX_DISTANCE})
+  geocoder.maybe_update_node(SENDER_ID, 55.95, -3.19)
+  return geocoder, clients
+
+
+def legacy_route(geocoder: NodeGeocoder, clients, node_id: int):
+  remote_entry = geocoder.get_node(node_id)
+  routed = []
+  for client in clients:
+    id = PacketUtilities.node_to_user_id(client['id'])
+    entry = geocoder.get_node(id)
+    if not entry:
+      continue
+    if not entry.is_within_distance_from(remote_entry, client.get('max_distance', DEFAULT_MAX_DISTANCE)):
+      continue
+    routed.append(client['id'])
+  return routed
+
+
+def main():
+  print(f'{"clients":>8} {"legacy us/msg":>14} {"table us/msg":>13}')
+  for client_count in (1, 10, 100, 1000):
+    geocoder, clients = make_geocoder(client_count)
+    table = RoutingTable(clients, geocoder)
+    assert sorted(r.id for r in table.lookup(SENDER_ID)) == sorted(legacy_route(geocoder, clients, SENDER_ID))
+
+    iterations = max(1, ITERATIONS // client_count)
+    legacy = timeit.timeit(lambda: legacy_route(geocoder, clients, SENDER_ID), number=iterations) / iterations
+    lookup = timeit.timeit(lambda: table.lookup(SENDER_ID), number=100000) / 100000
+    print(f'{client_count:>8} {legacy * 1e6:>14.2f} {lookup * 1e6:>13.3f}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,88 @@
+"""
+Replays the remote half of a synthetic capture through 1, 2 and 4 shard processes and compares it with the single process remote thread.
+
+Wall clock scaling needs as many free cores as shards. The CPU time of each shard and of the parent (the remote thread scanning and admitting messages, plus the coordinator applying results) is reported too, and the projected rate assumes each of them gets a core of its own, i.e. is bounded by the busiest of them.
+
+  python benchmarks/bench_sharding.py [mix]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import meshmtx.storage
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.mqtt.loopback import LoopbackBroker
+from meshmtx.sharding import ShardedIngest
+
+import traffic
+
+PACKETS = 20000
+
+
+def prepare(config, records, path: str):
+  storage = meshmtx.storage.get_engine(path)
+  meshmtx.storage.Base.metadata.create_all(storage)
+  multiplexer = Multiplexer({**config, 'pipeline': {'workers': 0}}, storage)
+  multiplexer.prepare()
+
+  # publishes are queued on the broker and never delivered, only the remote side is measured
+  broker = LoopbackBroker()
+  multiplexer.local.attach_client(broker.client())
+  multiplexer.remote.attach_client(broker.client())
+  for record in records:
+    if record.source == 'local':
+      multiplexer.local.handle_message(record.topic, record.payload, record.timestamp)
+  return multiplexer, broker
+
+
+def single(config, records, path: str):
+  multiplexer, broker = prepare(config, records, path)
+  remote = [record for record in records if record.source == 'remote']
+  published = broker.published
+  start = time.perf_counter()
+  cpu = time.process_time()
+  for record in remote:
+    multiplexer.remote.handle_message(record.topic, record.payload, record.timestamp)
+  elapsed = time.perf_counter() - start
+  return len(remote) / elapsed, time.process_time() - cpu, broker.published - published
+
+
+def sharded(config, records, path: str, processes: int):
+  config = {**config, 'sharding': {'processes': processes}}
+  multiplexer, broker = prepare(config, records, path)
+  remote = [record for record in records if record.source == 'remote']
+  published = broker.published
+
+  shards = ShardedIngest(config, multiplexer)
+  shards.start()
+  multiplexer.remote.shards = shards
+  shards.ready.wait()
+  start = time.perf_counter()
+  cpu = time.process_time()
+  for record in remote:
+    multiplexer.remote.handle_message(record.topic, record.payload, record.timestamp)
+  shards.stop()
+  elapsed = time.perf_counter() - start
+  parent_cpu = time.process_time() - cpu
+  shard_cpu = [shards.shard_stats[shard]['cpu'] for shard in sorted(shards.shard_stats)]
+  busiest = max(shard_cpu + [parent_cpu])
+  return len(remote) / elapsed, shard_cpu, parent_cpu, len(remote) / busiest, broker.published - published
+
+
+def main():
+  mix = sys.argv[1] if len(sys.argv) > 1 else 'text-heavy'
+  config, records = traffic.generate(mix, PACKETS)
+  print(f'{mix}, {sum(1 for record in records if record.source == "remote")} remote messages, {os.cpu_count()} cores')
+  print(f'{"processes":>9} {"published":>10} {"wall msgs/s":>12} {"shard cpu s":>20} {"parent cpu s":>18} {"projected msgs/s":>17}')
+
+  with tempfile.TemporaryDirectory() as directory:
+    rate, cpu, published = single(config, records, os.path.join(directory, 'single.db'))
+    print(f'{"thread":>9} {published:>10} {rate:>12.0f} {cpu:>20.2f} {"":>18} {rate:>17.0f}')
+    for processes in (1, 2, 4):
+      rate, shard_cpu, parent_cpu, projected, published = sharded(config, records, os.path.join(directory, f'sharded-{processes}.db'), processes)
+      print(f'{processes:>9} {published:>10} {rate:>12.0f} {"/".join(f"{cpu:.2f}" for cpu in shard_cpu):>20} {parent_cpu:>18.2f} {projected:>17.0f}')
+
+
+if __name__ == '__main__':
+  main()
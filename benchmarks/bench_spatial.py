@@ -0,0 +1,70 @@
+"""
+Checks the vectorized distance kernel against geopy's geodesic, and compares throughput of scalar versus batched proximity queries.
+
+  python benchmarks/bench_spatial.py
+"""
+import random
+import time
+
+import geopy.distance
+import numpy as np
+
+from meshmtx.spatial import NodeIndex, distance
+
+PAIRS = 2000
+NODES = 100000
+RADIUS = 80000
+
+
+def accuracy():
+  rng = random.Random(1)
+  errors = []
+  for _ in range(PAIRS):
+    lat1, lon1 = rng.uniform(-80, 80), rng.uniform(-180, 180)
+    # mostly regional distances, with some long haul pairs
+    spread = 2 if rng.random() < 0.8 else 60
+    lat2 = max(-89.0, min(89.0, lat1 + rng.uniform(-spread, spread)))
+    lon2 = lon1 + rng.uniform(-spread, spread)
+    expected = geopy.distance.geodesic((lat1, lon1), (lat2, lon2)).meters
+    errors.append(abs(float(distance(lat1, lon1, lat2, lon2)) - expected))
+  errors = np.array(errors)
+  print(f'accuracy over {PAIRS} pairs: max error {errors.max():.3f} m, mean error {errors.mean():.3f} m')
+
+
+def throughput():
+  rng = np.random.default_rng(1)
+  ids = np.arange(NODES)
+  latitudes = rng.uniform(49, 61, NODES)
+  longitudes = rng.uniform(-8, 2, NODES)
+
+  started = time.perf_counter()
+  index = NodeIndex()
+  index.bulk_update(ids.tolist(), latitudes.tolist(), longitudes.tolist())
+  print(f'indexed {NODES} nodes in {time.perf_counter() - started:.3f} s')
+
+  # a single scalar scan is enough, it takes seconds
+  started = time.perf_counter()
+  origin = (latitudes[0], longitudes[0])
+  [id for id, lat, lon in zip(ids, latitudes, longitudes) if geopy.distance.geodesic(origin, (lat, lon)).meters <= RADIUS]
+  scalar = time.perf_counter() - started
+
+  sample = 200
+
+  started = time.perf_counter()
+  found = 0
+  for i in range(sample):
+    found += len(index.query_radius(latitudes[i], longitudes[i], RADIUS))
+  batched = (time.perf_counter() - started) / sample
+
+  print(f'nodes near a point, scalar geodesic scan: {scalar * 1e3:.1f} ms/query')
+  print(f'nodes near a point, grid + vectorized:    {batched * 1e3:.3f} ms/query ({found // sample} matches on average)')
+
+  started = time.perf_counter()
+  matrix = distance(latitudes[:4096, None], longitudes[:4096, None], latitudes[None, :1000], longitudes[None, :1000])
+  elapsed = time.perf_counter() - started
+  print(f'bulk recompute of 4096 nodes x 1000 clients: {elapsed * 1e3:.1f} ms ({matrix.size / elapsed / 1e6:.1f} M distances/s)')
+
+
+if __name__ == '__main__':
+  accuracy()
+  throughput()
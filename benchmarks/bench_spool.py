@@ -0,0 +1,83 @@
+"""
+Simulates a local broker outage against the spool: the cost of spooling a message, memory held while the outage lasts, and the catch-up drain once the broker is back, checking nothing is reordered.
+
+A second run caps each client's spool well below the outage, to show the oldest messages go first and the most recent ones survive.
+
+  python benchmarks/bench_spool.py [messages]
+"""
+import gc
+import logging
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from meshmtx.spool import Spool
+
+MESSAGES = 200000
+CLIENTS = 20
+PAYLOAD = 120
+# payload, topic and record header
+MESSAGE_BYTES = PAYLOAD + 60
+CHECKPOINTS = 4
+
+_sequence = struct.Struct('<I')
+
+
+def outage(directory: str, messages: int, max_bytes: int, segment_size: int):
+  delivered = []
+  config = {'path': directory, 'max_bytes': max_bytes, 'segment_size': segment_size, 'drain_rate': 0}
+  spool = Spool(config, [], lambda topic, payload: delivered.append(payload) is None)
+
+  rng = random.Random(1)
+  filler = rng.randbytes(PAYLOAD - _sequence.size)
+  topics = [f'msh/router/{0x10000000 + i:08x}/2/e/LongFast/!abcdef01' for i in range(CLIENTS)]
+  now = time.time()
+
+  # the first half is timed, the second half traced, as tracing slows appends down several times
+  half = messages // 2
+  started = time.perf_counter()
+  for i in range(half):
+    spool.append(rng.choice(topics), _sequence.pack(i) + filler, now + i * 1e-6)
+  appended = time.perf_counter() - started
+
+  gc.collect()
+  tracemalloc.start()
+  baseline = tracemalloc.get_traced_memory()[0]
+  held = []
+  for i in range(half, messages):
+    spool.append(rng.choice(topics), _sequence.pack(i) + filler, now + i * 1e-6)
+    if (i + 1 - half) % (half // CHECKPOINTS) == 0:
+      held.append(tracemalloc.get_traced_memory()[0] - baseline)
+  tracemalloc.stop()
+  on_disk = spool.stats()['bytes']
+
+  started = time.perf_counter()
+  spool.drain()
+  drained = time.perf_counter() - started
+
+  sequences = [_sequence.unpack_from(payload)[0] for payload in delivered]
+  ordered = all(a < b for a, b in zip(sequences, sequences[1:]))
+  spool.stop()
+  return appended / half, held, on_disk, len(delivered), drained, ordered, sequences[-1] if sequences else None
+
+
+def main():
+  # the capped run warns for every trim
+  logging.basicConfig(level=logging.ERROR)
+  messages = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+  per_client = messages * MESSAGE_BYTES // CLIENTS
+  print(f'{"cap KB/client":>14} {"append us":>10} {"held KB at 25/50/75/100%":>26} {"disk MB":>8} {"drained":>8} {"drain msgs/s":>13} {"ordered":>8} {"last kept":>10}')
+  # uncapped, then capped at a quarter of each client's share with segments small enough to trim by
+  for max_bytes, segment_size in ((per_client * 2, 1 << 20), (per_client // 4, 64 << 10)):
+    with tempfile.TemporaryDirectory() as directory:
+      append, held, on_disk, delivered, drained, ordered, last = outage(os.path.join(directory, 'spool'), messages, max_bytes, segment_size)
+    held_kb = '/'.join(f'{size / 1024:.0f}' for size in held)
+    print(f'{max_bytes / 1024:>14.0f} {append * 1e6:>10.1f} {held_kb:>26} {on_disk / 1e6:>8.1f} {delivered:>8} {delivered / drained:>13.0f} {str(ordered):>8} {last:>10}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,128 @@
+"""
+Measures time to first forwarded message on a large state database, from process start to the first remote packet being published to a client.
+
+Each run is a fresh process. `lazy` forwards as soon as the brokers could connect, while the node table streams in behind; `blocking` waits for the node table first, like the original startup. The original full ORM scan into the node table is timed on its own for reference.
+
+  python benchmarks/bench_startup.py [nodes ...]
+"""
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+SIZES = (100000, 1000000)
+CLIENT_ID = 0x10000000
+SENDER_ID = 0x20000000
+INSERT_CHUNK = 50000
+
+
+def config() -> dict:
+  from meshmtx.utils import PacketUtilities
+  return {
+    'clients': [{'id': PacketUtilities.user_to_node_id(CLIENT_ID), 'max_distance': 80000}],
+    'telemetry': {'id': 'Telemetry', 'key': 'AQ=='},
+    'channels': [{'name': 'LongFast', 'key': 'AQ=='}],
+    'imports': [],
+    'mqtt': {'local': {}, 'remote': {}},
+    'geocoder': {'cache': {'enabled': False}},
+    'pipeline': {'workers': 0},
+  }
+
+
+def child(path: str, mode: str, started: float, payload: bytes):
+  import meshmtx.storage
+  from meshmtx.multiplexer import Multiplexer
+  from meshmtx.mqtt.loopback import LoopbackBroker
+  imported = time.time()
+
+  storage = meshmtx.storage.get_engine(path)
+  multiplexer = Multiplexer(config(), storage)
+  multiplexer.prepare()
+  broker = LoopbackBroker()
+  multiplexer.local.attach_client(broker.client(multiplexer.local.on_message))
+  prepared = time.time()
+
+  if mode == 'blocking':
+    multiplexer.nodes_loaded.wait()
+  multiplexer.remote.handle_message('msh/EU_868/2/e/LongFast/!abcdef01', payload, time.time())
+  forwarded = time.time()
+  assert broker.published == 1, 'the first packet was not forwarded'
+
+  multiplexer.nodes_loaded.wait()
+  loaded = time.time()
+  print(json.dumps({'imports': imported - started, 'ready': prepared - started, 'first': forwarded - started, 'loaded': loaded - started}))
+
+
+def build_state(path: str, count: int):
+  import sqlalchemy
+  import meshmtx.storage
+  from meshmtx.storage import NodeState
+
+  rng = random.Random(count)
+  storage = meshmtx.storage.get_engine(path)
+  meshmtx.storage.Base.metadata.create_all(storage)
+  rows = [{'id': CLIENT_ID, 'timestamp': datetime.fromtimestamp(1700000000), 'latitude': 55.0, 'longitude': -3.0}]
+  # the sender is the oldest node, so it streams in last
+  rows.append({'id': SENDER_ID, 'timestamp': datetime.fromtimestamp(1600000000), 'latitude': 55.1, 'longitude': -3.1})
+  with storage.begin() as connection:
+    for start in range(0, count, INSERT_CHUNK):
+      for i in range(start, min(start + INSERT_CHUNK, count)):
+        rows.append({'id': 0x30000000 + i, 'timestamp': datetime.fromtimestamp(1650000000 + rng.uniform(0, 5e7)), 'latitude': rng.uniform(35, 70), 'longitude': rng.uniform(-10, 30)})
+      connection.execute(sqlalchemy.insert(NodeState), rows)
+      rows = []
+  storage.dispose()
+
+
+def legacy_load(path: str) -> float:
+  import sqlalchemy.orm
+  import meshmtx.storage
+  from meshmtx.geocoder import NodeGeocoder
+  from meshmtx.storage import NodeState
+
+  storage = meshmtx.storage.get_engine(path)
+  started = time.perf_counter()
+  geocoder = NodeGeocoder(capacity=0)
+  with sqlalchemy.orm.Session(storage) as session:
+    updates = []
+    for node in session.query(NodeState):
+      if node.latitude == None or node.longitude == None:
+        continue
+      updates.append((node.id, node.latitude, node.longitude, node.timestamp))
+    geocoder.maybe_update_nodes(updates)
+  elapsed = time.perf_counter() - started
+  storage.dispose()
+  return elapsed
+
+
+def run(path: str, mode: str, payload: bytes) -> dict:
+  started = time.time()
+  output = subprocess.run([sys.executable, __file__, '--child', path, mode, repr(started), payload.hex()], check=True, capture_output=True, text=True).stdout
+  return json.loads(output.splitlines()[-1])
+
+
+def main():
+  if sys.argv[1:2] == ['--child']:
+    child(sys.argv[2], sys.argv[3], float(sys.argv[4]), bytes.fromhex(sys.argv[5]))
+    return
+
+  import traffic
+  payload = traffic.envelope(SENDER_ID, 1, traffic.PORTNUMS.TEXT_MESSAGE_APP, b'hello')
+
+  sizes = [int(size) for size in sys.argv[1:]] or SIZES
+  print(f'{"nodes":>9} {"orm scan s":>11} {"imports s":>10} {"ready s":>8} {"first lazy s":>13} {"first blocking s":>17} {"loaded s":>9}')
+  with tempfile.TemporaryDirectory() as directory:
+    for count in sizes:
+      path = os.path.join(directory, f'state-{count}.db')
+      build_state(path, count)
+      legacy = legacy_load(path)
+      lazy = run(path, 'lazy', payload)
+      blocking = run(path, 'blocking', payload)
+      print(f'{count:>9} {legacy:>11.2f} {lazy["imports"]:>10.2f} {lazy["ready"]:>8.2f} {lazy["first"]:>13.2f} {blocking["first"]:>17.2f} {lazy["loaded"]:>9.2f}')
+
+
+if __name__ == '__main__':
+  main()
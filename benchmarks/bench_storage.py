@@ -0,0 +1,81 @@
+"""
+Compares position persistence throughput of a SELECT and COMMIT per packet against the write-behind PositionWriter.
+
+  python benchmarks/bench_storage.py
+"""
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy import create_engine
+
+import meshmtx.storage
+from meshmtx.storage import NodeState, PositionWriter
+
+POSITIONS = 5000
+NODES = 1000
+
+
+def make_positions():
+  rng = random.Random(1)
+  start = datetime(2024, 1, 1)
+  return [(rng.randrange(NODES), start + timedelta(seconds=i), rng.uniform(49, 59), rng.uniform(-8, 2)) for i in range(POSITIONS)]
+
+
+def legacy(path: str, positions) -> float:
+  # the original per-packet path, on a default (rollback journal, FULL sync) connection
+  engine = create_engine(f'sqlite:///{path}')
+  meshmtx.storage.Base.metadata.create_all(engine)
+  session = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(bind=engine))()
+
+  started = time.perf_counter()
+  for node_id, timestamp, latitude, longitude in positions:
+    record = session.scalar(sqlalchemy.select(NodeState).where(NodeState.id == node_id))
+    if record:
+      if timestamp > record.timestamp:
+        record.timestamp = timestamp
+        record.latitude = latitude
+        record.longitude = longitude
+        session.commit()
+    else:
+      record = NodeState(id=node_id, timestamp=timestamp, latitude=latitude, longitude=longitude)
+      session.add(record)
+      session.commit()
+  elapsed = time.perf_counter() - started
+  session.close()
+  return elapsed
+
+
+def write_behind(path: str, positions) -> float:
+  engine = meshmtx.storage.get_engine(path)
+  meshmtx.storage.Base.metadata.create_all(engine)
+  writer = PositionWriter(engine)
+  writer.start()
+
+  started = time.perf_counter()
+  for node_id, timestamp, latitude, longitude in positions:
+    writer.submit(node_id, timestamp, latitude, longitude)
+  writer.stop()
+  elapsed = time.perf_counter() - started
+
+  with engine.connect() as connection:
+    stored = connection.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(NodeState)).scalar()
+  assert stored == len({position[0] for position in positions})
+  return elapsed
+
+
+def main():
+  positions = make_positions()
+  with tempfile.TemporaryDirectory() as directory:
+    before = legacy(os.path.join(directory, 'legacy.db'), positions)
+    after = write_behind(os.path.join(directory, 'write_behind.db'), positions)
+  print(f'select + commit per packet: {POSITIONS / before:>10.0f} positions/s')
+  print(f'write-behind upserts:       {POSITIONS / after:>10.0f} positions/s')
+
+
+if __name__ == '__main__':
+  main()
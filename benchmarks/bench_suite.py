@@ -0,0 +1,49 @@
+"""
+Replays synthetic traffic mixes through the replay driver and reports throughput, per-message latency and allocation pressure.
+
+Each mix is captured to disk and read back, so the capture format is exercised too. Allocations are traced on a second, separate replay, as tracing distorts timings.
+
+  python benchmarks/bench_suite.py [mix ...]
+"""
+import os
+import sys
+import tempfile
+
+import meshmtx.storage
+from meshmtx.capture import CaptureWriter, read_capture
+from meshmtx.replay import ReplayDriver
+
+import traffic
+
+PACKETS = 5000
+
+
+def replay(config, path: str, directory: str, name: str, trace_allocations: bool):
+  storage = meshmtx.storage.get_engine(os.path.join(directory, f'{name}.db'))
+  meshmtx.storage.Base.metadata.create_all(storage)
+  driver = ReplayDriver(config, storage)
+  report = driver.replay(read_capture(path), trace_allocations=trace_allocations)
+  driver.close()
+  storage.dispose()
+  return report
+
+
+def main():
+  mixes = sys.argv[1:] or list(traffic.MIXES)
+  print(f'{"mix":>16} {"messages":>9} {"published":>10} {"msgs/s":>9} {"p50 us":>8} {"p99 us":>8} {"bytes/msg":>10} {"retained":>9}')
+  with tempfile.TemporaryDirectory() as directory:
+    for mix in mixes:
+      config, records = traffic.generate(mix, PACKETS)
+      path = os.path.join(directory, f'{mix}.bin')
+      writer = CaptureWriter(path)
+      for record in records:
+        writer.write(record.source, record.topic, record.payload, record.timestamp)
+      writer.close()
+
+      timed = replay(config, path, directory, f'{mix}-timed', False)
+      traced = replay(config, path, directory, f'{mix}-traced', True)
+      print(f'{mix:>16} {timed.messages:>9} {timed.published:>10} {timed.rate:>9.0f} {timed.percentile(50) * 1e6:>8.1f} {timed.percentile(99) * 1e6:>8.1f} {traced.transient_bytes:>10.0f} {traced.retained_blocks:>9}')
+
+
+if __name__ == '__main__':
+  main()
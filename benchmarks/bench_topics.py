@@ -0,0 +1,95 @@
+"""
+Compares the per-message cost of building the local topics a remote packet is forwarded to: the original split and join of the remote topic followed by one format per client, against the compiled topic router with hundreds of import rules.
+
+Also times geocoded region topics with state mappings against the plain `NodeEntry.get_most_precise_topic`, both computed and as cached on the node.
+
+  python benchmarks/bench_topics.py [rules ...]
+"""
+import random
+import sys
+import timeit
+
+from meshmtx.geocoder import NodeEntry, NodePrecision
+from meshmtx.gis import GeocodeResult
+from meshmtx.topics import TopicRouter
+
+RULES = (0, 10, 100, 500)
+ROUTES = 5
+TOPICS = 2000
+GATEWAYS = 500
+NUMBER = 20000
+REPEAT = 9
+
+
+def rules(count: int, rng: random.Random):
+  regions = [f'R{i}' for i in range(max(count // 5, 1))]
+  return [{'region': f'{rng.choice(regions)}/Sub{i % 3}' if i % 4 == 0 else rng.choice(regions), 'remote': f'Ch{i}', 'local': f'Local{i}'} for i in range(count)]
+
+
+def topics(count: int, imports, rng: random.Random):
+  # half of the topics fall under an import rule, when there are any
+  regions = [f'R{i}' for i in range(100)] + ['EU_868', 'US']
+  sample = []
+  for _ in range(count):
+    gateway = f'!{rng.randrange(GATEWAYS):08x}'
+    if imports and rng.random() < 0.5:
+      rule = rng.choice(imports)
+      sample.append(f'msh/{rule["region"]}/2/e/{rule["remote"]}/{gateway}')
+    else:
+      sample.append(f'msh/{rng.choice(regions)}/2/e/LongFast/{gateway}')
+  return sample
+
+
+def legacy(clients, topic: str):
+  topic_suffix = '/'.join(topic.split('/')[2:])
+  return [f'msh/router/{client}/{topic_suffix}' for client in clients]
+
+
+def compiled(router: TopicRouter, clients, topic: str):
+  prefix, gateway = router.resolve(topic)
+  bases = prefix.bases
+  return [(bases.get(client) or prefix.base(client)) + gateway for client in clients]
+
+
+def main():
+  counts = [int(count) for count in sys.argv[1:]] or RULES
+  rng = random.Random(1)
+  clients = [f'{0x10000000 + i:x}' for i in range(ROUTES)]
+
+  print(f'{ROUTES} routes per message, {TOPICS} distinct topics')
+  print(f'{"rules":>6} {"legacy us/msg":>14} {"compiled us/msg":>16} {"cold us/msg":>12} {"renamed":>8}')
+  for count in counts:
+    imports = rules(count, rng)
+    sample = topics(TOPICS, imports, rng)
+    router = TopicRouter(imports)
+    cold = timeit.timeit(lambda: [compiled(router, clients, topic) for topic in sample], number=1) / len(sample)
+    if count == 0:
+      assert all(compiled(router, clients, topic) == legacy(clients, topic) for topic in sample)
+    renamed = sum(compiled(router, clients, topic) != legacy(clients, topic) for topic in sample)
+
+    topic_cycle = sample * (NUMBER // len(sample))
+    # interleaved, so drift in machine speed hits both alike
+    legacy_times = []
+    compiled_times = []
+    for _ in range(REPEAT):
+      legacy_times.append(timeit.timeit(lambda: [legacy(clients, topic) for topic in topic_cycle], number=1))
+      compiled_times.append(timeit.timeit(lambda: [compiled(router, clients, topic) for topic in topic_cycle], number=1))
+    legacy_time = min(legacy_times) / len(topic_cycle)
+    compiled_time = min(compiled_times) / len(topic_cycle)
+    print(f'{count:>6} {legacy_time * 1e6:>14.2f} {compiled_time * 1e6:>16.2f} {cold * 1e6:>12.2f} {renamed:>8}')
+
+  entry = NodeEntry(1, 55.95, -3.19)
+  entry.gis = GeocodeResult(country_iso2='GB', state='Scotland', city='Edinburgh')
+  router = TopicRouter(mappings=[{'state': f'State{i}', 'value': f'S{i}'} for i in range(500)] + [{'state': 'Scotland', 'value': 'Scot', 'replace_full': True}])
+  plain = timeit.timeit(lambda: entry.get_most_precise_topic(NodePrecision.CITY), number=NUMBER) / NUMBER
+  def uncached():
+    entry.topic = None
+    return router.geo_topic(entry)
+  mapped = timeit.timeit(uncached, number=NUMBER) / NUMBER
+  cached = timeit.timeit(lambda: router.geo_topic(entry), number=NUMBER) / NUMBER
+  print()
+  print(f'geo topic: plain {plain * 1e6:.2f} us ({entry.get_most_precise_topic(NodePrecision.CITY)}), mapped {mapped * 1e6:.2f} us, cached {cached * 1e6:.2f} us ({router.geo_topic(entry)})')
+
+
+if __name__ == '__main__':
+  main()
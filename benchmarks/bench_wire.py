@@ -0,0 +1,104 @@
+"""
+Verifies both envelope header scanners against full protobuf parsing, and compares their speed.
+
+Synthetic envelopes covering every MeshPacket field are always checked. Real captures can be added by passing files holding one raw envelope each:
+
+  python benchmarks/bench_wire.py [capture.bin ...]
+"""
+import random
+import sys
+import time
+
+import meshtastic
+import meshtastic.protobuf
+
+from meshmtx.wire import NATIVE_PROTOBUF, scan_envelope_native, scan_envelope_wire
+
+SYNTHETIC = 20000
+
+
+def random_envelope(rng: random.Random) -> bytes:
+  packet = meshtastic.mesh_pb2.MeshPacket()
+  setattr(packet, 'from', rng.getrandbits(32))
+  packet.to = rng.choice([0xffffffff, rng.getrandbits(32)])
+  packet.id = rng.getrandbits(32)
+  packet.channel = rng.randrange(256)
+  packet.hop_limit = rng.randrange(8)
+  packet.hop_start = rng.randrange(8)
+  packet.want_ack = rng.random() < 0.5
+  packet.via_mqtt = rng.random() < 0.5
+  packet.rx_time = rng.getrandbits(32)
+  packet.rx_snr = rng.uniform(-20, 10)
+  packet.rx_rssi = rng.randrange(-130, 0)
+  packet.priority = rng.choice([0, 10, 64, 70, 120])
+  if rng.random() < 0.3:
+    packet.relay_node = rng.randrange(256)
+    packet.next_hop = rng.randrange(256)
+    packet.public_key = rng.randbytes(32)
+  if rng.random() < 0.8:
+    packet.encrypted = rng.randbytes(rng.randrange(0, 200))
+  else:
+    packet.decoded.portnum = rng.choice([1, 3, 4, 67])
+    packet.decoded.payload = rng.randbytes(rng.randrange(0, 100))
+  envelope = meshtastic.mqtt_pb2.ServiceEnvelope(packet=packet, channel_id=rng.choice(['LongFast', 'MediumFast', 'Telemetry', '']), gateway_id=f'!{rng.getrandbits(32):08x}')
+  return envelope.SerializeToString()
+
+
+def check(payload: bytes, scan_envelope) -> bool:
+  envelope = meshtastic.mqtt_pb2.ServiceEnvelope()
+  try:
+    envelope.ParseFromString(payload)
+  except Exception:
+    return scan_envelope(payload) is None
+
+  header = scan_envelope(payload)
+  if header is None:
+    return False
+  packet = envelope.packet
+  expected = {
+    'channel_id': envelope.channel_id, 'gateway_id': envelope.gateway_id,
+    'sender': getattr(packet, 'from'), 'to': packet.to, 'id': packet.id, 'channel': packet.channel,
+    'hop_limit': packet.hop_limit, 'hop_start': packet.hop_start, 'want_ack': packet.want_ack, 'via_mqtt': packet.via_mqtt, 'rx_time': packet.rx_time,
+    'encrypted': packet.encrypted if packet.HasField('encrypted') else None,
+    'decoded': packet.decoded.SerializeToString() if packet.HasField('decoded') else None,
+  }
+  return all(getattr(header, key) == value for key, value in expected.items())
+
+
+def main():
+  rng = random.Random(1)
+  payloads = [random_envelope(rng) for _ in range(SYNTHETIC)]
+  captured = []
+  for path in sys.argv[1:]:
+    with open(path, 'rb') as f:
+      captured.append(f.read())
+
+  # truncated copies exercise the malformed input paths
+  payloads_truncated = [payload[:rng.randrange(len(payload))] for payload in payloads[:2000]]
+
+  for name, corpus in (('synthetic', payloads), ('truncated', payloads_truncated), ('captured', captured)):
+    if not corpus:
+      continue
+    for scanner in (scan_envelope_wire, scan_envelope_native):
+      mismatches = sum(1 for payload in corpus if not check(payload, scanner))
+      print(f'{name}, {scanner.__name__}: {len(corpus)} envelopes, {mismatches} mismatches')
+
+  started = time.perf_counter()
+  for payload in payloads:
+    envelope = meshtastic.mqtt_pb2.ServiceEnvelope()
+    envelope.ParseFromString(payload)
+    envelope.channel_id, getattr(envelope.packet, 'from'), envelope.packet.id
+  parsed = time.perf_counter() - started
+
+  print(f'protobuf runtime is {"native" if NATIVE_PROTOBUF else "pure python"}')
+  print(f'{"full parse":<20} {parsed / len(payloads) * 1e6:.2f} us/envelope')
+  for scanner in (scan_envelope_wire, scan_envelope_native):
+    started = time.perf_counter()
+    for payload in payloads:
+      scanner(payload)
+    scanned = time.perf_counter() - started
+    print(f'{scanner.__name__:<20} {scanned / len(payloads) * 1e6:.2f} us/envelope')
+
+
+if __name__ == '__main__':
+  main()
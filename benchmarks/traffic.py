@@ -0,0 +1,132 @@
+"""
+Generates synthetic captures for the replay driver, in a few traffic mixes.
+
+  python benchmarks/traffic.py position-heavy capture.bin config.yaml
+"""
+import random
+import sys
+import typing
+
+import meshtastic
+import meshtastic.protobuf
+import yaml
+
+from meshmtx.capture import CaptureRecord, CaptureWriter
+from meshmtx.crypto import ChannelKey, decode_psk
+from meshmtx.utils import PacketUtilities
+
+CLIENT_BASE = 0x10000000
+SENDER_BASE = 0x20000000
+GATEWAY_BASE = 0x30000000
+START = 1700000000.0
+
+PORTNUMS = meshtastic.portnums_pb2
+
+# name: (clients, remote senders, portnum weights, gateways uplinking each packet, share of packets from local clients)
+MIXES: typing.Dict[str, typing.Tuple[int, int, typing.Dict[int, float], typing.Tuple[int, int], float]] = {
+  'position-heavy': (20, 2000, {PORTNUMS.POSITION_APP: 0.7, PORTNUMS.TEXT_MESSAGE_APP: 0.1, PORTNUMS.NODEINFO_APP: 0.1, PORTNUMS.TELEMETRY_APP: 0.1}, (1, 1), 0.1),
+  'text-heavy': (20, 500, {PORTNUMS.POSITION_APP: 0.1, PORTNUMS.TEXT_MESSAGE_APP: 0.8, PORTNUMS.NODEINFO_APP: 0.1}, (1, 1), 0.1),
+  'duplicate-heavy': (20, 500, {PORTNUMS.POSITION_APP: 0.3, PORTNUMS.TEXT_MESSAGE_APP: 0.3, PORTNUMS.TELEMETRY_APP: 0.4}, (3, 6), 0.1),
+  'many-clients': (500, 2000, {PORTNUMS.POSITION_APP: 0.4, PORTNUMS.TEXT_MESSAGE_APP: 0.3, PORTNUMS.TELEMETRY_APP: 0.3}, (1, 2), 0.05),
+}
+
+_keys = {name: ChannelKey(name, decode_psk('AQ==')) for name in ('LongFast', 'Telemetry')}
+
+
+def envelope(sender: int, packet_id: int, portnum: int, payload: bytes, channel: str = 'LongFast', gateway: typing.Optional[int] = None) -> bytes:
+  key = _keys[channel]
+  packet = meshtastic.mesh_pb2.MeshPacket()
+  setattr(packet, 'from', sender)
+  packet.id = packet_id
+  packet.to = 0xffffffff
+  packet.channel = key.hash
+  packet.hop_limit = 3
+  data = meshtastic.mesh_pb2.Data(portnum=portnum, payload=payload)
+  packet.encrypted = key.crypt(sender, packet_id, data.SerializeToString())
+  gateway_id = PacketUtilities.user_to_node_id(gateway if gateway is not None else sender)
+  return meshtastic.mqtt_pb2.ServiceEnvelope(packet=packet, channel_id=channel, gateway_id=f'!{gateway_id}').SerializeToString()
+
+
+def position(latitude: float, longitude: float, timestamp: float) -> bytes:
+  return meshtastic.mesh_pb2.Position(latitude_i=int(latitude * 1e7), longitude_i=int(longitude * 1e7), time=int(timestamp)).SerializeToString()
+
+
+def payload_for(portnum: int, rng: random.Random, latitude: float, longitude: float, timestamp: float) -> bytes:
+  if portnum == PORTNUMS.POSITION_APP:
+    return position(latitude + rng.uniform(-0.01, 0.01), longitude + rng.uniform(-0.01, 0.01), timestamp)
+  if portnum == PORTNUMS.TEXT_MESSAGE_APP:
+    return bytes(rng.choice(b'abcdefghijklmnopqrstuvwxyz ') for _ in range(rng.randint(5, 120)))
+  return rng.randbytes(rng.randint(20, 60))
+
+
+def generate(mix: str, count: int = 20000, seed: int = 1) -> typing.Tuple[dict, typing.List[CaptureRecord]]:
+  """
+  Returns a config and the records of a capture. The capture starts with a position from every client and remote sender, so routes exist, followed by `count` packets of the mix.
+  """
+  client_count, sender_count, weights, gateways, local_share = MIXES[mix]
+  rng = random.Random(seed)
+  portnums = list(weights)
+  portnum_weights = list(weights.values())
+
+  clients = [(CLIENT_BASE + i, 55.0 + rng.uniform(-3, 3), -3.0 + rng.uniform(-3, 3)) for i in range(client_count)]
+  senders = [(SENDER_BASE + i, 55.0 + rng.uniform(-4, 4), -3.0 + rng.uniform(-4, 4)) for i in range(sender_count)]
+  config = {
+    'clients': [{'id': PacketUtilities.user_to_node_id(id), 'max_distance': 80000} for id, _, _ in clients],
+    'telemetry': {'id': 'Telemetry', 'key': 'AQ=='},
+    'channels': [{'name': 'LongFast', 'key': 'AQ=='}],
+    'imports': [],
+    'mqtt': {'local': {}, 'remote': {}},
+    'geocoder': {'cache': {'enabled': False}},
+  }
+
+  records = []
+  timestamp = START
+  packet_id = 1
+
+  def local(id: int, portnum: int, payload: bytes, channel: str = 'LongFast'):
+    user_id = PacketUtilities.user_to_node_id(id)
+    records.append(CaptureRecord(timestamp, 'local', f'msh/router/{user_id}/2/e/{channel}/!{user_id}', envelope(id, packet_id, portnum, payload, channel)))
+
+  def remote(id: int, portnum: int, payload: bytes, gateway: int):
+    gateway_id = PacketUtilities.user_to_node_id(gateway)
+    records.append(CaptureRecord(timestamp, 'remote', f'msh/EU_868/2/e/LongFast/!{gateway_id}', envelope(id, packet_id, portnum, payload, gateway=gateway)))
+
+  for id, latitude, longitude in clients:
+    local(id, PORTNUMS.POSITION_APP, position(latitude, longitude, timestamp), 'Telemetry')
+    packet_id += 1
+  for id, latitude, longitude in senders:
+    remote(id, PORTNUMS.POSITION_APP, position(latitude, longitude, timestamp), GATEWAY_BASE)
+    packet_id += 1
+
+  for _ in range(count):
+    timestamp += rng.expovariate(50.0)
+    portnum = rng.choices(portnums, portnum_weights)[0]
+    if rng.random() < local_share:
+      id, latitude, longitude = rng.choice(clients)
+      local(id, portnum, payload_for(portnum, rng, latitude, longitude, timestamp))
+    else:
+      id, latitude, longitude = rng.choice(senders)
+      payload = payload_for(portnum, rng, latitude, longitude, timestamp)
+      for gateway in rng.sample(range(GATEWAY_BASE, GATEWAY_BASE + 16), rng.randint(*gateways)):
+        remote(id, portnum, payload, gateway)
+    packet_id += 1
+
+  return config, records
+
+
+def main():
+  if len(sys.argv) != 4 or sys.argv[1] not in MIXES:
+    print(f'usage: traffic.py {{{",".join(MIXES)}}} capture.bin config.yaml')
+    sys.exit(1)
+
+  config, records = generate(sys.argv[1])
+  writer = CaptureWriter(sys.argv[2])
+  for record in records:
+    writer.write(record.source, record.topic, record.payload, record.timestamp)
+  writer.close()
+  with open(sys.argv[3], 'w') as f:
+    yaml.dump(config, f)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,288 @@
+import asyncio
+import concurrent.futures
+import logging
+import signal
+import threading
+import time
+import typing
+
+import paho.mqtt.client as mqtt
+import sqlalchemy.engine
+
+from meshmtx.capture import CaptureWriter
+from meshmtx.config import Config
+from meshmtx.metrics import Metrics, NULL_METRICS
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.mqtt.base import MQTTThreadBase
+from meshmtx.pipeline import DEFAULT_QUEUE_SIZE
+
+logger = logging.getLogger('meshmtx:aio')
+
+# seconds between paho housekeeping calls (keepalive pings, timeouts)
+MISC_INTERVAL = 1.0
+RECONNECT_MIN_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+
+# a thread hop costs more than decrypting a typical packet, see benchmarks/bench_engine.py
+DEFAULT_EXECUTOR_WORKERS = 0
+
+
+class AsyncConnection:
+  """
+  Drives a paho client from the event loop through its socket callbacks, in place of paho's own network thread.
+  """
+  handler: MQTTThreadBase
+  client: typing.Optional[mqtt.Client]
+  _engine: 'AsyncEngine'
+  _loop: asyncio.AbstractEventLoop
+  _loop_thread: int
+  _task: typing.Optional[asyncio.Task]
+  _closing: bool
+
+  def __init__(self, engine: 'AsyncEngine', handler: MQTTThreadBase):
+    self.handler = handler
+    self.client = None
+    self._engine = engine
+    self._task = None
+    self._closing = False
+
+  def on_message(self, client, userdata, msg):
+    self._engine.submit(self.handler, msg.topic, msg.payload)
+
+  def attach(self, client):
+    """
+    Uses an already connected client, e.g. a loopback client.
+    """
+    self.client = client
+    client.on_message = self.on_message
+    self.handler.attach_client(client)
+
+  def open(self):
+    self._loop = asyncio.get_running_loop()
+    self._loop_thread = threading.get_ident()
+
+    client = self.handler.create_client()
+    client.on_message = self.on_message
+    client.on_socket_open = self._on_socket_open
+    client.on_socket_close = self._on_socket_close
+    client.on_socket_register_write = self._on_socket_register_write
+    client.on_socket_unregister_write = self._on_socket_unregister_write
+    self.client = client
+    self.handler.use_client(client)
+    self._task = self._loop.create_task(self._run(), name=f'aio:mqtt:{self.handler.key}')
+
+  async def close(self):
+    self._closing = True
+    if self.client is None:
+      return
+    self.client.disconnect()
+    if self._task:
+      self._task.cancel()
+      await asyncio.gather(self._task, return_exceptions=True)
+      # flush the DISCONNECT packet if the socket is still open
+      self.client.loop_write()
+
+  async def _run(self):
+    host, port = self.handler.address
+    delay = RECONNECT_MIN_DELAY
+    connected = False
+    while not self._closing:
+      if not connected:
+        try:
+          # name resolution and the TCP handshake block, so keep them off the loop
+          await self._loop.run_in_executor(None, self.client.connect, host, port)
+          connected = True
+          delay = RECONNECT_MIN_DELAY
+        except (OSError, TimeoutError):
+          self.handler.on_connect_fail(self.client, None)
+          await asyncio.sleep(delay)
+          delay = min(delay * 2, RECONNECT_MAX_DELAY)
+          continue
+
+      await asyncio.sleep(MISC_INTERVAL)
+      if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+        connected = False
+
+  def _on_loop(self, callback, *args):
+    if threading.get_ident() == self._loop_thread:
+      callback(*args)
+    else:
+      self._loop.call_soon_threadsafe(callback, *args)
+
+  def _on_socket_open(self, client, userdata, sock):
+    self._on_loop(self._loop.add_reader, sock, client.loop_read)
+
+  def _on_socket_close(self, client, userdata, sock):
+    self._on_loop(self._loop.remove_reader, sock)
+    self._on_loop(self._loop.remove_writer, sock)
+
+  def _on_socket_register_write(self, client, userdata, sock):
+    self._on_loop(self._loop.add_writer, sock, client.loop_write)
+
+  def _on_socket_unregister_write(self, client, userdata, sock):
+    self._on_loop(self._loop.remove_writer, sock)
+
+
+class AsyncEngine:
+  """
+  Runs every broker connection, message routing and position flushes on one asyncio event loop, as an alternative to the thread per broker model of `Multiplexer.run`.
+
+  With `pipeline.executor_workers` above zero, decoding (parsing, deduplication and decryption) is offloaded to a thread pool of that size and routing continues on the loop. With zero workers everything runs on the loop. Apart from the startup node load, the loop is the only thread touching the routing table, the node table and the MQTT clients.
+  """
+  multiplexer: Multiplexer
+  connections: typing.List[AsyncConnection]
+  _workers: int
+  _queue_size: int
+  _queue: typing.Optional[asyncio.Queue]
+  _executor: typing.Optional[concurrent.futures.ThreadPoolExecutor]
+  _tasks: typing.List[asyncio.Task]
+  _stopping: typing.Optional[asyncio.Event]
+  _loop: typing.Optional[asyncio.AbstractEventLoop]
+  _loader: typing.Optional[typing.Callable[[], Config]]
+
+  dropped: int = 0
+
+  def __init__(self, config: Config, storage: sqlalchemy.engine.Engine, capture: typing.Optional[CaptureWriter] = None, metrics: Metrics = NULL_METRICS, loader: typing.Optional[typing.Callable[[], Config]] = None):
+    pipeline_config = config.get('pipeline', {})
+    self._workers = pipeline_config.get('executor_workers', DEFAULT_EXECUTOR_WORKERS)
+    self._queue_size = pipeline_config.get('ingest_queue_size', DEFAULT_QUEUE_SIZE)
+
+    # the loop takes the place of the pipeline threads, publishes go straight to the client
+    config = {**config, 'pipeline': {**pipeline_config, 'workers': 0}}
+    self.multiplexer = Multiplexer(config, storage, capture, metrics)
+    self.connections = []
+    self._queue = None
+    self._executor = None
+    self._tasks = []
+    self._stopping = None
+    self._loop = None
+    self._loader = loader
+
+  def run(self):
+    asyncio.run(self.main())
+
+  async def main(self):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+      loop.add_signal_handler(sig, self.stop)
+    if self._loader:
+      loop.add_signal_handler(signal.SIGHUP, self.reload)
+
+    await self.start()
+    await self._stopping.wait()
+    await self.shutdown()
+
+  async def start(self, connect: bool = True):
+    """
+    Prepares the multiplexer and starts the background tasks. Without `connect`, connections are attached by the caller (see `AsyncConnection.attach`).
+    """
+    self._loop = asyncio.get_running_loop()
+    self._stopping = asyncio.Event()
+    self.multiplexer.prepare()
+    self.connections = [AsyncConnection(self, handler) for handler in (self.multiplexer.local, *self.multiplexer.remotes)]
+
+    if self._workers > 0:
+      self._queue = asyncio.Queue()
+      self._executor = concurrent.futures.ThreadPoolExecutor(self._workers, thread_name_prefix='aio:decode')
+      # enough consumers to keep every executor thread busy while others route
+      for i in range(self._workers * 2):
+        self._tasks.append(self._loop.create_task(self._work(), name=f'aio:worker:{i}'))
+    self._tasks.append(self._loop.create_task(self._flush_positions(), name='aio:positions'))
+    if self.multiplexer.spool:
+      # disk reads and rate limited sends, kept on their own thread
+      self.multiplexer.spool.start()
+
+    if connect:
+      for connection in self.connections:
+        connection.open()
+
+  def reload(self):
+    """
+    Reads the config again and applies it, see `Multiplexer.reload`. Runs on the loop, which owns the routing table.
+    """
+    try:
+      config = self._loader()
+    except Exception as e:
+      logger.error(f'failed to read the config, keeping the running one: {e}')
+      return
+    # the loop never runs pipeline threads, as in __init__
+    self.multiplexer.reload({**config, 'pipeline': {**config.get('pipeline', {}), 'workers': 0}})
+
+  def stop(self):
+    """
+    Requests a shutdown. Safe to call from any thread.
+    """
+    if self._loop and self._stopping:
+      self._loop.call_soon_threadsafe(self._stopping.set)
+
+  async def idle(self):
+    """
+    Waits until every queued message has been handled.
+    """
+    if self._queue is not None:
+      await self._queue.join()
+
+  async def shutdown(self):
+    """
+    Stops receiving, finishes the queued messages, then flushes positions and the capture.
+    """
+    for connection in self.connections:
+      await connection.close()
+    await self.idle()
+
+    for task in self._tasks:
+      task.cancel()
+    await asyncio.gather(*self._tasks, return_exceptions=True)
+    self._tasks = []
+
+    if self._executor:
+      self._executor.shutdown(wait=True)
+    if self.multiplexer.spool:
+      await self._loop.run_in_executor(None, self.multiplexer.spool.stop)
+    await self._loop.run_in_executor(None, self.multiplexer.positions.flush)
+    if self.multiplexer.capture:
+      self.multiplexer.capture.close()
+
+  def submit(self, handler: MQTTThreadBase, topic: str, payload: bytes):
+    if self.multiplexer.capture:
+      self.multiplexer.capture.write(handler.key, topic, payload)
+
+    received = time.time()
+    if self._queue is None:
+      handler.handle_message(topic, payload, received)
+      return
+
+    # shed the oldest message rather than growing without bound when decoding falls behind
+    if self._queue.qsize() >= self._queue_size:
+      self._queue.get_nowait()
+      self._queue.task_done()
+      self.dropped += 1
+    self._queue.put_nowait((handler, topic, payload, received))
+
+  async def _work(self):
+    metrics = self.multiplexer.metrics
+    while True:
+      handler, topic, payload, received = await self._queue.get()
+      try:
+        lap = metrics.lap()
+        if lap:
+          handler.observe_queue_wait(received)
+        decoded = await self._loop.run_in_executor(self._executor, handler.decode_message, payload, lap)
+        if decoded is not None:
+          handler.mark_stage(lap, 'queue')
+          handler.route_message(topic, payload, decoded[0], decoded[1], received, lap)
+      except Exception as e:
+        logger.exception(f'failed to process message on {topic}: {e}')
+      finally:
+        self._queue.task_done()
+
+  async def _flush_positions(self):
+    positions = self.multiplexer.positions
+    interval = positions.flush_interval
+    last = time.monotonic()
+    while True:
+      await asyncio.sleep(min(interval, MISC_INTERVAL))
+      if positions.pending >= positions.flush_size or time.monotonic() - last >= interval:
+        last = time.monotonic()
+        # the sqlite write blocks, run it next to the loop
+        await self._loop.run_in_executor(None, positions.flush)
@@ -0,0 +1,79 @@
+import logging
+import os
+import struct
+import threading
+import time
+import typing
+
+logger = logging.getLogger('meshmtx:capture')
+
+MAGIC = b'MMTXCAP1'
+
+# timestamp, source length, topic length, payload length
+_record = struct.Struct('<dBHI')
+
+
+class CaptureRecord(typing.NamedTuple):
+  timestamp: float
+  source: str # broker key, i.e. local or the name of a remote broker
+  topic: str
+  payload: bytes
+
+
+class CaptureWriter:
+  """
+  Appends received MQTT messages to a compact binary log, for offline replay with `meshmtx.replay`.
+
+  The file is a magic header followed by records of (timestamp, source, topic, payload), each prefixed by their lengths.
+  """
+  _file: typing.BinaryIO
+  _lock: threading.Lock
+
+  records: int = 0
+
+  def __init__(self, path: str):
+    new = not os.path.exists(path) or os.path.getsize(path) == 0
+    self._file = open(path, 'ab')
+    self._lock = threading.Lock()
+    if new:
+      self._file.write(MAGIC)
+    logger.info(f'capturing received messages to {path}')
+
+  def write(self, source: str, topic: str, payload: bytes, timestamp: typing.Optional[float] = None):
+    if timestamp is None:
+      timestamp = time.time()
+    source_bytes = source.encode('utf-8')
+    topic_bytes = topic.encode('utf-8')
+    with self._lock:
+      self._file.write(_record.pack(timestamp, len(source_bytes), len(topic_bytes), len(payload)))
+      self._file.write(source_bytes)
+      self._file.write(topic_bytes)
+      self._file.write(payload)
+      self.records += 1
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+
+def read_capture(path: str) -> typing.Iterator[CaptureRecord]:
+  """
+  Iterates the records of a capture file. A truncated final record, e.g. from an unclean shutdown, is ignored.
+  """
+  with open(path, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError(f'{path} is not a capture file')
+    while True:
+      head = f.read(_record.size)
+      if len(head) < _record.size:
+        return
+      timestamp, source_length, topic_length, payload_length = _record.unpack(head)
+      body = f.read(source_length + topic_length + payload_length)
+      if len(body) < source_length + topic_length + payload_length:
+        return
+      yield CaptureRecord(
+        timestamp,
+        body[:source_length].decode('utf-8'),
+        body[source_length:source_length + topic_length].decode('utf-8'),
+        body[source_length + topic_length:],
+      )
@@ -3,11 +3,34 @@ import yaml
 import logging
 import os
 import signal
+import threading
 
+from meshmtx.capture import CaptureWriter
 from meshmtx.config import Config
+from meshmtx.metrics import Metrics, MetricsServer, SamplingProfiler, NULL_METRICS
 from meshmtx.multiplexer import Multiplexer
 import meshmtx.storage
 
+logger = logging.getLogger('meshmtx:cli')
+
+
+def load_config(path: str) -> Config:
+  with open(path, 'r') as f:
+    return yaml.load(f, yaml.SafeLoader)
+
+
+def reload_config(path: str, multiplexer: Multiplexer):
+  try:
+    config = load_config(path)
+  except Exception as e:
+    logger.error(f'failed to read {path}, keeping the running config: {e}')
+    return
+  try:
+    multiplexer.reload(config)
+  except Exception as e:
+    logger.exception(f'failed to reload {path}: {e}')
+
+
 def main():
   parser = argparse.ArgumentParser(
     prog='meshtastic-multiplexer',
@@ -16,16 +39,22 @@ def main():
     (c) 2024 Alex XZ Cypher Zero
 
     Tool to forward messages between local and remote MQTT queues based on a mesh radio location.
+
+    Send SIGHUP to reload the clients, channel keys, remote subscriptions, imports and mappings from the config file without reconnecting.
     '''
   )
 
   parser.add_argument('-c', '--config', type=str, default='config.yaml', help='The config file to use')
   parser.add_argument('-s', '--state', type=str, default='state.db', help='Path to the state database')
+  parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads', help='Run each broker on its own thread, or everything on one asyncio event loop')
+  parser.add_argument('--capture', type=str, default=None, help='Record all received messages to this file, for replay with meshmtx.replay')
+  parser.add_argument('--metrics-port', type=int, default=None, help='Serve Prometheus metrics on this port')
+  parser.add_argument('--metrics-host', type=str, default='127.0.0.1', help='Address to serve metrics on')
+  parser.add_argument('--profile', type=float, nargs='?', const=0.01, default=None, metavar='INTERVAL', help='Sample thread stacks every INTERVAL seconds, served on /profile next to the metrics')
   parser.add_argument('-v', '--verbose', action='store_true', default=bool(os.getenv('VERBOSE')), help='Enable debug output')
   args = parser.parse_args()
 
-  with open(args.config, 'r') as f:
-    config: Config = yaml.load(f, yaml.SafeLoader)
+  config = load_config(args.config)
   
   log_level = logging.DEBUG if args.verbose else logging.INFO
   logging.basicConfig(level=log_level)
@@ -33,10 +62,29 @@ def main():
   storage = meshmtx.storage.get_engine(path=args.state)
   meshmtx.storage.Base.metadata.create_all(storage)
 
-  multiplexer = Multiplexer(config, storage)
+  capture = CaptureWriter(args.capture) if args.capture else None
+
+  metrics = NULL_METRICS
+  if args.metrics_port is not None:
+    metrics = Metrics()
+    profiler = None
+    if args.profile:
+      profiler = SamplingProfiler(args.profile)
+      profiler.start()
+    MetricsServer(metrics, args.metrics_port, args.metrics_host, profiler).start()
+
+  if args.engine == 'asyncio':
+    # the engine installs its own signal handlers on the event loop
+    from meshmtx.aio import AsyncEngine
+    AsyncEngine(config, storage, capture, metrics, lambda: load_config(args.config)).run()
+    return
+
+  multiplexer = Multiplexer(config, storage, capture, metrics)
 
   signal.signal(signal.SIGINT, lambda sig, _frame: multiplexer.stop())
   signal.signal(signal.SIGTERM, lambda sig, _frame: multiplexer.stop())
+  # the reload runs next to the running threads rather than inside the signal handler
+  signal.signal(signal.SIGHUP, lambda sig, _frame: threading.Thread(target=reload_config, args=(args.config, multiplexer), name='config:reload', daemon=True).start())
 
   multiplexer.run()
 
@@ -1,9 +1,21 @@
 import typing
 
 
+class ConfigClientFilter(typing.TypedDict):
+  portnums: typing.List[str] # portnum names forwarded, e.g. TEXT_MESSAGE_APP, all if unset
+  channels: typing.List[str] # channel names forwarded, as named in the envelope, all if unset
+  min_hop_limit: int # hops a packet has left, 0 to 7
+  max_hop_limit: int
+  senders: typing.List[str] # only packets from these node ids, all if unset
+  deny: typing.List[str] # never packets from these node ids
+
+
 class ConfigClient(typing.TypedDict):
   id: str
   max_distance: int
+  filter: ConfigClientFilter # what is forwarded to the client, everything if unset
+  spool_max_bytes: int # overrides spool.max_bytes for this client
+  spool_ttl: float # overrides spool.ttl for this client
 
 
 class ConfigTelemetry(typing.TypedDict):
@@ -11,27 +23,140 @@ class ConfigTelemetry(typing.TypedDict):
   key: str
 
 
+class ConfigChannel(typing.TypedDict):
+  name: str
+  key: str # base64 PSK, as shown in the Meshtastic apps
+
+
 class ConfigQueueImport(typing.TypedDict):
   region: str
   remote: str
   local: str
 
 
+class ConfigMapping(typing.TypedDict):
+  state: str # geocoded state name
+  value: str # short region name used in its place
+  replace_full: bool # the region name replaces the whole topic, not just the state segment
+
+
 class ConfigMQTT(typing.TypedDict):
+  name: str # remote brokers only, labels their stats and captures, see meshmtx.mqtt.remote.remote_brokers
   address: str
   port: int
   username: str
   password: str
   subscriptions: typing.List[str]
+  protocol: int # 3 (3.1.1, default) or 5
 
 
 class ConfigMQTTDict(typing.TypedDict):
   local: ConfigMQTT
-  remote: ConfigMQTT
+  remote: typing.Union[ConfigMQTT, typing.List[ConfigMQTT]] # one broker, or a list of them feeding the same nodes and routes
+
+
+class ConfigGeocoderBackend(typing.TypedDict):
+  type: str # arcgis, offline
+  path: str # packed boundary file, for the offline backend
+
+
+class ConfigGeocoderCache(typing.TypedDict):
+  enabled: bool
+  precision: int # decimal places of the quantized latitude/longitude cell
+  capacity: int # cells kept in memory
+
+
+class ConfigGeocoder(typing.TypedDict):
+  backends: typing.List[ConfigGeocoderBackend]
+  cache: ConfigGeocoderCache
+
+
+class ConfigNodes(typing.TypedDict):
+  capacity: int # nodes kept in memory, 0 for no limit
+  ttl: float # seconds since a node was last heard before it is evicted, 0 never expires
+
+
+class ConfigRouting(typing.TypedDict):
+  mode: str # clients (a copy per client in range of the sender) or geo (one copy under msh/geo/<region> of the sender)
+  precision: str # country, state or city, the most precise region topic used in geo mode
+
+
+class ConfigStorage(typing.TypedDict):
+  flush_size: int # pending node positions that trigger a write
+  flush_interval: float # seconds between writes
+  max_pending: int # node positions held while writes fail, further nodes are dropped
+
+
+class ConfigPipeline(typing.TypedDict):
+  workers: int # 0 processes messages inline on the MQTT threads
+  executor_workers: int # asyncio engine only, threads decoding off the event loop, 0 decodes on the loop
+  ingest_queue_size: int # split evenly between the workers
+  drop_policy: str # oldest, newest, portnum; portnum only applies to the output queues, at ingest it sheds the oldest
+  priorities: typing.Dict[str, int] # portnum name -> priority, higher is kept longer
+
+
+class ConfigOutput(typing.TypedDict):
+  queue_size: int # messages queued per client
+  drop_policy: str # oldest, newest, portnum, defaults to pipeline.drop_policy
+  quantum: int # payload bytes a client may publish per round before the next client's turn
+  batch_size: int # messages published per hold of the local client
+  qos: int # QoS of local publishes
+  max_inflight: int # QoS 1 and 2 publishes awaiting acknowledgement before paho holds the rest back
+
+
+class ConfigDedup(typing.TypedDict):
+  capacity: int # packets remembered per side
+  window: float # seconds a packet is remembered for
+
+
+class ConfigRateLimitBucket(typing.TypedDict):
+  rate: float # messages per second, 0 disables the bucket
+  burst: float # messages let through at once after a quiet spell
+
+
+class ConfigRateLimit(typing.TypedDict):
+  enabled: bool
+  sender: ConfigRateLimitBucket # per remote sender node
+  client: ConfigRateLimitBucket # per client messages are forwarded to
+  reserve: float # share of each bucket priority 0 portnums leave to the highest priority ones
+  priorities: typing.Dict[str, int] # portnum name -> priority, defaults to pipeline.priorities
+  sweep_interval: float # seconds between freeing buckets that have refilled
+
+
+class ConfigFreshness(typing.TypedDict):
+  enabled: bool
+  interval: float # seconds after a node's last stored position within which its positions are redundant unless it moved
+  distance: float # metres a node has to move for a position within the interval to be stored
+
+
+class ConfigSpool(typing.TypedDict):
+  path: str # directory for messages held while the local broker is unreachable, unset disables spooling
+  segment_size: int # bytes per segment file
+  max_bytes: int # bytes on disk per client, the oldest messages are dropped beyond this
+  ttl: float # seconds a spooled message is kept
+  drain_rate: float # messages per second of catch-up once the local broker is back, later messages are not paced, 0 for no limit
+
+
+class ConfigSharding(typing.TypedDict):
+  processes: int # 0 decrypts remote traffic on the remote MQTT thread
+  batch_size: int # messages per batch to and from a shard
 
 
 class Config(typing.TypedDict):
   clients: typing.List[ConfigClient]
   telemetry: ConfigTelemetry
+  channels: typing.List[ConfigChannel]
   imports: typing.List[ConfigQueueImport]
+  mappings: typing.List[ConfigMapping]
   mqtt: ConfigMQTTDict
+  geocoder: ConfigGeocoder
+  nodes: ConfigNodes
+  routing: ConfigRouting
+  storage: ConfigStorage
+  pipeline: ConfigPipeline
+  output: ConfigOutput
+  dedup: ConfigDedup
+  ratelimit: ConfigRateLimit
+  freshness: ConfigFreshness
+  sharding: ConfigSharding
+  spool: ConfigSpool
@@ -0,0 +1,160 @@
+import base64
+import logging
+import struct
+import typing
+
+import cryptography.hazmat.primitives.ciphers
+import cryptography.hazmat.primitives.ciphers.algorithms
+import cryptography.hazmat.primitives.ciphers.modes
+import meshtastic
+import meshtastic.protobuf
+
+from meshmtx.config import ConfigChannel
+
+logger = logging.getLogger('meshmtx:crypto')
+
+# the well-known key behind the single byte PSK "AQ=="
+DEFAULT_KEY_BYTES = base64.b64decode('1PG7OiApB1nwvP+rz05pAQ==')
+# the modem preset channel names, which nodes on the default key use as their channel name
+PRESET_CHANNELS = ('LongFast', 'LongSlow', 'LongModerate', 'LongTurbo', 'VeryLongSlow', 'MediumFast', 'MediumSlow', 'ShortFast', 'ShortSlow', 'ShortTurbo')
+DEFAULT_CHANNELS: typing.List[ConfigChannel] = [{'name': name, 'key': 'AQ=='} for name in PRESET_CHANNELS]
+# default key channels under other names, built when first seen
+MAX_FALLBACK_KEYS = 256
+
+_nonce = struct.Struct('<QQ')
+
+
+def decode_psk(key: str) -> bytes:
+  """
+  Decodes a channel PSK as written in the Meshtastic apps, expanding the single byte shorthand keys and padding short keys the way the firmware does.
+  """
+  padded = key.ljust(len(key) + ((4 - (len(key) % 4)) % 4), '=')
+  raw = base64.b64decode(padded.replace('-', '+').replace('_', '/'))
+
+  if len(raw) == 1:
+    index = raw[0]
+    if index == 0:
+      return b'' # unencrypted
+    return DEFAULT_KEY_BYTES[:-1] + bytes([(DEFAULT_KEY_BYTES[-1] + index - 1) & 0xff])
+  if 1 < len(raw) < 16:
+    return raw.ljust(16, b'\0')
+  if 16 < len(raw) < 32:
+    return raw.ljust(32, b'\0')
+  return raw
+
+
+def channel_hash(name: str, key: bytes) -> int:
+  """
+  The 8 bit channel hash carried in the `channel` field of encrypted packets.
+  """
+  result = 0
+  for byte in name.encode('utf-8'):
+    result ^= byte
+  for byte in key:
+    result ^= byte
+  return result
+
+
+class ChannelKey:
+  """
+  Decoded key material for one channel, with the AES algorithm object built once.
+  """
+  __slots__ = ('name', 'key', 'hash', '_algorithm')
+
+  name: str
+  key: bytes
+  hash: int
+
+  def __init__(self, name: str, key: bytes):
+    self.name = name
+    self.key = key
+    self.hash = channel_hash(name, key)
+    self._algorithm = cryptography.hazmat.primitives.ciphers.algorithms.AES(key) if key else None
+
+  def crypt(self, sender: int, packet_id: int, data: bytes) -> bytes:
+    """
+    Encrypts or decrypts a packet payload, AES-CTR being symmetric.
+    """
+    if self._algorithm is None:
+      return data
+    cipher = cryptography.hazmat.primitives.ciphers.Cipher(self._algorithm, cryptography.hazmat.primitives.ciphers.modes.CTR(_nonce.pack(packet_id, sender)))
+    decryptor = cipher.decryptor()
+    return decryptor.update(data) + decryptor.finalize()
+
+
+class KeyRing:
+  """
+  Channel keys indexed by channel hash, so each encrypted packet is only tried against the keys of its own channel. Packets on channels we have no key for are skipped without a decryption attempt.
+
+  With `default_fallback`, a packet no configured key decrypts is still decrypted if its hash is that of its channel name (from the envelope) under the default key, as any default key channel was before keys were indexed. This includes default key channels whose hash collides with a configured channel's. The check is exact, so other channels still cost no attempt.
+  """
+  _keys: typing.Dict[int, typing.Tuple[ChannelKey, ...]]
+  _default_fallback: bool
+  _fallback: typing.Dict[str, ChannelKey]
+
+  attempts: int = 0
+  skipped: int = 0
+  failures: int = 0
+
+  def __init__(self, channels: typing.Iterable[ConfigChannel], default_fallback: bool = False):
+    keys: typing.Dict[int, typing.List[ChannelKey]] = {}
+    for channel in channels:
+      key = ChannelKey(channel['name'], decode_psk(channel['key']))
+      keys.setdefault(key.hash, []).append(key)
+    self._keys = {hash: tuple(entries) for hash, entries in keys.items()}
+    self._default_fallback = default_fallback
+    self._fallback = {}
+
+  def __len__(self) -> int:
+    return sum(len(keys) for keys in self._keys.values())
+
+  def keys_for(self, hash: int) -> typing.Tuple[ChannelKey, ...]:
+    return self._keys.get(hash, ())
+
+  def decrypt(self, sender: int, packet_id: int, hash: int, encrypted: bytes, channel: typing.Optional[str] = None) -> typing.Optional[meshtastic.mesh_pb2.Data]:
+    keys = self._keys.get(hash, ())
+    for key in keys:
+      data = self._attempt(key, sender, packet_id, encrypted)
+      if data is not None:
+        return data
+
+    # a default key channel may share its hash with a configured one, so the fallback is tried after the configured keys
+    key = self._default_key(channel, hash) if self._default_fallback and channel else None
+    if key is not None and not any(configured.name == key.name and configured.key == key.key for configured in keys):
+      data = self._attempt(key, sender, packet_id, encrypted)
+      if data is not None:
+        return data
+    elif not keys:
+      self.skipped += 1
+      return None
+    self.failures += 1
+    return None
+
+  def _attempt(self, key: ChannelKey, sender: int, packet_id: int, encrypted: bytes) -> typing.Optional[meshtastic.mesh_pb2.Data]:
+    self.attempts += 1
+    data = meshtastic.mesh_pb2.Data()
+    try:
+      data.ParseFromString(key.crypt(sender, packet_id, encrypted))
+    except Exception:
+      return None
+    # channel hashes collide, a wrong key usually fails to parse or yields no portnum
+    return data if data.portnum else None
+
+  def _default_key(self, channel: str, hash: int) -> typing.Optional[ChannelKey]:
+    key = self._fallback.get(channel)
+    if key is None:
+      key = ChannelKey(channel, DEFAULT_KEY_BYTES)
+      # names off the wire are only remembered while there are few of them
+      if len(self._fallback) < MAX_FALLBACK_KEYS:
+        self._fallback[channel] = key
+    return key if key.hash == hash else None
+
+  def decrypt_packet(self, packet: meshtastic.mesh_pb2.MeshPacket) -> bool:
+    data = self.decrypt(getattr(packet, 'from'), packet.id, packet.channel, packet.encrypted)
+    if data is None:
+      return False
+    packet.decoded.CopyFrom(data)
+    return True
+
+  def stats(self) -> typing.Dict[str, int]:
+    return {'attempts': self.attempts, 'skipped': self.skipped, 'failures': self.failures}
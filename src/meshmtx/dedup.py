@@ -0,0 +1,190 @@
+import threading
+import time
+import typing
+
+DEFAULT_CAPACITY = 65536
+DEFAULT_WINDOW = 600.0 # seconds
+DEFAULT_ECHO_WINDOW = 60.0 # seconds
+
+
+class RecentKeys:
+  """
+  Time-windowed set of integer keys, held in a fixed-size ring buffer backed by a hash map. Memory is bounded by the capacity, and the oldest keys are forgotten first. A key also stops matching once it is older than the window.
+  """
+  _capacity: int
+  _window: float
+  _ring: typing.List[int]
+  _head: int
+  _seen: typing.Dict[int, typing.Tuple[float, int, typing.Any]]
+
+  def __init__(self, capacity: int, window: float):
+    self._capacity = capacity
+    self._window = window
+    self._ring = [-1] * capacity
+    self._head = 0
+    self._seen = {}
+
+  def __len__(self) -> int:
+    return len(self._seen)
+
+  def contains(self, key: int, now: float) -> bool:
+    seen = self._seen.get(key)
+    return seen is not None and now - seen[0] <= self._window
+
+  def get(self, key: int, now: float) -> typing.Optional[typing.Tuple[float, typing.Any]]:
+    """
+    Returns when a key was added and its tag, None if it is not within the window.
+    """
+    seen = self._seen.get(key)
+    if seen is None or now - seen[0] > self._window:
+      return None
+    return seen[0], seen[2]
+
+  def add(self, key: int, now: float, tag: typing.Any = None):
+    # evict the key occupying the slot we are about to reuse, unless it has since moved to a newer slot
+    evicted = self._ring[self._head]
+    if evicted != -1 and self._seen.get(evicted, (0, -1))[1] == self._head:
+      del self._seen[evicted]
+    self._ring[self._head] = key
+    self._seen[key] = (now, self._head, tag)
+    self._head = (self._head + 1) % self._capacity
+
+
+class SourceStats:
+  """
+  Counters of one source (broker) feeding a shared deduplicator.
+  """
+  __slots__ = ('processed', 'first', 'duplicates', 'late', 'lag')
+
+  processed: int
+  first: int
+  duplicates: int
+  late: int
+  lag: float
+
+  def __init__(self):
+    self.processed = 0
+    self.first = 0
+    self.duplicates = 0
+    self.late = 0
+    self.lag = 0.0
+
+  def as_dict(self) -> typing.Dict[str, float]:
+    return {
+      'processed': self.processed,
+      'first': self.first,
+      'duplicates': self.duplicates,
+      'duplicate_rate': self.duplicates / self.processed if self.processed else 0.0,
+      'late': self.late,
+      'lag_seconds': self.lag,
+    }
+
+
+class PacketDeduplicator:
+  """
+  Remembers recently seen packets by (sender, packet id) so copies uplinked by several gateways, or received on overlapping subscriptions, are only processed once.
+
+  Several brokers may share one deduplicator, each passing its name as the `source`. The source that delivered a packet first is remembered with it, so each source also counts the packets it delivered first, and for those another source delivered first (`late`), how many seconds after it in total (`lag_seconds`).
+  """
+  _keys: RecentKeys
+  _lock: threading.Lock
+  _sources: typing.Dict[str, SourceStats]
+
+  processed: int = 0
+  duplicates: int = 0
+
+  def __init__(self, capacity: int = DEFAULT_CAPACITY, window: float = DEFAULT_WINDOW):
+    self._keys = RecentKeys(capacity, window)
+    self._lock = threading.Lock()
+    self._sources = {}
+
+  def is_duplicate(self, sender: int, packet_id: int, now: typing.Optional[float] = None, source: typing.Optional[str] = None) -> bool:
+    """
+    Returns True if the packet was already seen within the window, otherwise records it and returns False.
+    """
+    # packets without an id can't be told apart
+    if not packet_id:
+      return False
+
+    key = (sender << 32) | packet_id
+    if now is None:
+      now = time.monotonic()
+
+    with self._lock:
+      self.processed += 1
+      seen = self._keys.get(key, now)
+      if source is None:
+        if seen is None:
+          self._keys.add(key, now)
+          return False
+        self.duplicates += 1
+        return True
+
+      stats = self._sources.get(source)
+      if stats is None:
+        stats = self._sources[source] = SourceStats()
+      stats.processed += 1
+      if seen is None:
+        self._keys.add(key, now, source)
+        stats.first += 1
+        return False
+      self.duplicates += 1
+      stats.duplicates += 1
+      if seen[1] != source:
+        stats.late += 1
+        stats.lag += now - seen[0]
+      return True
+
+  def stats(self) -> typing.Dict[str, float]:
+    return {
+      'processed': self.processed,
+      'duplicates': self.duplicates,
+      'duplicate_rate': self.duplicates / self.processed if self.processed else 0.0,
+      'size': len(self._keys),
+    }
+
+  def source_stats(self, source: str) -> typing.Dict[str, float]:
+    with self._lock:
+      stats = self._sources.get(source) or SourceStats()
+      return stats.as_dict()
+
+
+class EchoFilter:
+  """
+  Remembers digests of payloads we published to a broker, so our own output is recognised and ignored when the broker delivers it back to our subscription.
+
+  A payload fanned out to many clients takes one slot, refreshed once it is half way through the window, so the ring holds distinct payloads however many clients there are.
+  """
+  _keys: RecentKeys
+  _refresh: float
+  _lock: threading.Lock
+
+  published: int = 0
+  echoes: int = 0
+
+  def __init__(self, capacity: int = DEFAULT_CAPACITY, window: float = DEFAULT_ECHO_WINDOW):
+    self._keys = RecentKeys(capacity, window)
+    self._refresh = window / 2
+    self._lock = threading.Lock()
+
+  def record(self, payload: bytes, now: typing.Optional[float] = None):
+    if now is None:
+      now = time.monotonic()
+    key = hash(payload)
+    with self._lock:
+      self.published += 1
+      seen = self._keys.get(key, now)
+      if seen is None or now - seen[0] > self._refresh:
+        self._keys.add(key, now)
+
+  def is_echo(self, payload: bytes, now: typing.Optional[float] = None) -> bool:
+    if now is None:
+      now = time.monotonic()
+    with self._lock:
+      if self._keys.contains(hash(payload), now):
+        self.echoes += 1
+        return True
+      return False
+
+  def stats(self) -> typing.Dict[str, int]:
+    return {'published': self.published, 'echoes': self.echoes}
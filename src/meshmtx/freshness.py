@@ -0,0 +1,97 @@
+import math
+import threading
+import time
+import typing
+
+from meshmtx.config import ConfigFreshness
+from meshmtx.spatial import METRES_PER_DEGREE
+
+DEFAULT_INTERVAL = 60.0 # seconds
+DEFAULT_DISTANCE = 50.0 # metres
+
+
+class FreshnessGate:
+  """
+  Remembers when and where the position of each node was last stored, so work that cannot change anything is dropped early.
+
+  A position arriving within `interval` of the last stored one and less than `distance` metres from it is redundant: it is dropped once its coordinates are parsed, before its timestamp is worked out, the node table is updated and it is written to storage. A node whose position is fresh and that no client is in range of (or wants packets from, see `RoutingTable.routable`) gets nothing out of its packets being decrypted, so those are dropped before decryption, see `RemoteMQTTThread.decode_message`; a node moving into range is then noticed up to an interval late.
+  """
+  _interval: float
+  _distance_squared: float
+  _stored: typing.Dict[int, typing.Tuple[float, float, float]]
+  _clock: typing.Callable[[], float]
+  _lock: threading.Lock
+
+  positions: int = 0
+  redundant: int = 0
+  skipped: int = 0
+
+  def __init__(self, config: ConfigFreshness, clock: typing.Callable[[], float] = time.monotonic):
+    self._interval = config.get('interval', DEFAULT_INTERVAL)
+    self._distance_squared = float(config.get('distance', DEFAULT_DISTANCE)) ** 2
+    self._stored = {}
+    self._clock = clock
+    self._lock = threading.Lock()
+
+  def is_fresh(self, node_id: int) -> bool:
+    """
+    Whether a position of the node was stored within the interval.
+    """
+    stored = self._stored.get(node_id)
+    if stored is None:
+      return False
+    # a clock stepping back makes every position stale rather than fresh for longer
+    return 0.0 <= self._clock() - stored[0] < self._interval
+
+  def skip_unroutable(self, node_id: int) -> bool:
+    """
+    Checks a packet from a node no client is in range of can be dropped before decryption, counting it if so.
+    """
+    # only reads, so without the lock: a position stored meanwhile is at worst seen on the next packet
+    if not self.is_fresh(node_id):
+      return False
+    with self._lock:
+      self.skipped += 1
+    return True
+
+  def is_redundant(self, node_id: int, latitude: float, longitude: float) -> bool:
+    """
+    Checks whether a position adds nothing to the last stored one, counting it either way.
+    """
+    now = self._clock()
+    with self._lock:
+      self.positions += 1
+      stored = self._stored.get(node_id)
+      if stored is None or not 0.0 <= now - stored[0] < self._interval:
+        return False
+      # equirectangular, which is plenty over the tens of metres compared here
+      dy = latitude - stored[1]
+      dx = (longitude - stored[2]) * math.cos(math.radians(stored[1]))
+      if (dx * dx + dy * dy) * METRES_PER_DEGREE * METRES_PER_DEGREE < self._distance_squared:
+        self.redundant += 1
+        return True
+      return False
+
+  def stored(self, node_id: int, latitude: float, longitude: float):
+    """
+    Records a position as stored. Only called once the node table accepted it, so a position it rejects as older does not hold back the next one.
+    """
+    with self._lock:
+      self._stored[node_id] = (self._clock(), latitude, longitude)
+
+  def forget(self, ids: typing.List[int]):
+    """
+    Drops what is known about evicted nodes, so their next position is stored.
+    """
+    with self._lock:
+      for id in ids:
+        self._stored.pop(id, None)
+
+  def stats(self) -> typing.Dict[str, int]:
+    with self._lock:
+      return {
+        'tracked': len(self._stored),
+        'positions': self.positions,
+        'redundant': self.redundant,
+        'skipped': self.skipped,
+      }
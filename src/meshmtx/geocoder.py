@@ -1,40 +1,79 @@
-import geocoder
-import geopy.distance
+import collections
 import typing
 import logging
-import pycountry
 import enum
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from meshmtx.gis import ArcGISBackend, GeocodeResult, GeocoderBackend
+from meshmtx.spatial import NodeIndex
 
 logger = logging.getLogger('meshmtx:geocoder')
 
+# nodes kept in memory, 0 for no limit
+DEFAULT_NODE_CAPACITY = 100000
+# seconds since a node was last heard before it is evicted, 0 never expires
+DEFAULT_NODE_TTL = 7 * 24 * 3600.0
+# seconds between sweeps for expired nodes
+SWEEP_INTERVAL = 60.0
+# share of the capacity kept after a size eviction, so the next one is not a single node away
+LOW_WATER = 0.9
+# evicted ids buffered before they are merged into the sorted array of reloadable ids
+EVICTED_MERGE_SIZE = 65536
+# nodes waiting for the background reverse geocoder, further requests are dropped and made again when the node is next heard
+GIS_QUEUE_SIZE = 10000
+
+NodeFix = typing.Tuple[float, float, typing.Optional[datetime]]
+
 class NodePrecision(enum.IntEnum):
   COUNTRY = 1
   STATE = 2
   CITY = 3
 
+def _gis_field(name: str) -> property:
+  return property(lambda self: getattr(self.gis, name, None))
+
 class NodeEntry:
+  """
+  A node and its last known position. Reverse geocoded fields are read through `gis`, which nodes in the same cached cell share. `topic` caches the region topic derived from them by the router of `topic_generation`, see `meshmtx.topics.TopicRouter.geo_topic`.
+  """
+  __slots__ = ('id', 'latitude', 'longitude', 'timestamp', 'gis', 'gis_dirty', 'topic', 'topic_generation')
+
   id: int
   latitude: float
   longitude: float
-  
-  address: typing.Optional[str] = None
-  city: typing.Optional[str] = None
-  country: typing.Optional[str]
-  country_iso3: typing.Optional[str] = None
-  country_iso2: typing.Optional[str] = None
-  neighborhood: typing.Optional[str] = None
-  postal: typing.Optional[str] = None
-  region: typing.Optional[str] = None
-  state: typing.Optional[str] = None
-
-  gis_dirty: bool = True
+  timestamp: typing.Optional[datetime]
+  gis: typing.Optional[GeocodeResult]
+  gis_dirty: bool
+  topic: typing.Optional[str]
+  topic_generation: int
+
+  address = _gis_field('address')
+  city = _gis_field('city')
+  country = _gis_field('country')
+  country_iso3 = _gis_field('country_iso3')
+  country_iso2 = _gis_field('country_iso2')
+  neighborhood = _gis_field('neighborhood')
+  postal = _gis_field('postal')
+  region = _gis_field('region')
+  state = _gis_field('state')
 
   def __init__(self, id: int, latitude: float, longitude: float):
     self.id = id
     self.latitude = latitude
     self.longitude = longitude
+    self.timestamp = None
+    self.gis = None
+    self.gis_dirty = True
+    self.topic = None
+    self.topic_generation = 0
   
   def is_within_distance_from(self, other: "NodeEntry", max_distance_metres: int) -> bool:
+    # geopy is slow to import and only needed here, routing uses meshmtx.spatial
+    import geopy.distance
     metres = geopy.distance.geodesic((self.latitude, self.longitude), (other.latitude, other.longitude)).meters
     if metres > max_distance_metres:
       return False
@@ -74,24 +113,86 @@ class NodeEntry:
     """
     Returns the most precise MQTT topic path for the specified maximum precision. Can return None if no geocoded data is available.
     """
-    curr = precision
-    while True:
-      if curr < NodePrecision.COUNTRY:
-        return None
-      topic = self.get_topic(curr)
+    for curr in range(precision, NodePrecision.COUNTRY - 1, -1):
+      topic = self.get_topic(NodePrecision(curr))
       if topic:
         return topic
-      curr = NodePrecision(curr - 1)
+    return None
 
 class NodeGeocoder:
-  _entries: typing.Dict[int, NodeEntry] = {}
-  _iso3_to_country: typing.Dict[str, str] = {}
+  """
+  The in-memory node table. Bounded by a capacity and a ttl since a node was last heard, evicting the least recently heard nodes first. Pinned nodes (the configured clients) are never evicted.
+
+  With a loader, evicted nodes are reloaded from storage when they are heard again. Their ids are kept in a sorted array so unknown senders that were never stored cost no query. While the table is still loading (see `set_loading`) every unknown sender is looked up on demand.
+  """
+  _entries: typing.Dict[int, NodeEntry]
+  _iso3_to_country: typing.Dict[str, typing.Any] = {}
+  _listeners: typing.List[typing.Callable[[typing.List[NodeEntry]], None]]
+  _eviction_listeners: typing.List[typing.Callable[[typing.List[int]], None]]
+
+  _backend: GeocoderBackend
+  _lock: threading.RLock
+  _capacity: int
+  _ttl: float
+  _pinned: typing.Set[int]
+  _loader: typing.Optional[typing.Callable[[int], typing.Optional[NodeFix]]]
+  _stored: np.ndarray
+  _evicted: typing.Set[int]
+  _loading: bool
+  _missing: typing.Set[int]
+  _next_sweep: float
+  _gis_queue: typing.Deque[int]
+  _gis_pending: typing.Set[int]
+  _gis_condition: threading.Condition
+  _gis_thread: typing.Optional[threading.Thread]
+
+  index: NodeIndex
+  evictions: int = 0
+  reloads: int = 0
+
+  def __init__(self, backend: typing.Optional[GeocoderBackend] = None, capacity: int = DEFAULT_NODE_CAPACITY, ttl: float = DEFAULT_NODE_TTL, pinned: typing.Iterable[int] = (), loader: typing.Optional[typing.Callable[[int], typing.Optional[NodeFix]]] = None):
+    self._backend = backend or ArcGISBackend()
+    self._lock = threading.RLock()
+    self._entries = {}
+    self._listeners = []
+    self._eviction_listeners = []
+    self._capacity = capacity
+    self._ttl = ttl
+    self._pinned = set(pinned)
+    self._loader = loader
+    self._stored = np.zeros(0, dtype=np.int64)
+    self._evicted = set()
+    self._loading = False
+    self._missing = set()
+    self._next_sweep = time.monotonic() + SWEEP_INTERVAL
+    self._gis_queue = collections.deque()
+    self._gis_pending = set()
+    self._gis_condition = threading.Condition()
+    self._gis_thread = None
+    self.index = NodeIndex()
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  @property
+  def capacity(self) -> int:
+    return self._capacity
+
+  @property
+  def pinned(self) -> typing.FrozenSet[int]:
+    return frozenset(self._pinned)
 
-  def __init__(self):
-    for country in pycountry.countries:
-      self._iso3_to_country[country.alpha_3] = country # type: ignore
+  def set_pinned(self, pinned: typing.Iterable[int]):
+    """
+    Replaces the pinned nodes, e.g. when clients are added or removed. Nodes no longer pinned are evicted like any other.
+    """
+    with self._lock:
+      self._pinned = set(pinned)
 
   def get_node(self, id: int, needs_gis = False) -> typing.Optional[NodeEntry]:
+    """
+    Returns a node, None if it is not in memory. With `needs_gis` a node that moved is reverse geocoded first, which may block on the backend, so the forwarding path uses `request_gis` instead.
+    """
     entry = self._entries.get(id)
     if not entry:
       return None
@@ -100,41 +201,227 @@ class NodeGeocoder:
 
     return entry
 
-  def maybe_update_node(self, id: int, latitude: float, longitude: float):
-    entry = self._entries.get(id)
-    if not entry:
-      entry = NodeEntry(id, latitude, longitude)
+  def request_gis(self, entry: NodeEntry):
+    """
+    Queues a node that moved to be reverse geocoded on a background thread. Meanwhile it keeps its last geocoded location, if it has one.
+    """
+    with self._gis_condition:
+      if entry.id in self._gis_pending or len(self._gis_pending) >= GIS_QUEUE_SIZE:
+        return
+      self._gis_pending.add(entry.id)
+      self._gis_queue.append(entry.id)
+      if self._gis_thread is None:
+        self._gis_thread = threading.Thread(target=self._geocode_pending, name='geocoder:gis', daemon=True)
+        self._gis_thread.start()
+      self._gis_condition.notify()
 
-    if entry.latitude != latitude or entry.longitude != longitude:
-      entry.latitude = latitude
-      entry.longitude = longitude
-      entry.gis_dirty = True
-    
-    self._entries[id] = entry
+  def _geocode_pending(self):
+    while True:
+      with self._gis_condition:
+        while not self._gis_queue:
+          self._gis_condition.wait()
+        id = self._gis_queue.popleft()
+      try:
+        entry = self._entries.get(id)
+        if entry is not None and entry.gis_dirty:
+          self.update_node_gis(id, entry)
+      except Exception as e:
+        logger.exception(f'failed to reverse geocode node {id}: {e}')
+      finally:
+        with self._gis_condition:
+          self._gis_pending.discard(id)
+
+  def get_nodes(self) -> typing.List[NodeEntry]:
+    return list(self._entries.values())
+
+  def add_listener(self, listener: typing.Callable[[typing.List[NodeEntry]], None]):
+    """
+    Registers a callback invoked with the nodes that were added or changed position.
+    """
+    self._listeners.append(listener)
+
+  def add_eviction_listener(self, listener: typing.Callable[[typing.List[int]], None]):
+    """
+    Registers a callback invoked with the ids of evicted nodes.
+    """
+    self._eviction_listeners.append(listener)
+
+  def heard(self, id: int):
+    """
+    Records that a packet was heard from a node, reloading it from storage if it was evicted. Called for every forwarded packet, so the common case is a single array write.
+    """
+    now = time.monotonic()
+    if not self.index.touch(id, now) and self._loader is not None:
+      if self._loading:
+        if id not in self._missing:
+          self._reload(id)
+      elif self.was_evicted(id):
+        self._reload(id)
+    if now >= self._next_sweep:
+      self.expire(now)
+
+  def was_evicted(self, id: int) -> bool:
+    """
+    Whether a node may have a stored position but is not in memory.
+    """
+    if id in self._evicted:
+      return True
+    stored = self._stored
+    position = np.searchsorted(stored, id)
+    return bool(position < len(stored) and stored[position] == id)
+
+  def mark_stored(self, ids: typing.Iterable[int]):
+    """
+    Records nodes that have a stored position but were not loaded, so they are reloaded when heard.
+    """
+    with self._lock:
+      self._evicted.update(ids)
+      if len(self._evicted) >= EVICTED_MERGE_SIZE:
+        self._merge_evicted()
+
+  def set_loading(self, loading: bool):
+    """
+    Marks the table as still being loaded from storage, or done.
+    """
+    with self._lock:
+      self._loading = loading
+      if not loading:
+        self._missing = set()
+        self._merge_evicted()
+
+  def _merge_evicted(self):
+    if not self._evicted:
+      return
+    evicted = np.fromiter(self._evicted, dtype=np.int64, count=len(self._evicted))
+    self._stored = np.union1d(self._stored, evicted)
+    self._evicted = set()
+
+  def _reload(self, id: int):
+    fix = self._loader(id)
+    if fix is None:
+      if self._loading:
+        self._missing.add(id)
+      return
+    latitude, longitude, timestamp = fix
+    if self.maybe_update_node(id, latitude, longitude, timestamp):
+      self.reloads += 1
+      logger.debug(f'reloaded evicted node {id}')
+
+  def maybe_update_node(self, id: int, latitude: float, longitude: float, timestamp: typing.Optional[datetime] = None) -> bool:
+    """
+    Updates the position of a node. Returns False if the position is older than the one already known.
+    """
+    return bool(self.maybe_update_nodes([(id, latitude, longitude, timestamp)]))
+
+  def maybe_update_nodes(self, updates: typing.Iterable[typing.Tuple[int, float, float, typing.Optional[datetime]]]) -> int:
+    """
+    Updates a batch of node positions, notifying listeners once for all nodes that moved. Returns the number of updates accepted.
+    """
+    accepted = 0
+    moved: typing.List[NodeEntry] = []
+    now = time.monotonic()
+    with self._lock:
+      for id, latitude, longitude, timestamp in updates:
+        entry = self._entries.get(id)
+        if not entry:
+          entry = NodeEntry(id, latitude, longitude)
+          moved.append(entry)
+        elif timestamp and entry.timestamp and timestamp <= entry.timestamp:
+          continue
+        elif entry.latitude != latitude or entry.longitude != longitude:
+          entry.latitude = latitude
+          entry.longitude = longitude
+          entry.gis_dirty = True
+          moved.append(entry)
+        else:
+          self.index.touch(id, now)
+
+        if timestamp:
+          entry.timestamp = timestamp
+        self._entries[id] = entry
+        accepted += 1
+
+      if moved:
+        self.index.bulk_update([entry.id for entry in moved], [entry.latitude for entry in moved], [entry.longitude for entry in moved], now)
+        for listener in self._listeners:
+          listener(moved)
+
+      if (self._capacity and len(self._entries) > self._capacity) or now >= self._next_sweep:
+        self.expire(now)
+    return accepted
+
+  def expire(self, now: typing.Optional[float] = None) -> int:
+    """
+    Evicts the nodes not heard within the ttl, then the least recently heard nodes down to the low water mark if over capacity. Returns the number of nodes evicted.
+    """
+    if now is None:
+      now = time.monotonic()
+    with self._lock:
+      self._next_sweep = now + SWEEP_INTERVAL
+      evicted: typing.Set[int] = set()
+      if self._ttl:
+        evicted.update(self.index.seen_before(now - self._ttl).tolist())
+      evicted -= self._pinned
+
+      if self._capacity and len(self._entries) - len(evicted) > self._capacity:
+        keep = int(self._capacity * LOW_WATER)
+        excess = len(self._entries) - len(evicted) - keep
+        for id in self.index.least_recent(len(evicted) + excess + len(self._pinned)).tolist():
+          if excess <= 0:
+            break
+          if id in evicted or id in self._pinned:
+            continue
+          evicted.add(id)
+          excess -= 1
+      if not evicted:
+        return 0
+
+      for id in evicted:
+        del self._entries[id]
+        self.index.remove(id)
+      if self._loader is not None:
+        self._evicted.update(evicted)
+        if len(self._evicted) >= EVICTED_MERGE_SIZE:
+          self._merge_evicted()
+
+      ids = list(evicted)
+      for listener in self._eviction_listeners:
+        listener(ids)
+      self.evictions += len(ids)
+      logger.debug(f'evicted {len(ids)} nodes, {len(self._entries)} left')
+      return len(ids)
+
+  def stats(self) -> typing.Dict[str, int]:
+    return {'count': len(self._entries), 'pinned': len(self._pinned), 'evictions': self.evictions, 'reloads': self.reloads, 'reloadable': len(self._stored) + len(self._evicted), 'gis_pending': len(self._gis_pending)}
   
+  def _country(self, iso3: str):
+    # built on the first reverse geocode rather than at startup
+    countries = NodeGeocoder._iso3_to_country
+    if not countries:
+      import pycountry
+      countries = {country.alpha_3: country for country in pycountry.countries} # type: ignore
+      NodeGeocoder._iso3_to_country = countries
+    return countries.get(iso3)
+
   def update_node_gis(self, id: int, entry: NodeEntry):
     result = None
     try:
-      result = geocoder.reverse([entry.latitude, entry.longitude], 'arcgis')
+      result = self._backend.reverse(entry.latitude, entry.longitude)
     except Exception as e:
       logger.warning(f"failed to reverse geocode node {id} at lat={entry.latitude} long={entry.longitude}: {e}")
-    if result is None or not result.ok:
+    if result is None:
       return
     
-    country_iso3 = typing.cast(str, getattr(result, 'country', None))
+    country_iso3 = result.country_iso3
     if not country_iso3:
       return None
-    country_entry = self._iso3_to_country.get(country_iso3)
-    if country_entry:
-      entry.country = self._iso3_to_country.get(country_iso3).name # type: ignore
-      entry.country_iso2 = self._iso3_to_country.get(country_iso3).alpha_2 # type: ignore
-
-    entry.address = typing.cast(str, getattr(result, 'address', None))
-    entry.city = typing.cast(str, getattr(result, 'city', None))
-    entry.country_iso3 = country_iso3
-    entry.neighborhood = typing.cast(str, getattr(result, 'neighborhood', None))
-    entry.postal = typing.cast(str, getattr(result, 'postal', None))
-    entry.region = typing.cast(str, getattr(result, 'region', None))
-    entry.state = typing.cast(str, getattr(result, 'state', None))
+    country_entry = self._country(country_iso3)
+    if country_entry and (result.country != country_entry.name or result.country_iso2 != country_entry.alpha_2): # type: ignore
+      result = GeocodeResult(**{**result.as_dict(), 'country': country_entry.name, 'country_iso2': country_entry.alpha_2}) # type: ignore
 
+    # a node that moved without leaving its area keeps its topic
+    previous = entry.gis
+    if previous is not result and (previous is None or previous.as_dict() != result.as_dict()):
+      entry.gis = result
+      entry.topic = None
     entry.gis_dirty = False
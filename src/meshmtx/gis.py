@@ -0,0 +1,379 @@
+import argparse
+import collections
+import json
+import logging
+import math
+import threading
+import time
+import typing
+from datetime import datetime
+
+import numpy as np
+import sqlalchemy
+import sqlalchemy.dialects.sqlite
+import sqlalchemy.engine
+
+from meshmtx.config import ConfigGeocoder, ConfigGeocoderBackend, ConfigGeocoderCache
+from meshmtx.storage import GeocodeState
+
+logger = logging.getLogger('meshmtx:gis')
+
+# grid cell size for the polygon bounding box index
+GRID_DEGREES = 1.0
+
+# decimal places of the cache cell, 2 is roughly 1 km
+DEFAULT_CACHE_PRECISION = 2
+DEFAULT_CACHE_CAPACITY = 65536
+# seconds before a cell that failed to resolve is tried again, doubling with each further failure
+FAILURE_BACKOFF = 60.0
+MAX_FAILURE_BACKOFF = 3600.0
+
+
+class GeocodeResult:
+  """
+  Reverse geocoded location of a point. Any field may be missing depending on the backend and the data available.
+  """
+  FIELDS = ('address', 'city', 'country', 'country_iso2', 'country_iso3', 'neighborhood', 'postal', 'region', 'state')
+
+  address: typing.Optional[str] = None
+  city: typing.Optional[str] = None
+  country: typing.Optional[str] = None
+  country_iso2: typing.Optional[str] = None
+  country_iso3: typing.Optional[str] = None
+  neighborhood: typing.Optional[str] = None
+  postal: typing.Optional[str] = None
+  region: typing.Optional[str] = None
+  state: typing.Optional[str] = None
+
+  def __init__(self, **fields: typing.Optional[str]):
+    for key, value in fields.items():
+      if key in self.FIELDS and value:
+        setattr(self, key, value)
+
+  def as_dict(self) -> typing.Dict[str, typing.Optional[str]]:
+    return {key: getattr(self, key) for key in self.FIELDS}
+
+
+class GeocoderBackend:
+  name: str = 'base'
+
+  def reverse(self, latitude: float, longitude: float) -> typing.Optional[GeocodeResult]:
+    """
+    Returns the location of a point, or None if it could not be resolved.
+    """
+    raise NotImplementedError()
+
+
+class ArcGISBackend(GeocoderBackend):
+  """
+  Online reverse geocoding through the ArcGIS API. Blocks on a network request for every lookup.
+  """
+  name = 'arcgis'
+
+  def reverse(self, latitude: float, longitude: float) -> typing.Optional[GeocodeResult]:
+    # the geocoder package pulls in requests and friends, so it is only imported once a lookup is needed
+    import geocoder
+    result = geocoder.reverse([latitude, longitude], 'arcgis')
+    if result is None or not result.ok:
+      return None
+
+    return GeocodeResult(
+      address=getattr(result, 'address', None),
+      city=getattr(result, 'city', None),
+      country_iso3=getattr(result, 'country', None),
+      neighborhood=getattr(result, 'neighborhood', None),
+      postal=getattr(result, 'postal', None),
+      region=getattr(result, 'region', None),
+      state=getattr(result, 'state', None),
+    )
+
+
+class OfflineBackend(GeocoderBackend):
+  """
+  Offline reverse geocoding against a packed boundary polygon file (see `pack`).
+
+  Each polygon carries a subset of the GeocodeResult fields. A point gets the fields of every polygon containing it, with smaller polygons taking precedence, so country, state and city boundaries can be layered in one file.
+  """
+  name = 'offline'
+
+  _vertices: np.ndarray
+  _ring_offsets: np.ndarray
+  _polygon_rings: np.ndarray
+  _polygon_bbox: np.ndarray
+  _polygon_feature: np.ndarray
+  _polygon_edges: np.ndarray
+  _edges: np.ndarray
+  _features: typing.List[typing.Dict[str, str]]
+  _grid: typing.Dict[typing.Tuple[int, int], np.ndarray]
+
+  def __init__(self, path: str):
+    with np.load(path) as data:
+      self._vertices = data['vertices']
+      self._ring_offsets = data['ring_offsets']
+      self._polygon_rings = data['polygon_rings']
+      self._polygon_bbox = data['polygon_bbox']
+      self._polygon_feature = data['polygon_feature']
+      self._features = json.loads(str(data['features']))
+    self._build_edges()
+
+    # visit larger polygons first so the more specific ones overwrite their fields
+    areas = (self._polygon_bbox[:, 2] - self._polygon_bbox[:, 0]) * (self._polygon_bbox[:, 3] - self._polygon_bbox[:, 1])
+    order = np.argsort(-areas, kind='stable')
+
+    grid: typing.Dict[typing.Tuple[int, int], typing.List[int]] = {}
+    for polygon in order.tolist():
+      lon_min, lat_min, lon_max, lat_max = self._polygon_bbox[polygon]
+      for cell_lat in range(math.floor(lat_min / GRID_DEGREES), math.floor(lat_max / GRID_DEGREES) + 1):
+        for cell_lon in range(math.floor(lon_min / GRID_DEGREES), math.floor(lon_max / GRID_DEGREES) + 1):
+          grid.setdefault((cell_lat, cell_lon), []).append(polygon)
+    self._grid = {cell: np.array(polygons, dtype=np.int64) for cell, polygons in grid.items()}
+
+    logger.info(f'loaded {len(self._polygon_feature)} boundary polygons from {path}')
+
+  def _build_edges(self):
+    # flatten every ring into (x1, y1, x2, y2) edges, grouped by polygon, so a containment test is a single vectorized pass
+    edges: typing.List[np.ndarray] = []
+    polygon_edges = [0]
+    count = 0
+    for polygon in range(len(self._polygon_feature)):
+      for ring in range(self._polygon_rings[polygon], self._polygon_rings[polygon + 1]):
+        points = self._vertices[self._ring_offsets[ring]:self._ring_offsets[ring + 1]]
+        ring_edges = np.hstack([points, np.roll(points, -1, axis=0)])
+        edges.append(ring_edges)
+        count += len(ring_edges)
+      polygon_edges.append(count)
+    self._edges = np.ascontiguousarray(np.vstack(edges).T) if edges else np.zeros((4, 0))
+    self._polygon_edges = np.array(polygon_edges, dtype=np.int64)
+
+  def _contains(self, polygon: int, latitude: float, longitude: float) -> bool:
+    # even-odd ray casting over the edges of all rings at once, which also accounts for holes
+    x1, y1, x2, y2 = self._edges[:, self._polygon_edges[polygon]:self._polygon_edges[polygon + 1]]
+    crosses = (y1 > latitude) != (y2 > latitude)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      intersect = (x2 - x1) * (latitude - y1) / (y2 - y1) + x1
+    return bool(np.count_nonzero(crosses & (longitude < intersect)) & 1)
+
+  def reverse(self, latitude: float, longitude: float) -> typing.Optional[GeocodeResult]:
+    candidates = self._grid.get((math.floor(latitude / GRID_DEGREES), math.floor(longitude / GRID_DEGREES)))
+    if candidates is None:
+      return None
+
+    bbox = self._polygon_bbox[candidates]
+    candidates = candidates[(bbox[:, 0] <= longitude) & (longitude <= bbox[:, 2]) & (bbox[:, 1] <= latitude) & (latitude <= bbox[:, 3])]
+
+    fields: typing.Dict[str, str] = {}
+    for polygon in candidates.tolist():
+      if self._contains(polygon, latitude, longitude):
+        fields.update(self._features[self._polygon_feature[polygon]])
+    if not fields:
+      return None
+    return GeocodeResult(**fields)
+
+  @staticmethod
+  def pack(geojson_path: str, output_path: str):
+    """
+    Packs a GeoJSON FeatureCollection of Polygon/MultiPolygon boundaries into the file format loaded by OfflineBackend. Feature properties named after GeocodeResult fields are kept.
+    """
+    with open(geojson_path, 'r') as f:
+      collection = json.load(f)
+
+    vertices: typing.List[typing.List[float]] = []
+    ring_offsets = [0]
+    polygon_rings = [0]
+    polygon_bbox: typing.List[typing.List[float]] = []
+    polygon_feature: typing.List[int] = []
+    features: typing.List[typing.Dict[str, str]] = []
+
+    for feature in collection['features']:
+      geometry = feature.get('geometry') or {}
+      if geometry.get('type') == 'Polygon':
+        polygons = [geometry['coordinates']]
+      elif geometry.get('type') == 'MultiPolygon':
+        polygons = geometry['coordinates']
+      else:
+        continue
+
+      properties = feature.get('properties') or {}
+      features.append({key: str(value) for key, value in properties.items() if key in GeocodeResult.FIELDS and value})
+      for rings in polygons:
+        outer = np.array(rings[0], dtype=np.float64)[:, :2]
+        polygon_bbox.append([outer[:, 0].min(), outer[:, 1].min(), outer[:, 0].max(), outer[:, 1].max()])
+        polygon_feature.append(len(features) - 1)
+        for ring in rings:
+          vertices.extend(point[:2] for point in ring)
+          ring_offsets.append(len(vertices))
+        polygon_rings.append(len(ring_offsets) - 1)
+
+    np.savez_compressed(
+      output_path,
+      vertices=np.array(vertices, dtype=np.float64).reshape(-1, 2),
+      ring_offsets=np.array(ring_offsets, dtype=np.int64),
+      polygon_rings=np.array(polygon_rings, dtype=np.int64),
+      polygon_bbox=np.array(polygon_bbox, dtype=np.float64).reshape(-1, 4),
+      polygon_feature=np.array(polygon_feature, dtype=np.int64),
+      features=np.array(json.dumps(features)),
+    )
+
+
+class ChainedBackend(GeocoderBackend):
+  """
+  Tries each backend in turn until one resolves the point, e.g. the offline index with ArcGIS as a fallback.
+  """
+  name = 'chained'
+
+  _backends: typing.List[GeocoderBackend]
+
+  def __init__(self, backends: typing.List[GeocoderBackend]):
+    self._backends = backends
+
+  def reverse(self, latitude: float, longitude: float) -> typing.Optional[GeocodeResult]:
+    for backend in self._backends:
+      try:
+        result = backend.reverse(latitude, longitude)
+      except Exception as e:
+        logger.warning(f'{backend.name} backend failed to reverse geocode lat={latitude} long={longitude}: {e}')
+        continue
+      if result and result.country_iso3:
+        return result
+    return None
+
+
+class CachedBackend(GeocoderBackend):
+  """
+  Caches results of another backend per quantized latitude/longitude cell, so nodes that jitter within a cell or share a town reuse one lookup.
+
+  Recently used cells are kept in an in-memory LRU, and every resolved cell is persisted to the state database so restarts start warm. A cell that failed to resolve, e.g. while the backend is down, is not tried again until its backoff has passed.
+  """
+  name = 'cached'
+
+  _backend: GeocoderBackend
+  _storage: typing.Optional[sqlalchemy.engine.Engine]
+  _precision: int
+  _capacity: int
+  _entries: typing.OrderedDict[str, GeocodeResult]
+  _failures: typing.OrderedDict[str, typing.Tuple[float, float]]
+  _lock: threading.Lock
+
+  hits: int = 0
+  stored_hits: int = 0
+  misses: int = 0
+  backed_off: int = 0
+
+  def __init__(self, backend: GeocoderBackend, storage: typing.Optional[sqlalchemy.engine.Engine] = None, precision: int = DEFAULT_CACHE_PRECISION, capacity: int = DEFAULT_CACHE_CAPACITY):
+    self._backend = backend
+    self._storage = storage
+    self._precision = precision
+    self._capacity = capacity
+    self._entries = collections.OrderedDict()
+    self._failures = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def cell(self, latitude: float, longitude: float) -> str:
+    return f'{latitude:.{self._precision}f},{longitude:.{self._precision}f}'
+
+  def reverse(self, latitude: float, longitude: float) -> typing.Optional[GeocodeResult]:
+    cell = self.cell(latitude, longitude)
+    with self._lock:
+      result = self._entries.get(cell)
+      if result:
+        self._entries.move_to_end(cell)
+        self.hits += 1
+        return result
+      # (retry at, backoff) of a cell that failed before
+      failure = self._failures.get(cell)
+      if failure is not None and time.monotonic() < failure[0]:
+        self.backed_off += 1
+        return None
+
+    result = self._load(cell)
+    if result:
+      self.stored_hits += 1
+    else:
+      self.misses += 1
+      try:
+        result = self._backend.reverse(latitude, longitude)
+      except Exception:
+        self._failed(cell, failure)
+        raise
+      if not result:
+        self._failed(cell, failure)
+        return None
+      self._store(cell, result)
+
+    with self._lock:
+      self._failures.pop(cell, None)
+      self._entries[cell] = result
+      self._entries.move_to_end(cell)
+      while len(self._entries) > self._capacity:
+        self._entries.popitem(last=False)
+    return result
+
+  def _failed(self, cell: str, failure: typing.Optional[typing.Tuple[float, float]]):
+    backoff = min(failure[1] * 2, MAX_FAILURE_BACKOFF) if failure else FAILURE_BACKOFF
+    with self._lock:
+      self._failures[cell] = (time.monotonic() + backoff, backoff)
+      self._failures.move_to_end(cell)
+      while len(self._failures) > self._capacity:
+        self._failures.popitem(last=False)
+
+  def stats(self) -> typing.Dict[str, int]:
+    return {'hits': self.hits, 'stored_hits': self.stored_hits, 'misses': self.misses, 'backed_off': self.backed_off, 'size': len(self._entries), 'failed': len(self._failures)}
+
+  def _load(self, cell: str) -> typing.Optional[GeocodeResult]:
+    if not self._storage:
+      return None
+    with self._storage.connect() as connection:
+      row = connection.execute(sqlalchemy.select(GeocodeState).where(GeocodeState.cell == cell)).first()
+    if not row:
+      return None
+    return GeocodeResult(**{key: getattr(row, key) for key in GeocodeResult.FIELDS})
+
+  def _store(self, cell: str, result: GeocodeResult):
+    if not self._storage:
+      return
+    values = {'cell': cell, 'timestamp': datetime.now(), **result.as_dict()}
+    statement = sqlalchemy.dialects.sqlite.insert(GeocodeState).values(values)
+    statement = statement.on_conflict_do_update(index_elements=[GeocodeState.cell], set_={key: statement.excluded[key] for key in values if key != 'cell'})
+    with self._storage.begin() as connection:
+      connection.execute(statement)
+
+
+def create_backend(config: typing.Optional[ConfigGeocoder], storage: typing.Optional[sqlalchemy.engine.Engine] = None) -> GeocoderBackend:
+  backend: GeocoderBackend
+  if not config or not config.get('backends'):
+    # ArcGIS only, if nothing else is configured
+    backend = ArcGISBackend()
+  else:
+    backends: typing.List[GeocoderBackend] = []
+    for backend_config in config['backends']:
+      backends.append(_create_single_backend(backend_config))
+    backend = backends[0] if len(backends) == 1 else ChainedBackend(backends)
+
+  cache: ConfigGeocoderCache = (config or {}).get('cache', {}) # type: ignore
+  if not cache.get('enabled', True):
+    return backend
+  return CachedBackend(
+    backend, storage,
+    precision=cache.get('precision', DEFAULT_CACHE_PRECISION),
+    capacity=cache.get('capacity', DEFAULT_CACHE_CAPACITY),
+  )
+
+
+def _create_single_backend(config: ConfigGeocoderBackend) -> GeocoderBackend:
+  if config['type'] == ArcGISBackend.name:
+    return ArcGISBackend()
+  if config['type'] == OfflineBackend.name:
+    return OfflineBackend(config['path'])
+  raise ValueError(f'unknown geocoder backend "{config["type"]}"')
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='meshmtx.gis', description='Packs GeoJSON boundaries for the offline geocoder backend')
+  parser.add_argument('geojson', type=str, help='GeoJSON FeatureCollection to read')
+  parser.add_argument('output', type=str, help='Packed .npz file to write')
+  args = parser.parse_args()
+
+  OfflineBackend.pack(args.geojson, args.output)
+
+if __name__ == "__main__":
+  main()
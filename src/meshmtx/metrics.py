@@ -0,0 +1,327 @@
+import bisect
+import collections
+import http.server
+import logging
+import sys
+import threading
+import time
+import typing
+
+import meshtastic
+import meshtastic.protobuf
+
+logger = logging.getLogger('meshmtx:metrics')
+
+# seconds, from a few microseconds (envelope scans) up to slow broker publishes
+DEFAULT_BUCKETS = (
+  0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+DEFAULT_PROFILE_INTERVAL = 0.01
+
+Labels = typing.Tuple[str, ...]
+
+
+def _format_labels(names: Labels, values: Labels, extra: str = '') -> str:
+  pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def portnum_label(portnum: typing.Optional[int]) -> str:
+  if portnum is None:
+    return 'unknown'
+  try:
+    return meshtastic.portnums_pb2.PortNum.Name(portnum)
+  except ValueError:
+    return str(portnum)
+
+
+class Counter:
+  __slots__ = ('value', '_lock')
+
+  value: float
+
+  def __init__(self):
+    self.value = 0.0
+    self._lock = threading.Lock()
+
+  def inc(self, amount: float = 1.0):
+    with self._lock:
+      self.value += amount
+
+
+class Histogram:
+  __slots__ = ('bounds', 'counts', 'sum', 'count', '_lock')
+
+  bounds: typing.Tuple[float, ...]
+  counts: typing.List[int]
+  sum: float
+  count: int
+
+  def __init__(self, bounds: typing.Tuple[float, ...]):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.sum = 0.0
+    self.count = 0
+    self._lock = threading.Lock()
+
+  def observe(self, value: float):
+    index = bisect.bisect_left(self.bounds, value)
+    with self._lock:
+      self.counts[index] += 1
+      self.sum += value
+      self.count += 1
+
+
+class Family:
+  """
+  A named metric with a fixed set of label names, holding one counter or histogram per combination of label values.
+  """
+  name: str
+  help: str
+  type: str
+  label_names: Labels
+  _buckets: typing.Tuple[float, ...]
+  _children: typing.Dict[Labels, typing.Union[Counter, Histogram]]
+  _lock: threading.Lock
+
+  def __init__(self, name: str, help: str, type: str, label_names: Labels, buckets: typing.Tuple[float, ...] = DEFAULT_BUCKETS):
+    self.name = name
+    self.help = help
+    self.type = type
+    self.label_names = label_names
+    self._buckets = buckets
+    self._children = {}
+    self._lock = threading.Lock()
+
+  def labels(self, *values: str):
+    child = self._children.get(values)
+    if child is None:
+      with self._lock:
+        child = self._children.get(values)
+        if child is None:
+          child = Histogram(self._buckets) if self.type == 'histogram' else Counter()
+          self._children[values] = child
+    return child
+
+  def render(self) -> typing.Iterator[str]:
+    yield f'# HELP {self.name} {self.help}'
+    yield f'# TYPE {self.name} {self.type}'
+    for values, child in list(self._children.items()):
+      if isinstance(child, Counter):
+        yield f'{self.name}{_format_labels(self.label_names, values)} {child.value}'
+        continue
+
+      with child._lock:
+        counts = list(child.counts)
+        total = child.sum
+        count = child.count
+      cumulative = 0
+      for bound, bucket in zip(child.bounds + (float('inf'),), counts):
+        cumulative += bucket
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        le_label = f'le="{le}"'
+        yield f'{self.name}_bucket{_format_labels(self.label_names, values, le_label)} {cumulative}'
+      yield f'{self.name}_sum{_format_labels(self.label_names, values)} {total}'
+      yield f'{self.name}_count{_format_labels(self.label_names, values)} {count}'
+
+
+class Lap:
+  """
+  Times consecutive stages of handling one message.
+  """
+  __slots__ = ('started', '_last')
+
+  started: float
+
+  def __init__(self):
+    self.started = self._last = time.perf_counter()
+
+  def mark(self, histogram: Histogram):
+    now = time.perf_counter()
+    histogram.observe(now - self._last)
+    self._last = now
+
+  def elapsed(self) -> float:
+    return time.perf_counter() - self.started
+
+
+class Metrics:
+  """
+  Registry of the hot path instrumentation, rendered in the Prometheus text format.
+
+  When disabled, `lap` returns None and callers skip all timing, so the only cost left on the hot path is that check.
+  """
+  enabled: bool
+  _families: typing.List[Family]
+  _collectors: typing.List[typing.Tuple[str, str, typing.Dict[str, str], typing.Callable[[], typing.Dict[str, float]]]]
+
+  stage_seconds: Family
+  message_seconds: Family
+  messages: Family
+  dropped: Family
+  shed: Family
+  end_to_end_seconds: Family
+  publish_lock_seconds: Family
+  output_queue_seconds: Family
+  flush_seconds: Family
+
+  def __init__(self, enabled: bool = True):
+    self.enabled = enabled
+    self._families = []
+    self._collectors = []
+
+    self.stage_seconds = self.histogram('meshmtx_stage_seconds', 'Time spent per message in each processing stage', ('broker', 'stage'))
+    self.message_seconds = self.histogram('meshmtx_message_seconds', 'Time spent handling a message, by portnum', ('broker', 'portnum'))
+    self.messages = self.counter('meshmtx_messages_total', 'Messages handled, by portnum', ('broker', 'portnum'))
+    self.dropped = self.counter('meshmtx_dropped_total', 'Messages dropped before routing, by reason', ('broker', 'reason'))
+    self.shed = self.counter('meshmtx_shed_total', 'Messages shed by flood control, by bucket and portnum', ('bucket', 'portnum'))
+    self.end_to_end_seconds = self.histogram('meshmtx_end_to_end_seconds', 'Time from receiving a message to publishing it to a client', ())
+    self.publish_lock_seconds = self.histogram('meshmtx_publish_lock_seconds', 'Time spent waiting for the publish lock', ('broker',))
+    self.output_queue_seconds = self.histogram('meshmtx_output_queue_seconds', 'Time a message waits in its client queue before it is published', ())
+    self.flush_seconds = self.histogram('meshmtx_storage_flush_seconds', 'Time spent writing pending node positions', ())
+
+  def counter(self, name: str, help: str, label_names: Labels = ()) -> Family:
+    family = Family(name, help, 'counter', label_names)
+    self._families.append(family)
+    return family
+
+  def histogram(self, name: str, help: str, label_names: Labels = (), buckets: typing.Tuple[float, ...] = DEFAULT_BUCKETS) -> Family:
+    family = Family(name, help, 'histogram', label_names, buckets)
+    self._families.append(family)
+    return family
+
+  def collect(self, prefix: str, help: str, callback: typing.Callable[[], typing.Dict[str, float]], **labels: str):
+    """
+    Exposes the `stats()` of a component as gauges named `<prefix>_<key>`, read when the metrics are rendered.
+    """
+    if not self.enabled:
+      return
+    self._collectors.append((prefix, help, labels, callback))
+
+  def lap(self) -> typing.Optional[Lap]:
+    return Lap() if self.enabled else None
+
+  def render(self) -> str:
+    lines = []
+    for family in self._families:
+      lines.extend(family.render())
+
+    gauges: typing.Dict[str, typing.Tuple[str, typing.List[str]]] = collections.OrderedDict()
+    for prefix, help, labels, callback in self._collectors:
+      try:
+        stats = callback()
+      except Exception as e:
+        logger.error(f'failed to collect {prefix}: {e}')
+        continue
+      names = tuple(labels)
+      values = tuple(labels.values())
+      for key, value in stats.items():
+        name = f'{prefix}_{key}'
+        gauges.setdefault(name, (help, []))[1].append(f'{name}{_format_labels(names, values)} {value}')
+
+    for name, (help, samples) in gauges.items():
+      lines.append(f'# HELP {name} {help}')
+      lines.append(f'# TYPE {name} gauge')
+      lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+NULL_METRICS = Metrics(enabled=False)
+
+
+class SamplingProfiler(threading.Thread):
+  """
+  Samples the stacks of all threads at a fixed interval and aggregates them in the folded format understood by flamegraph tools.
+  """
+  _interval: float
+  _stacks: typing.Counter[str]
+  _lock: threading.Lock
+  _stopping: threading.Event
+
+  samples: int = 0
+
+  def __init__(self, interval: float = DEFAULT_PROFILE_INTERVAL):
+    threading.Thread.__init__(self, name='metrics:profiler', daemon=True)
+    self._interval = interval
+    self._stacks = collections.Counter()
+    self._lock = threading.Lock()
+    self._stopping = threading.Event()
+
+  def run(self):
+    names = {}
+    while not self._stopping.wait(self._interval):
+      own = threading.get_ident()
+      if len(names) != threading.active_count():
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+      stacks = []
+      for ident, frame in sys._current_frames().items():
+        if ident == own:
+          continue
+        frames = []
+        while frame is not None:
+          code = frame.f_code
+          frames.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{code.co_firstlineno})')
+          frame = frame.f_back
+        frames.append(names.get(ident, str(ident)))
+        stacks.append(';'.join(reversed(frames)))
+
+      with self._lock:
+        self._stacks.update(stacks)
+        self.samples += 1
+
+  def stop(self):
+    self._stopping.set()
+
+  def render(self) -> str:
+    with self._lock:
+      return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common())
+
+
+class MetricsServer(threading.Thread):
+  """
+  Serves `/metrics` and, when profiling, `/profile` over HTTP.
+  """
+  _server: http.server.ThreadingHTTPServer
+
+  def __init__(self, metrics: Metrics, port: int, host: str = '127.0.0.1', profiler: typing.Optional[SamplingProfiler] = None):
+    threading.Thread.__init__(self, name='metrics:http', daemon=True)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path == '/metrics':
+          body = metrics.render()
+          content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/profile' and profiler:
+          body = profiler.render()
+          content_type = 'text/plain'
+        else:
+          self.send_error(404)
+          return
+        encoded = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+      def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+    self._server.daemon_threads = True
+    logger.info(f'serving metrics on http://{host}:{self._server.server_port}/metrics')
+
+  @property
+  def port(self) -> int:
+    return self._server.server_port
+
+  def run(self):
+    self._server.serve_forever()
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
@@ -1,51 +1,70 @@
 import threading
 import logging
 import time
+import typing
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.reasoncodes import ReasonCode
 import meshtastic
 import meshtastic.protobuf
 
 from datetime import datetime
-import sqlalchemy
-import sqlalchemy.orm
-from sqlalchemy.orm import Session, sessionmaker
 
 from typing import TYPE_CHECKING
 
 from meshmtx.config import Config, ConfigMQTT
+from meshmtx.dedup import PacketDeduplicator, DEFAULT_CAPACITY, DEFAULT_WINDOW
 from meshmtx.geocoder import NodeGeocoder
-from meshmtx.storage import NodeState
+from meshmtx.metrics import Histogram, Lap, Metrics, portnum_label
+from meshmtx.utils import PacketUtilities
+from meshmtx.wire import EnvelopeHeader
 
 if TYPE_CHECKING:
   from meshmtx.multiplexer import Multiplexer
 
 
+# processing stages timed per message, see meshmtx.metrics
+STAGES = ('queue', 'echo', 'scan', 'dedup', 'decrypt', 'position', 'route', 'publish')
+
+
 class MQTTThreadBase(threading.Thread):
   _key: str
   _config: Config
-  _storage: Session
   _geocoder: NodeGeocoder
+  _dedup: PacketDeduplicator
   _multiplexer: 'Multiplexer'
+  _metrics: Metrics
+  _stages: typing.Dict[str, Histogram]
+  _lock_wait: Histogram
 
-  _mutex = threading.Lock()
+  _mutex: threading.Lock
   _logger: logging.Logger
   _mqtt_config: ConfigMQTT
 
-  def __init__(self, key: str, config: Config, storage: sessionmaker, geocoder: NodeGeocoder, multiplexer: 'Multiplexer'):
+  def __init__(self, key: str, config: Config, geocoder: NodeGeocoder, multiplexer: 'Multiplexer', dedup: typing.Optional[PacketDeduplicator] = None):
     threading.Thread.__init__(self, name=f'mqtt:{key}')
     self._key = key
     self._config = config
-    self._storage = sqlalchemy.orm.scoped_session(storage)()
     self._geocoder = geocoder
     self._multiplexer = multiplexer
+    self._mutex = threading.Lock()
+    self._metrics = multiplexer.metrics
+    self._stages = {stage: self._metrics.stage_seconds.labels(key, stage) for stage in STAGES}
+    self._lock_wait = self._metrics.publish_lock_seconds.labels(key)
 
     self._logger = logging.getLogger(f'meshmtx:mqtt:{key}')
-    self._mqtt_config = config['mqtt'][key]
+    self._mqtt_config = self.broker_config(config)
+
+    # brokers carrying the same traffic share one, so a packet is processed once whichever delivers it first
+    if dedup is None:
+      dedup_config = config.get('dedup', {})
+      dedup = PacketDeduplicator(dedup_config.get('capacity', DEFAULT_CAPACITY), dedup_config.get('window', DEFAULT_WINDOW))
+    self._dedup = dedup
   
   def on_connect(self, client, userdata, flags, reason_code, properties):
     if reason_code.value != mqtt.CONNACK_ACCEPTED:
-      self._logger.error(f'Failed to connect to MQTT server with reason \"{reason_code}\".')
+      self._logger.error(f'Failed to connect to MQTT server with reason "{reason_code}".')
       return
 
     self._logger.info(f'Connected to MQTT server')
@@ -53,16 +72,75 @@ class MQTTThreadBase(threading.Thread):
   def on_connect_fail(self, client, userdata):
     self._logger.error('Failed to connect to MQTT server, will retry')
 
+  def on_disconnect(self, client, userdata, flags, reason_code, properties):
+    self._logger.warning(f'Disconnected from MQTT server with reason "{reason_code}"')
+
   def on_message(self, client, userdata, msg):
+    if self._multiplexer.capture:
+      self._multiplexer.capture.write(self._key, msg.topic, msg.payload)
+
+    # only hand the message off here, processing happens on the pipeline workers
+    self._multiplexer.pipeline.submit(self, msg.topic, msg.payload)
+
+  def handle_message(self, topic: str, payload: bytes, received: float):
+    lap = self._metrics.lap()
+    decoded = self.decode_message(payload, lap)
+    if decoded is None:
+      return
+    self.route_message(topic, payload, decoded[0], decoded[1], received, lap)
+
+  def decode_message(self, payload: bytes, lap: typing.Optional[Lap]) -> typing.Optional[typing.Tuple[EnvelopeHeader, typing.Optional[meshtastic.mesh_pb2.Data]]]:
+    """
+    The CPU bound part of handling a message: parsing, deduplication and decryption. Returns None if the message is to be dropped.
+
+    Touches no shared state beyond the (locked) deduplicator, so it may run off the thread that routes messages.
+    """
+    raise NotImplementedError()
+
+  def route_message(self, topic: str, payload: bytes, header: EnvelopeHeader, data: typing.Optional[meshtastic.mesh_pb2.Data], received: float, lap: typing.Optional[Lap]):
+    """
+    Updates node positions and forwards a decoded message.
+    """
     raise NotImplementedError()
   
-  def run(self):
-    self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2) # type: ignore
-    self._client.on_connect = self.on_connect
-    self._client.on_connect_fail = self.on_connect_fail
-    self._client.on_message = self.on_message
+  @property
+  def is_mqtt5(self) -> bool:
+    return self._mqtt_config.get('protocol') == 5
+
+  def create_client(self) -> mqtt.Client:
+    protocol = mqtt.MQTTv5 if self.is_mqtt5 else mqtt.MQTTv311
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=protocol) # type: ignore
+    client.on_connect = self.on_connect
+    client.on_connect_fail = self.on_connect_fail
+    client.on_disconnect = self.on_disconnect
+    client.on_message = self.on_message
+
+    client.username_pw_set(self._mqtt_config['username'], self._mqtt_config['password'])
+    return client
+
+  @property
+  def key(self) -> str:
+    return self._key
+
+  @property
+  def address(self) -> typing.Tuple[str, int]:
+    return self._mqtt_config['address'], self._mqtt_config['port']
+
+  def use_client(self, client):
+    """
+    Uses a client whose network loop is driven elsewhere (e.g. by the asyncio engine) instead of connecting from `run`.
+    """
+    self._client = client
+
+  def attach_client(self, client):
+    """
+    Uses an already connected client (e.g. a loopback client) instead of connecting from `run`.
+    """
+    self.use_client(client)
+    self.on_connect(client, None, {}, ReasonCode(PacketTypes.CONNACK, 'Success'), None)
 
-    self._client.username_pw_set(self._mqtt_config['username'], self._mqtt_config['password'])
+  def run(self):
+    self._client = self.create_client()
     self._client.connect_async(self._mqtt_config['address'], self._mqtt_config['port'])
     
     # handle TimeoutError, which for some reason isn't internally in paho-mqtt
@@ -77,65 +155,86 @@ class MQTTThreadBase(threading.Thread):
   
   def stop(self):
     self._client.disconnect()
-    self._storage.close()
+
+  def reload(self, config: Config):
+    """
+    Takes a changed configuration on the existing connection, see `Multiplexer.reload`. The broker address and credentials are only read when connecting.
+    """
+    self._config = config
+    self._mqtt_config = self.broker_config(config)
+
+  def broker_config(self, config: Config) -> ConfigMQTT:
+    """
+    Returns the settings of this thread's broker.
+    """
+    return config['mqtt'][self._key]
   
-  def publish(self, topic: str, payload):
+  def publish(self, topic: str, payload, qos: int = 0) -> bool:
+    """
+    Publishes a message. Returns False if the client refused it, e.g. while disconnected.
+    """
+    waiting = time.perf_counter() if self._metrics.enabled else None
     with self._mutex:
-      self._client.publish(topic, payload)
+      if waiting is not None:
+        self._lock_wait.observe(time.perf_counter() - waiting)
+      return self._client.publish(topic, payload, qos).rc == mqtt.MQTT_ERR_SUCCESS
+
+  def publish_batch(self, messages: typing.List[typing.Tuple[str, bytes]], qos: int = 0) -> int:
+    """
+    Publishes messages in order under one hold of the lock, stopping at the first one the client refuses. Returns the number published.
+    """
+    waiting = time.perf_counter() if self._metrics.enabled else None
+    with self._mutex:
+      if waiting is not None:
+        self._lock_wait.observe(time.perf_counter() - waiting)
+      publish = self._client.publish
+      for i, (topic, payload) in enumerate(messages):
+        if publish(topic, payload, qos).rc != mqtt.MQTT_ERR_SUCCESS:
+          return i
+    return len(messages)
+
+  def stats(self) -> typing.Dict[str, float]:
+    return {f'dedup_{key}': value for key, value in self._dedup.stats().items()}
+
+  def observe_queue_wait(self, received: float):
+    self._stages['queue'].observe(time.time() - received)
+
+  def mark_stage(self, lap: typing.Optional[Lap], stage: str):
+    if lap:
+      lap.mark(self._stages[stage])
+
+  def count_dropped(self, reason: str):
+    self._metrics.dropped.labels(self._key, reason).inc()
+
+  def count_message(self, lap: Lap, portnum: typing.Optional[int]):
+    elapsed = lap.elapsed()
+    label = portnum_label(portnum)
+    self._metrics.messages.labels(self._key, label).inc()
+    self._metrics.message_seconds.labels(self._key, label).observe(elapsed)
   
-  def handle_telemetry_packet(self, node_id: int, packet: meshtastic.mesh_pb2.MeshPacket):
+  def handle_telemetry_packet(self, node_id: int, data: meshtastic.mesh_pb2.Data):
     # is the client sending its location? if so, update the geocoded MQTT route
+    position = PacketUtilities.parse_position(data)
+    if position is None:
+      return
+    latitude = position.latitude_i * 1e-7
+    longitude = position.longitude_i * 1e-7
+    if self.is_redundant_position(node_id, latitude, longitude):
+      return
 
-    if packet.decoded.portnum == meshtastic.portnums_pb2.POSITION_APP:
-      position = meshtastic.mesh_pb2.Position()
-      try:
-        position.ParseFromString(packet.decoded.payload)
-      except Exception:
-        return
+    # store the position
+    self.store_position(node_id, latitude, longitude, PacketUtilities.position_timestamp(position))
 
-      # store the position
-      self.try_store_position(node_id, position)
+  def is_redundant_position(self, node_id: int, latitude: float, longitude: float) -> bool:
+    # a node repeating where it is adds nothing until its stored position goes stale, see meshmtx.freshness
+    freshness = self._multiplexer.freshness
+    return freshness is not None and freshness.is_redundant(node_id, latitude, longitude)
   
-  def try_store_position(self, node_id: int, position: meshtastic.mesh_pb2.Position):
-    # Must have latitude and longitude
-    if position.latitude_i == 0 or position.longitude_i == 0:
+  def store_position(self, node_id: int, latitude: float, longitude: float, timestamp: datetime):
+    # the in-memory node table decides whether this is newer than what we know, the database write happens behind
+    if not self._geocoder.maybe_update_node(node_id, latitude, longitude, timestamp):
       return
-    
-    # Integer to decimal position
-    latitude = position.latitude_i * 1e-7
-    longitude = position.longitude_i * 1e-7
-    
-    # Get the best timestamp
-    timestamp = time.gmtime()
-    if position.timestamp > 0:
-      timestamp = time.gmtime(position.timestamp)
-    if position.time > 0:
-      timestamp = time.gmtime(position.time)
-    timestamp = datetime.fromtimestamp(time.mktime(timestamp))
-
-    # check for an existing record
-    record = self._storage.scalar(sqlalchemy.select(NodeState).where(NodeState.id == node_id))
-    
-    updated = False
-    if record:
-      if timestamp > record.timestamp:
-        record.timestamp = timestamp
-        record.latitude = latitude
-        record.longitude = longitude
-
-        self._storage.commit()
-        updated = True
-    else:
-      record = NodeState()
-      record.id = node_id
-      record.timestamp = timestamp
-      record.latitude = latitude
-      record.longitude = longitude
-
-      self._storage.add(record)
-      self._storage.commit()
-      updated = True
-    
-    if updated:
-      self._geocoder.maybe_update_node(node_id, latitude, longitude)
-      self._logger.debug(f"updated position for node {node_id} to lat={latitude} long={longitude}")
+    if self._multiplexer.freshness:
+      self._multiplexer.freshness.stored(node_id, latitude, longitude)
+    self._multiplexer.positions.submit(node_id, timestamp, latitude, longitude)
+    self._logger.debug(f"updated position for node {node_id} to lat={latitude} long={longitude}")
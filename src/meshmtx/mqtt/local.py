@@ -1,11 +1,19 @@
+import typing
+
 import paho.mqtt.client as mqtt
-from sqlalchemy.orm import Session, sessionmaker
+import meshtastic
+import meshtastic.protobuf
 from typing import TYPE_CHECKING
 
+from meshmtx.crypto import KeyRing, DEFAULT_CHANNELS
+from meshmtx.dedup import EchoFilter
 from meshmtx.geocoder import NodeGeocoder
+from meshmtx.metrics import Lap
 from meshmtx.mqtt.base import MQTTThreadBase
 from meshmtx.config import Config
+from meshmtx.output import DEFAULT_MAX_INFLIGHT, DEFAULT_QOS
 from meshmtx.utils import PacketUtilities
+from meshmtx.wire import EnvelopeHeader
 
 if TYPE_CHECKING:
   from meshmtx.multiplexer import Multiplexer
@@ -13,9 +21,33 @@ if TYPE_CHECKING:
 
 class LocalMQTTThread(MQTTThreadBase):
   _client: mqtt.Client
+  _echoes: EchoFilter
+  _keys: KeyRing
+  _channel_keys: KeyRing
+  _qos: int
+  _max_inflight: int
+
+  connected: bool
+
+  def __init__(self, config: Config, geocoder: NodeGeocoder, multiplexer: 'Multiplexer'):
+    MQTTThreadBase.__init__(self, 'local', config, geocoder, multiplexer)
+    self.connected = False
+    output_config = config.get('output', {})
+    self._qos = output_config.get('qos', DEFAULT_QOS)
+    self._max_inflight = output_config.get('max_inflight', DEFAULT_MAX_INFLIGHT)
+    self._echoes = EchoFilter()
+    self._keys = KeyRing([{'name': config['telemetry']['id'], 'key': config['telemetry']['key']}])
+    self._channel_keys = KeyRing(config.get('channels') or DEFAULT_CHANNELS, default_fallback=True)
 
-  def __init__(self, config: Config, storage: sessionmaker, geocoder: NodeGeocoder, multiplexer: 'Multiplexer'):
-    MQTTThreadBase.__init__(self, 'local', config, storage, geocoder, multiplexer)
+  def reload(self, config: Config):
+    telemetry = config['telemetry']
+    if telemetry != self._config['telemetry']:
+      # swapped whole, so a message being decoded uses either the old keys or the new ones
+      self._keys = KeyRing([{'name': telemetry['id'], 'key': telemetry['key']}])
+      self._logger.info(f'telemetry channel is now {telemetry["id"]}')
+    if (config.get('channels') or DEFAULT_CHANNELS) != (self._config.get('channels') or DEFAULT_CHANNELS):
+      self._channel_keys = KeyRing(config.get('channels') or DEFAULT_CHANNELS, default_fallback=True)
+    MQTTThreadBase.reload(self, config)
 
   def on_connect(self, client, userdata, flags, reason_code, properties):
     if reason_code.value != mqtt.CONNACK_ACCEPTED:
@@ -23,37 +55,150 @@ class LocalMQTTThread(MQTTThreadBase):
       return
 
     self._logger.info(f'Connected to MQTT server')
-    self._client.subscribe('msh/router/#')
 
-  def on_message(self, client, userdata, msg):
-    # node_id = PacketUtilities.topic_to_node_id(msg.topic)
+    # we publish into the same tree we subscribe to, so on MQTT 5 ask the broker not to send our own messages back
+    if self.is_mqtt5:
+      self._client.subscribe('msh/router/#', options=mqtt.SubscribeOptions(noLocal=True))
+    else:
+      self._client.subscribe('msh/router/#')
+
+    self.connected = True
+    if self._multiplexer.spool:
+      self._multiplexer.spool.wake()
+
+  def on_disconnect(self, client, userdata, flags, reason_code, properties):
+    self.connected = False
+    MQTTThreadBase.on_disconnect(self, client, userdata, flags, reason_code, properties)
+
+  def create_client(self) -> mqtt.Client:
+    client = MQTTThreadBase.create_client(self)
+    # with QoS above 0, this many publishes are on the wire at once and paho queues the rest
+    client.max_inflight_messages_set(self._max_inflight)
+    return client
+
+  def publish(self, topic: str, payload, qos: typing.Optional[int] = None) -> bool:
+    # while the broker is unreachable, or earlier messages are still spooled, messages queue up on disk behind them
+    qos = self._qos if qos is None else qos
+    spool = self._multiplexer.spool
+    if spool is None:
+      return self._send(topic, payload, qos)
+    if self.connected and not spool.backlog and self._send(topic, payload, qos):
+      return True
+    spool.append(topic, payload)
+    return False
+
+  def publish_batch(self, messages: typing.List[typing.Tuple[str, bytes]], qos: typing.Optional[int] = None) -> int:
+    qos = self._qos if qos is None else qos
+    spool = self._multiplexer.spool
+    if spool is None:
+      return self._send_batch(messages, qos)
+    sent = 0
+    if self.connected and not spool.backlog:
+      sent = self._send_batch(messages, qos)
+    for topic, payload in messages[sent:]:
+      spool.append(topic, payload)
+    return sent
+
+  def publish_spooled(self, topic: str, payload) -> bool:
+    """
+    Publishes a message drained from the spool. Returns False to stop draining.
+    """
+    return self.connected and self._send(topic, payload, self._qos)
+
+  def _send(self, topic: str, payload: bytes, qos: int) -> bool:
+    # recorded as it goes out rather than when queued, so a message held back by the spool is still known when it comes back
+    self._echoes.record(payload)
+    return MQTTThreadBase.publish(self, topic, payload, qos)
+
+  def _send_batch(self, messages: typing.List[typing.Tuple[str, bytes]], qos: int) -> int:
+    previous = None
+    for _, payload in messages:
+      # the copies of a fan-out share one payload object
+      if payload is not previous:
+        self._echoes.record(payload)
+        previous = payload
+    return MQTTThreadBase.publish_batch(self, messages, qos)
+
+  def stats(self) -> typing.Dict[str, float]:
+    stats = MQTTThreadBase.stats(self)
+    stats.update({f'echo_{key}': value for key, value in self._echoes.stats().items()})
+    stats.update({f'keys_{key}': value for key, value in self._keys.stats().items()})
+    return stats
+
+  def decode_message(self, payload: bytes, lap: typing.Optional[Lap]) -> typing.Optional[typing.Tuple[EnvelopeHeader, typing.Optional[meshtastic.mesh_pb2.Data]]]:
+    # our own fan-out coming back from the broker, it has been forwarded already
+    if self._echoes.is_echo(payload):
+      if lap:
+        self.count_dropped('echo')
+      return None
+    if lap:
+      lap.mark(self._stages['echo'])
+
+    # node_id = PacketUtilities.topic_to_node_id(topic)
     # if not node_id:
     #   return
-    envelope = PacketUtilities.decode_envelope(msg.payload)
-    if not envelope:
-      return
+    # only the routing fields are needed to fan out, the payload itself is forwarded untouched
+    header = PacketUtilities.scan_envelope(payload)
+    if not header:
+      if lap:
+        self.count_dropped('malformed')
+      return None
+    if lap:
+      lap.mark(self._stages['scan'])
+
+    # the same packet may be uplinked by several of our clients
+    if self._dedup.is_duplicate(header.sender, header.id):
+      if lap:
+        self.count_dropped('duplicate')
+      return None
+    if lap:
+      lap.mark(self._stages['dedup'])
 
+    # only packets on the telemetry channel are decrypted, and others while a client filters by portnum
+    data = None
+    if header.channel_id == self._config['telemetry']['id']:
+      data = PacketUtilities.decode_data(header, self._keys)
+      if not data:
+        if lap:
+          self.count_dropped('undecryptable')
+        return None
+      if lap:
+        lap.mark(self._stages['decrypt'])
+    elif self._multiplexer.routing.filters_portnums:
+      # once for all clients; a packet that cannot be decrypted is still forwarded to clients not filtering by portnum
+      data = PacketUtilities.decode_data(header, self._channel_keys)
+      if lap:
+        lap.mark(self._stages['decrypt'])
+    return header, data
+
+  def route_message(self, topic: str, payload: bytes, header: EnvelopeHeader, data: typing.Optional[meshtastic.mesh_pb2.Data], received: float, lap: typing.Optional[Lap]):
+    portnum = data.portnum if data is not None else None
     is_telemetry = False
-    if envelope.channel_id == self._config['telemetry']['id']:
-      decoded = PacketUtilities.decode_packet(envelope.packet, self._config['telemetry']['key'])
-      if not decoded:
-        return
-      self.handle_telemetry_packet(getattr(envelope.packet, "from"), decoded)
+    if data is not None and header.channel_id == self._config['telemetry']['id']:
+      self.handle_telemetry_packet(header.sender, data)
+      if lap:
+        lap.mark(self._stages['position'])
       is_telemetry = True # telemetry channel is excluded from forwarding to remote
 
-    # fan out packet to other multiplex queues on the local server
-    if hasattr(envelope.packet, "from"):
-      node_id = getattr(envelope.packet, "from")
-      for client in self._config['clients']:
-        id = PacketUtilities.node_to_user_id(client['id'])
-        if id == node_id:
-          continue
-        self.publish_client(client['id'], msg.payload)
+    # fan out packet to other multiplex queues on the local server, to the clients whose filter accepts it
+    node_id = header.sender
+    for client in self._multiplexer.routing.clients:
+      if client.node_id == node_id:
+        continue
+      if client.filter is not None and not client.filter.accepts(node_id, header.channel_id, header.hop_limit, portnum):
+        continue
+      self.publish_client(client.id, payload, received=received)
+    if lap:
+      lap.mark(self._stages['publish'])
+      self.count_message(lap, portnum)
   
-  def publish_client(self, id: str, payload, suffix = None):
+  def publish_client(self, id: str, payload, suffix = None, portnum = None, received = None):
     if suffix:
       suffix = '/' + suffix
     else:
       suffix = ''
 
-    self.publish(f'msh/router/{id}{suffix}', payload)
+    self.publish_topic(id, f'msh/router/{id}{suffix}', payload, portnum, received)
+
+  def publish_topic(self, id: str, topic: str, payload, portnum = None, received = None):
+    self._multiplexer.output.publish(id, topic, payload, portnum, received)
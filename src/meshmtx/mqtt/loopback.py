@@ -0,0 +1,98 @@
+import collections
+import typing
+
+import paho.mqtt.client as mqtt
+
+
+class LoopbackMessage:
+  topic: str
+  payload: bytes
+  qos: int
+  retain: bool
+
+  def __init__(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+    self.topic = topic
+    self.payload = payload
+    self.qos = qos
+    self.retain = retain
+
+
+class LoopbackBroker:
+  """
+  In-process stand-in for an MQTT broker, for benchmarks and replays. Messages are queued and delivered to matching subscribers when `drain` is called, so feedback loops show up as extra deliveries rather than recursion.
+  """
+  _clients: typing.List['LoopbackClient']
+  _queue: typing.Deque[typing.Tuple['LoopbackClient', LoopbackMessage]]
+
+  published: int = 0
+  delivered: int = 0
+  published_topics: typing.Counter[str]
+
+  def __init__(self):
+    self._clients = []
+    self._queue = collections.deque()
+    self.published_topics = collections.Counter()
+
+  def client(self, on_message: typing.Optional[typing.Callable] = None) -> 'LoopbackClient':
+    client = LoopbackClient(self)
+    client.on_message = on_message
+    self._clients.append(client)
+    return client
+
+  def publish(self, sender: 'LoopbackClient', message: LoopbackMessage):
+    self.published += 1
+    self.published_topics[message.topic] += 1
+    self._queue.append((sender, message))
+
+  def drain(self, limit: typing.Optional[int] = None) -> int:
+    """
+    Delivers queued messages, including any published while delivering, until the queue is empty or the limit is reached. Returns the number of messages routed.
+    """
+    routed = 0
+    while self._queue and (limit is None or routed < limit):
+      sender, message = self._queue.popleft()
+      routed += 1
+      for client in self._clients:
+        if client.accepts(message.topic, sender):
+          self.delivered += 1
+          if client.on_message:
+            client.on_message(client, None, message)
+    return routed
+
+
+class LoopbackClient:
+  """
+  The subset of the paho client API used by the MQTT threads, connected to a LoopbackBroker.
+  """
+  _broker: LoopbackBroker
+  _subscriptions: typing.Dict[str, bool]
+
+  on_message: typing.Optional[typing.Callable]
+
+  def __init__(self, broker: LoopbackBroker):
+    self._broker = broker
+    self._subscriptions = {}
+    self.on_message = None
+
+  def subscribe(self, topic: str, qos: int = 0, options: typing.Optional[mqtt.SubscribeOptions] = None, properties = None):
+    self._subscriptions[topic] = bool(options and options.noLocal)
+    return (mqtt.MQTT_ERR_SUCCESS, None)
+
+  def unsubscribe(self, topic: str, properties = None):
+    self._subscriptions.pop(topic, None)
+    return (mqtt.MQTT_ERR_SUCCESS, None)
+
+  def publish(self, topic: str, payload = None, qos: int = 0, retain: bool = False, properties = None):
+    self._broker.publish(self, LoopbackMessage(topic, payload, qos, retain))
+    return mqtt.MQTTMessageInfo(0)
+
+  def disconnect(self, *args, **kwargs):
+    self._broker._clients.remove(self)
+
+  def accepts(self, topic: str, sender: 'LoopbackClient') -> bool:
+    for subscription, no_local in self._subscriptions.items():
+      if no_local and sender is self:
+        continue
+      if mqtt.topic_matches_sub(subscription, topic):
+        return True
+    return False
@@ -1,22 +1,87 @@
+import time
+import typing
+
 import paho.mqtt.client as mqtt
-from sqlalchemy.orm import Session, sessionmaker
+import meshtastic
+import meshtastic.protobuf
 from typing import TYPE_CHECKING
 
-from meshmtx.config import Config
+from meshmtx.config import Config, ConfigMQTT
+from meshmtx.crypto import KeyRing, DEFAULT_CHANNELS
+from meshmtx.dedup import PacketDeduplicator
 from meshmtx.geocoder import NodeGeocoder
+from meshmtx.metrics import Lap
 from meshmtx.mqtt.base import MQTTThreadBase
-from meshmtx.utils import PacketUtilities, DEFAULT_FIRMWARE_KEY, DEFAULT_MAX_DISTANCE
+from meshmtx.routing import RoutingMode, filter_routes
+from meshmtx.utils import PacketUtilities
+from meshmtx.wire import EnvelopeHeader
 
 if TYPE_CHECKING:
   from meshmtx.multiplexer import Multiplexer
+  from meshmtx.sharding import ShardedIngest
+
+
+def remote_brokers(config: Config) -> typing.List[ConfigMQTT]:
+  """
+  Returns the remote brokers, `mqtt.remote` being one broker or a list of them, each with its name filled in: remote for the first unless named, then remote2, remote3 and so on.
+  """
+  brokers = config['mqtt']['remote']
+  if isinstance(brokers, dict):
+    brokers = [brokers]
+  named: typing.List[ConfigMQTT] = [{**broker, 'name': broker.get('name') or ('remote' if i == 0 else f'remote{i + 1}')} for i, broker in enumerate(brokers)]
+  names = [broker['name'] for broker in named]
+  if len(set(names)) != len(names) or 'local' in names:
+    raise ValueError(f'remote broker names must be unique and not local, got {", ".join(names)}')
+  return named
 
 
 class RemoteMQTTThread(MQTTThreadBase):
+  """
+  Ingest from one remote broker. With several remote brokers there is a thread per broker, all sharing the node table, routes and deduplicator of the multiplexer.
+  """
   _client: mqtt.Client
+  _keys: KeyRing
+  _geo: bool
 
-  def __init__(self, config: Config, storage: sessionmaker, geocoder: NodeGeocoder, multiplexer: 'Multiplexer'):
-    MQTTThreadBase.__init__(self, 'remote', config, storage, geocoder, multiplexer)
+  shards: typing.Optional['ShardedIngest']
+
+  def __init__(self, config: Config, geocoder: NodeGeocoder, multiplexer: 'Multiplexer', name: str = 'remote', dedup: typing.Optional[PacketDeduplicator] = None):
+    MQTTThreadBase.__init__(self, name, config, geocoder, multiplexer, dedup)
+    self.shards = None
+    self._keys = KeyRing(config.get('channels') or DEFAULT_CHANNELS, default_fallback=True)
+    self._geo = RoutingMode(config.get('routing', {}).get('mode', RoutingMode.CLIENTS.value)) == RoutingMode.GEO
   
+  def reload(self, config: Config):
+    if (config.get('channels') or DEFAULT_CHANNELS) != (self._config.get('channels') or DEFAULT_CHANNELS):
+      # swapped whole, so a message being decoded uses either the old keys or the new ones
+      self._keys = KeyRing(config.get('channels') or DEFAULT_CHANNELS, default_fallback=True)
+      if self.shards:
+        self.shards.set_channels(config.get('channels') or DEFAULT_CHANNELS)
+      self._logger.info(f'loaded {len(self._keys)} channel keys')
+
+    previous = self._mqtt_config.get('subscriptions', [])
+    MQTTThreadBase.reload(self, config)
+    current = self._mqtt_config.get('subscriptions', [])
+    added = [topic for topic in current if topic not in previous]
+    removed = [topic for topic in previous if topic not in current]
+    if not added and not removed:
+      return
+
+    # applied on the live session, or on connecting if there is none yet
+    client = getattr(self, '_client', None)
+    if client is not None:
+      for topic in removed:
+        client.unsubscribe(topic)
+      for topic in added:
+        client.subscribe(topic)
+    self._logger.info(f'subscribed to {len(added)} and unsubscribed from {len(removed)} topics')
+
+  def broker_config(self, config: Config) -> ConfigMQTT:
+    for broker in remote_brokers(config):
+      if broker['name'] == self._key:
+        return broker
+    raise KeyError(f'no remote broker named {self._key}')
+
   def on_connect(self, client, userdata, flags, reason_code, properties):
     if reason_code.value != mqtt.CONNACK_ACCEPTED:
       self._logger.error(f'Failed to connect to MQTT server with reason \"{reason_code}\".')
@@ -30,37 +95,147 @@ class RemoteMQTTThread(MQTTThreadBase):
     #   topic_name = f'msh/{topic["region"]}/{DEFAULT_FIRMWARE_KEY}/e/{topic["remote"]}/#'
     #   self._client.subscribe(topic_name)
   
-  def on_message(self, client, userdata, msg):
+  def stats(self) -> typing.Dict[str, float]:
+    # the deduplicator may be shared with other brokers, so only this broker's share of it
+    stats = {f'dedup_{key}': value for key, value in self._dedup.source_stats(self._key).items()}
+    stats.update({f'keys_{key}': value for key, value in self._keys.stats().items()})
+    return stats
+
+  def handle_message(self, topic: str, payload: bytes, received: float):
+    shards = self.shards
+    if shards is None:
+      MQTTThreadBase.handle_message(self, topic, payload, received)
+      return
+    # decryption happens in the shard processes, only what passes the checks here is sent there
+    lap = self._metrics.lap()
+    header = PacketUtilities.scan_envelope(payload)
+    if not header:
+      if lap:
+        self.count_dropped('malformed')
+      return
+    if lap:
+      lap.mark(self._stages['scan'])
+    if self.admit(header, lap):
+      shards.dispatch(topic, payload, header.sender, received)
+
+  def admit(self, header: EnvelopeHeader, lap: typing.Optional[Lap]) -> bool:
+    """
+    The checks made before paying for decryption. Returns False if the message is to be dropped.
+    """
+    # the same packet is commonly uplinked by several gateways, and may match more than one subscription
+    if self._dedup.is_duplicate(header.sender, header.id, source=self._key):
+      if lap:
+        self.count_dropped('duplicate')
+      return False
+    if lap:
+      lap.mark(self._stages['dedup'])
+
+    # a sender out of tokens even for its most important messages is shed before paying for decryption
+    limits = self._multiplexer.limits
+    if limits and not limits.may_send(header.sender):
+      if lap:
+        self.count_dropped('rate_limited')
+      return False
+
+    # nothing from a sender no client is in range of (or wants) is forwarded, and while its position is fresh there is nothing to learn either
+    freshness = self._multiplexer.freshness
+    if freshness and not self._geo and not self._multiplexer.routing.routable(header.sender, header.channel_id, header.hop_limit) and freshness.skip_unroutable(header.sender):
+      # still heard, so it stays in the node table
+      self._geocoder.heard(header.sender)
+      if lap:
+        self.count_dropped('unroutable')
+      return False
+    return True
+
+  def decode_message(self, payload: bytes, lap: typing.Optional[Lap]) -> typing.Optional[typing.Tuple[EnvelopeHeader, typing.Optional[meshtastic.mesh_pb2.Data]]]:
     # i.e. msh/EU_868/2/e/LongFast/!e2e52528
-    # node_id = PacketUtilities.topic_to_node_id(msg.topic)
+    # node_id = PacketUtilities.topic_to_node_id(topic)
     # if not node_id:
     #   return
-    envelope = PacketUtilities.decode_envelope(msg.payload)
-    if not envelope:
-      return
-    
-    # attempt to decrypt the packet and process it as telemetry using the default crypto key
-    packet = PacketUtilities.decode_packet(envelope.packet)
-    if packet and hasattr(envelope.packet, "from"):
-      node_id = getattr(envelope.packet, "from")
-      self.handle_telemetry_packet(node_id, packet)
-
-      remote_entry = self._geocoder.get_node(node_id)
-      if not remote_entry:
+    header = PacketUtilities.scan_envelope(payload)
+    if not header:
+      if lap:
+        self.count_dropped('malformed')
+      return None
+    if lap:
+      lap.mark(self._stages['scan'])
+    if not self.admit(header, lap):
+      return None
+
+    # attempt to decrypt the packet with the key of its channel
+    data = PacketUtilities.decode_data(header, self._keys)
+    if not data:
+      if lap:
+        self.count_dropped('undecryptable')
+      return None
+    if lap:
+      lap.mark(self._stages['decrypt'])
+    return header, data
+
+  def route_message(self, topic: str, payload: bytes, header: EnvelopeHeader, data: typing.Optional[meshtastic.mesh_pb2.Data], received: float, lap: typing.Optional[Lap]):
+    # process it as telemetry
+    node_id = header.sender
+    self.handle_telemetry_packet(node_id, data)
+    if lap:
+      lap.mark(self._stages['position'])
+    self.forward(topic, payload, node_id, data.portnum, header.channel_id, header.hop_limit, received, lap)
+
+  def forward(self, topic: str, payload: bytes, node_id: int, portnum: int, channel: str, hop_limit: int, received: float, lap: typing.Optional[Lap]):
+    self._geocoder.heard(node_id)
+    limits = self._multiplexer.limits
+    if limits:
+      now = time.monotonic()
+      if not limits.admit_sender(node_id, portnum, now):
+        if lap:
+          self.count_dropped('rate_limited')
         return
+    if self._geo and self.forward_region(topic, payload, node_id, portnum, received, lap):
+      return
+
+    # forward the message to the client multiplexer queues within range of the sender (if any)
+    routing = self._multiplexer.routing
+    routes = routing.lookup(node_id)
+    if routes and routing.filtered:
+      # one decode serves every client, each only checks its compiled filter against it
+      routes = filter_routes(routes, node_id, channel, hop_limit, portnum)
+    if routes and limits:
+      routes = limits.admit_clients(routes, portnum, now)
+    if lap:
+      lap.mark(self._stages['route'])
+    if routes:
+      # the region prefix is replaced by the client's queue, with imported channels renamed
+      prefix, gateway = self._multiplexer.topics.resolve(topic)
+      bases = prefix.bases
+      local = self._multiplexer.local
+      for route in routes:
+        base = bases.get(route.id) or prefix.base(route.id)
+        local.publish_topic(route.id, base + gateway, payload, portnum, received)
+      if lap:
+        lap.mark(self._stages['publish'])
+
+    if lap:
+      self.count_message(lap, portnum)
+
+  def forward_region(self, topic: str, payload: bytes, node_id: int, portnum: int, received: float, lap: typing.Optional[Lap]) -> bool:
+    """
+    Publishes the message once under the region of the sender, for clients subscribed by region. Returns False if the sender has no known region.
+    """
+    entry = self._geocoder.get_node(node_id)
+    if entry is not None and entry.gis_dirty:
+      # never geocoded on the forwarding path, the node keeps its last region (if any) until the background lookup lands
+      self._geocoder.request_gis(entry)
+    topics = self._multiplexer.topics
+    region = topics.geo_topic(entry) if entry else None
+    if not region:
+      return False
+    if lap:
+      lap.mark(self._stages['route'])
 
-      # forward the message to the right client multiplexer queue (if it exists)
-      for client in self._config['clients']:
-        id = PacketUtilities.node_to_user_id(client['id'])
-        entry = self._geocoder.get_node(id)
-        if not entry:
-          continue
-
-        # see if the target node is close enough to our node
-        max_distance = client.get('max_distance', DEFAULT_MAX_DISTANCE)
-        if not entry.is_within_distance_from(remote_entry, max_distance):
-          continue
-
-        # strip off the region prefix, then actually publish the message
-        topic_suffix = '/'.join(msg.topic.split('/')[2:])
-        self._multiplexer.local.publish_client(client['id'], msg.payload, topic_suffix)
+    prefix, gateway = topics.resolve(topic)
+    base = prefix.regions.get(region) or prefix.region_base(region)
+    # regions take the place of clients in the output stage, so a busy region cannot hold back the others
+    self._multiplexer.local.publish_topic(region, base + gateway, payload, portnum, received)
+    if lap:
+      lap.mark(self._stages['publish'])
+      self.count_message(lap, portnum)
+    return True
@@ -1,51 +1,295 @@
 import logging
+import threading
+import time
 import typing
+from datetime import datetime
 
+import sqlalchemy
 import sqlalchemy.engine
-import sqlalchemy.orm
 
+from meshmtx.capture import CaptureWriter
 from meshmtx.config import Config
-from meshmtx.geocoder import NodeGeocoder
+from meshmtx.dedup import PacketDeduplicator, DEFAULT_CAPACITY, DEFAULT_WINDOW
+from meshmtx.freshness import FreshnessGate
+from meshmtx.geocoder import NodeGeocoder, NodePrecision, DEFAULT_NODE_CAPACITY, DEFAULT_NODE_TTL
+from meshmtx.gis import CachedBackend, GeocoderBackend, create_backend
+from meshmtx.metrics import Metrics, NULL_METRICS
 from meshmtx.mqtt.local import LocalMQTTThread
-from meshmtx.mqtt.remote import RemoteMQTTThread
-from meshmtx.storage import NodeState
+from meshmtx.mqtt.remote import RemoteMQTTThread, remote_brokers
+from meshmtx.output import OutputMessage, OutputStage
+from meshmtx.pipeline import Pipeline
+from meshmtx.ratelimit import FloodControl
+from meshmtx.routing import RoutingTable, client_routes
+from meshmtx.sharding import ShardedIngest
+from meshmtx.spool import Spool
+from meshmtx.storage import NodeState, PositionWriter, DEFAULT_FLUSH_INTERVAL, DEFAULT_FLUSH_SIZE, DEFAULT_MAX_PENDING
+from meshmtx.topics import TopicRouter
+from meshmtx.utils import PacketUtilities
 
 logger = logging.getLogger('meshmtx:multiplexer')
 
+# rows per batch of the streaming node load
+LOAD_CHUNK_SIZE = 5000
+
+# config sections read once at startup, see Multiplexer.reload
+RESTART_SECTIONS = ('geocoder', 'nodes', 'routing', 'storage', 'pipeline', 'output', 'dedup', 'ratelimit', 'freshness', 'sharding', 'spool')
+
 
 class Multiplexer:
   _config: Config
   _storage: sqlalchemy.engine.Engine
   _geocoder: NodeGeocoder
+  _backend: GeocoderBackend
 
   local: LocalMQTTThread
   remote: RemoteMQTTThread
+  remotes: typing.List[RemoteMQTTThread]
+  remote_dedup: PacketDeduplicator
+  routing: RoutingTable
+  topics: TopicRouter
+  positions: PositionWriter
+  pipeline: Pipeline
+  output: OutputStage
+  limits: typing.Optional[FloodControl]
+  freshness: typing.Optional[FreshnessGate]
+  shards: typing.Optional[ShardedIngest]
+  spool: typing.Optional[Spool]
+  capture: typing.Optional[CaptureWriter]
+  metrics: Metrics
+  nodes_loaded: threading.Event
+  _reload_lock: threading.Lock
 
-  def __init__(self, config: Config, storage: sqlalchemy.engine.Engine):
+  def __init__(self, config: Config, storage: sqlalchemy.engine.Engine, capture: typing.Optional[CaptureWriter] = None, metrics: Metrics = NULL_METRICS):
     self._config = config
     self._storage = storage
-    self._geocoder = NodeGeocoder()
+    self.capture = capture
+    self.metrics = metrics
+    self.shards = None
+    self.nodes_loaded = threading.Event()
+    self._reload_lock = threading.Lock()
+    routing_config = config.get('routing', {})
+    self.topics = TopicRouter(config.get('imports') or [], config.get('mappings') or [], NodePrecision[routing_config.get('precision', 'city').upper()])
+    self._backend = create_backend(config.get('geocoder'), storage)
+    nodes_config = config.get('nodes', {})
+    self._geocoder = NodeGeocoder(
+      self._backend,
+      capacity=nodes_config.get('capacity', DEFAULT_NODE_CAPACITY),
+      ttl=nodes_config.get('ttl', DEFAULT_NODE_TTL),
+      pinned=[PacketUtilities.node_to_user_id(client['id']) for client in config['clients']],
+      loader=self._load_node,
+    )
+    storage_config = config.get('storage', {})
+    self.positions = PositionWriter(
+      storage,
+      flush_size=storage_config.get('flush_size', DEFAULT_FLUSH_SIZE),
+      flush_interval=storage_config.get('flush_interval', DEFAULT_FLUSH_INTERVAL),
+      max_pending=storage_config.get('max_pending', DEFAULT_MAX_PENDING),
+      metrics=metrics,
+    )
+    self.pipeline = Pipeline(config.get('pipeline', {}), metrics)
+    # without pipeline workers there is no thread to hand publishes to either
+    self.output = OutputStage(config, self._publish_local, metrics, inline=self.pipeline.inline)
+    self.limits = None
+    ratelimit_config = config.get('ratelimit', {})
+    if ratelimit_config.get('enabled', False):
+      self.limits = FloodControl(ratelimit_config, config.get('pipeline', {}).get('priorities'), metrics)
+    self.freshness = None
+    freshness_config = config.get('freshness', {})
+    if freshness_config.get('enabled', False):
+      self.freshness = FreshnessGate(freshness_config)
+      self._geocoder.add_eviction_listener(self.freshness.forget)
+    self.spool = None
+    spool_config = config.get('spool', {})
+    if spool_config.get('path'):
+      self.spool = Spool(spool_config, config['clients'], self._publish_spooled)
   
+  def _publish_local(self, messages: typing.List[OutputMessage]) -> int:
+    if len(messages) == 1:
+      topic, payload = messages[0]
+      return int(self.local.publish(topic, payload))
+    return self.local.publish_batch(messages)
+
+  def _publish_spooled(self, topic: str, payload: bytes) -> bool:
+    return self.local.publish_spooled(topic, payload)
+
+  def _node_query(self):
+    return sqlalchemy.select(NodeState.id, NodeState.latitude, NodeState.longitude, NodeState.timestamp).where(NodeState.latitude.is_not(None), NodeState.longitude.is_not(None))
+
+  def _load_clients(self, ids: typing.Optional[typing.Iterable[int]] = None):
+    # routing needs the client positions from the first message on, so these are loaded up front
+    pinned = self._geocoder.pinned if ids is None else ids
+    if not pinned:
+      return
+    with self._storage.connect() as connection:
+      self._geocoder.maybe_update_nodes(connection.execute(self._node_query().where(NodeState.id.in_(pinned))))
+
   def _load_nodes(self):
-    with sqlalchemy.orm.Session(self._storage) as session:
-      for node in session.query(NodeState):
-        if node.latitude == None or node.longitude == None:
-          continue
-        self._geocoder.maybe_update_node(node.id, node.latitude, node.longitude)
+    """
+    Streams the most recently heard nodes up to the capacity into the node table, next to live traffic. The rest are loaded when heard.
+    """
+    started = time.perf_counter()
+    pinned = self._geocoder.pinned
+    capacity = self._geocoder.capacity
+    limit = max(capacity - len(pinned), 0)
+    loaded = 0
+    stored = 0
+    try:
+      with self._storage.connect() as connection:
+        result = connection.execution_options(yield_per=LOAD_CHUNK_SIZE).execute(self._node_query().order_by(NodeState.timestamp.desc()))
+        for rows in result.partitions():
+          updates = []
+          ids = []
+          for row in rows:
+            if row[0] in pinned:
+              continue
+            if capacity and loaded >= limit:
+              ids.append(row[0])
+              continue
+            updates.append(row)
+            loaded += 1
+          self._geocoder.maybe_update_nodes(updates)
+          self._geocoder.mark_stored(ids)
+          stored += len(ids)
+    except Exception as e:
+      logger.error(f'failed to load nodes: {e}')
+    finally:
+      self._geocoder.set_loading(False)
+      self.nodes_loaded.set()
+    logger.info(f'loaded {loaded} nodes in {time.perf_counter() - started:.1f}s, {stored} more are loaded when heard')
+
+  def _load_node(self, id: int) -> typing.Optional[typing.Tuple[float, float, datetime]]:
+    # the node may have been evicted with its last position still waiting to be written
+    pending = self.positions.lookup(id)
+    if pending:
+      timestamp, latitude, longitude = pending
+      return latitude, longitude, timestamp
+    with self._storage.connect() as connection:
+      row = connection.execute(self._node_query().where(NodeState.id == id)).first()
+    if row is None:
+      return None
+    return row.latitude, row.longitude, row.timestamp
   
-  def run(self):
-    self._load_nodes()
+  def prepare(self):
+    """
+    Loads the clients and builds the MQTT threads without connecting them. The other nodes load in the background, `nodes_loaded` is set once they have.
+    """
+    self._geocoder.set_loading(True)
+    self._load_clients()
+    self.routing = RoutingTable(self._config['clients'], self._geocoder)
+    self.local = LocalMQTTThread(self._config, self._geocoder, self)
+    # one thread per remote broker, the first is the one sharded ingest takes over
+    dedup_config = self._config.get('dedup', {})
+    self.remote_dedup = PacketDeduplicator(dedup_config.get('capacity', DEFAULT_CAPACITY), dedup_config.get('window', DEFAULT_WINDOW))
+    self.remotes = [RemoteMQTTThread(self._config, self._geocoder, self, broker['name'], self.remote_dedup) for broker in remote_brokers(self._config)]
+    self.remote = self.remotes[0]
 
-    session_factory = sqlalchemy.orm.sessionmaker(bind=self._storage)
-    self.local = LocalMQTTThread(self._config, session_factory, self._geocoder, self)
-    self.remote = RemoteMQTTThread(self._config, session_factory, self._geocoder, self)
+    self.metrics.collect('meshmtx_pipeline', 'Pipeline queue depths and drops', self.pipeline.stats)
+    self.metrics.collect('meshmtx_output', 'Local publish throughput, client queue depths and drops', self.output.stats)
+    self.metrics.collect('meshmtx_positions', 'Write-behind position store counters', self.positions.stats)
+    self.metrics.collect('meshmtx_broker', 'Per broker deduplication and decryption counters', self.local.stats, broker='local')
+    for remote in self.remotes:
+      self.metrics.collect('meshmtx_broker', 'Per broker deduplication and decryption counters', remote.stats, broker=remote.key)
+    self.metrics.collect('meshmtx_remote_dedup', 'Deduplication across all remote brokers', self.remote_dedup.stats)
+    self.metrics.collect('meshmtx_nodes', 'Node table size, evictions and reloads', self._geocoder.stats)
+    if isinstance(self._backend, CachedBackend):
+      self.metrics.collect('meshmtx_geocode_cache', 'Reverse geocoding cache counters', self._backend.stats)
+    if self.limits:
+      self.metrics.collect('meshmtx_ratelimit', 'Flood control buckets and messages shed', self.limits.stats)
+    if self.freshness:
+      self.metrics.collect('meshmtx_freshness', 'Redundant positions and undecrypted packets from nodes out of range', self.freshness.stats)
+    if self.spool:
+      self.metrics.collect('meshmtx_spool', 'Messages held on disk while the local broker is unreachable', self.spool.stats)
+
+    # connecting does not wait for this, senders not loaded yet are looked up on demand
+    threading.Thread(target=self._load_nodes, name='storage:nodes', daemon=True).start()
+
+  def reload(self, config: Config):
+    """
+    Applies a changed configuration to the running multiplexer, without reconnecting or reloading the node table: clients (routes, pinned nodes and spool limits), channel keys, remote subscriptions, imports and mappings. Only what changed is rebuilt. Sections that need a restart are logged and otherwise ignored.
+    """
+    with self._reload_lock:
+      started = time.perf_counter()
+      previous = self._config
+      applied = []
+
+      for section in RESTART_SECTIONS:
+        if config.get(section) != previous.get(section):
+          logger.warning(f'{section} changed, restart to apply it')
+      previous_brokers = {'local': previous['mqtt']['local'], **{broker['name']: broker for broker in remote_brokers(previous)}}
+      brokers = {'local': config['mqtt']['local'], **{broker['name']: broker for broker in remote_brokers(config)}}
+      if brokers.keys() != previous_brokers.keys():
+        logger.warning('remote brokers added or removed, restart to apply it')
+      for key in brokers.keys() & previous_brokers.keys():
+        old_mqtt = {name: value for name, value in previous_brokers[key].items() if name != 'subscriptions'}
+        new_mqtt = {name: value for name, value in brokers[key].items() if name != 'subscriptions'}
+        if old_mqtt != new_mqtt:
+          logger.warning(f'mqtt broker {key} connection settings changed, restart to apply them')
+
+      if config['clients'] != previous['clients']:
+        # parsed before anything changes, so an invalid client leaves the running config as it was
+        routes = client_routes(config['clients'])
+        ids = list(routes)
+        # new clients are pinned and loaded before they are routed to, so their routes are computed from their position
+        pinned = self._geocoder.pinned
+        unknown = [id for id in ids if id not in pinned and self._geocoder.get_node(id) is None]
+        self._geocoder.set_pinned(ids)
+        self._load_clients(unknown)
+        added, removed, changed = self.routing.update_clients(routes)
+        self.output.set_clients([client['id'] for client in config['clients']])
+        if self.spool:
+          self.spool.set_clients(config['clients'])
+        applied.append(f'{added} clients added, {removed} removed, {changed} changed')
+
+      if config.get('imports') != previous.get('imports') or config.get('mappings') != previous.get('mappings'):
+        routing_config = config.get('routing', {})
+        self.topics = TopicRouter(config.get('imports') or [], config.get('mappings') or [], NodePrecision[routing_config.get('precision', 'city').upper()])
+        applied.append('topics recompiled')
+
+      self.local.reload(config)
+      for remote in self.remotes:
+        if remote.key in brokers:
+          remote.reload(config)
+      self._config = config
+      logger.info(f'reloaded config in {(time.perf_counter() - started) * 1e3:.1f}ms: {", ".join(applied) or "nothing to rebuild"}')
+
+  def run(self):
+    self.prepare()
     
+    self.positions.start()
+    self.pipeline.start()
+    self.output.start()
+    if self.spool:
+      self.spool.start()
     self.local.start()
-    self.remote.start()
+    if self._config.get('sharding', {}).get('processes', 0) > 0:
+      # the first remote broker's thread keeps reading, and hands decryption to worker processes
+      self.shards = ShardedIngest(self._config, self)
+      self.metrics.collect('meshmtx_sharding', 'Sharded remote ingest counters', self.shards.stats)
+      self.shards.start()
+      self.remote.shards = self.shards
+    for remote in self.remotes:
+      remote.start()
 
     self.local.join()
-    self.remote.join()
+    if self.shards:
+      self.shards.join()
+    for remote in self.remotes:
+      remote.join()
   
   def stop(self):
+    if self.shards:
+      # the first remote broker feeds the shards, and they finish what it and the pipeline handed them before the output stage stops
+      self.remote.stop()
+    self.pipeline.stop()
+    if self.shards:
+      self.shards.stop()
+    self.output.stop()
+    if self.spool:
+      self.spool.stop()
     self.local.stop()
-    self.remote.stop()
+    for remote in self.remotes:
+      if not (self.shards and remote is self.remote):
+        remote.stop()
+    self.positions.stop()
+    if self.capture:
+      self.capture.close()
@@ -0,0 +1,223 @@
+import collections
+import logging
+import threading
+import time
+import typing
+
+import meshtastic
+import meshtastic.protobuf
+
+from meshmtx.config import Config
+from meshmtx.metrics import Histogram, Metrics, NULL_METRICS
+from meshmtx.pipeline import BoundedQueue, DropPolicy
+
+logger = logging.getLogger('meshmtx:output')
+
+DEFAULT_QUEUE_SIZE = 1000 # messages per client
+DEFAULT_QUANTUM = 2048 # payload bytes per client per round
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_QOS = 0
+DEFAULT_MAX_INFLIGHT = 100
+
+# (topic, payload)
+OutputMessage = typing.Tuple[str, bytes]
+
+
+def _payload_size(item) -> int:
+  return len(item[1])
+
+
+class OutputStage(threading.Thread):
+  """
+  Publishes the fan-out to the local broker from a bounded queue per client.
+
+  Clients take turns by deficit round robin over payload bytes: each turn a client may publish up to the quantum, and what it did not use carries over while it has messages queued. A client with a busy region around it gets its share of the connection, but cannot hold back the others, and when its queue fills it is its own messages that are shed. In geo mode regions take the place of clients; their queues are dropped once idle, so only regions with messages waiting hold one. Messages taken in one pass, across clients, are handed to the local client together under a single hold of its lock.
+
+  With `inline`, messages are published on the calling thread instead, as with zero pipeline workers or the asyncio engine.
+  """
+  _inline: bool
+  _queue_size: int
+  _policy: DropPolicy
+  _priorities: typing.Dict[int, int]
+  _quantum: int
+  _batch_size: int
+  _send: typing.Callable[[typing.List[OutputMessage]], int]
+  _queues: typing.Dict[str, BoundedQueue]
+  _clients: typing.Set[str]
+  _deficits: typing.Dict[str, int]
+  _active: typing.Deque[str]
+  _resume: bool
+  _condition: threading.Condition
+  _closed: bool
+  _metrics: Metrics
+  _queue_seconds: Histogram
+  _end_to_end: Histogram
+
+  published: int = 0
+  published_bytes: int = 0
+  unsent: int = 0
+  batches: int = 0
+  evicted_dropped: int = 0
+
+  def __init__(self, config: Config, send: typing.Callable[[typing.List[OutputMessage]], int], metrics: Metrics = NULL_METRICS, inline: bool = False):
+    threading.Thread.__init__(self, name='output:publisher', daemon=True)
+    pipeline_config = config.get('pipeline', {})
+    output_config = config.get('output', {})
+    self._inline = inline
+    self._queue_size = output_config.get('queue_size', DEFAULT_QUEUE_SIZE)
+    self._policy = DropPolicy(output_config.get('drop_policy', pipeline_config.get('drop_policy', DropPolicy.OLDEST.value)))
+    self._quantum = max(output_config.get('quantum', DEFAULT_QUANTUM), 1)
+    self._batch_size = output_config.get('batch_size', DEFAULT_BATCH_SIZE)
+    self._send = send
+    self._metrics = metrics
+    self._queue_seconds = metrics.output_queue_seconds.labels()
+    self._end_to_end = metrics.end_to_end_seconds.labels()
+
+    # higher is more important, unlisted portnums are 0
+    self._priorities = {}
+    for name, priority in pipeline_config.get('priorities', {}).items():
+      self._priorities[meshtastic.portnums_pb2.PortNum.Value(name)] = priority
+
+    self._condition = threading.Condition()
+    self._closed = False
+    self._queues = {}
+    self._deficits = {}
+    self._active = collections.deque()
+    self._resume = False
+    self._clients = {client['id'] for client in config['clients']}
+    for client in self._clients:
+      self._queue(client)
+
+  def _queue(self, client: str) -> BoundedQueue:
+    with self._condition:
+      queue = self._queues.get(client)
+      if queue is None:
+        # all queues share the condition, so the publisher waits on them together
+        queue = BoundedQueue(f'output:{client}', self._queue_size, self._policy, self._condition)
+        self._queues[client] = queue
+      return queue
+
+  def set_clients(self, clients: typing.List[str]):
+    """
+    Applies a changed client list. Queues of new clients are kept while idle, those of removed clients are dropped once they have been published.
+    """
+    with self._condition:
+      self._clients = set(clients)
+      for client in self._clients:
+        self._queue(client)
+      for client in [client for client in self._queues if client not in self._clients and client not in self._deficits]:
+        self.evicted_dropped += self._queues.pop(client).dropped
+
+  def start(self):
+    if self._inline:
+      return
+    threading.Thread.start(self)
+
+  def stop(self):
+    """
+    Stops accepting messages, then publishes what is queued.
+    """
+    with self._condition:
+      self._closed = True
+      for queue in self._queues.values():
+        queue.close()
+      self._condition.notify_all()
+    if self.is_alive():
+      self.join()
+
+  def publish(self, client: str, topic: str, payload: bytes, portnum: typing.Optional[int] = None, received: typing.Optional[float] = None) -> bool:
+    """
+    Queues a message for a client. `received` is when the message that caused it arrived, for end-to-end latency. Returns False if it was dropped.
+    """
+    if self._inline:
+      self._flush([(topic, payload, None, received)])
+      return True
+
+    priority = self._priorities.get(portnum, 0) if portnum is not None else 0
+    with self._condition:
+      if self._closed:
+        return False
+      # looked up under the condition, as idle region queues are dropped by the publisher
+      queue = self._queues.get(client) or self._queue(client)
+      if not queue.put((topic, payload, time.perf_counter(), received), priority):
+        return False
+      if client not in self._deficits:
+        self._deficits[client] = 0
+        self._active.append(client)
+    return True
+
+  def run(self):
+    while True:
+      with self._condition:
+        while not self._active and not self._closed:
+          self._condition.wait()
+        if not self._active:
+          return
+        batch = self._take()
+      self._flush(batch)
+
+  def _take(self) -> list:
+    batch = []
+    while self._active and len(batch) < self._batch_size:
+      client = self._active[0]
+      queue = self._queues[client]
+      deficit = self._deficits[client]
+      # a client cut short by a full batch continues its turn, without a new quantum
+      if not self._resume:
+        deficit += self._quantum
+      taken, deficit = queue.take(self._batch_size - len(batch), deficit, _payload_size)
+      batch.extend(taken)
+
+      if not len(queue):
+        # an idle client does not bank allowance
+        self._active.popleft()
+        del self._deficits[client]
+        self._resume = False
+        if client not in self._clients:
+          # a region queue, recreated when the region is next published to
+          self.evicted_dropped += queue.dropped
+          del self._queues[client]
+      else:
+        self._deficits[client] = deficit
+        self._resume = len(batch) == self._batch_size
+        if not self._resume:
+          self._active.rotate(-1)
+    return batch
+
+  def _flush(self, batch: list):
+    try:
+      sent = self._send([(topic, payload) for topic, payload, _, _ in batch])
+    except Exception as e:
+      logger.exception(f'failed to publish {len(batch)} messages: {e}')
+      return
+    self.batches += 1
+    self.published += sent
+    self.unsent += len(batch) - sent
+    self.published_bytes += sum(len(item[1]) for item in batch[:sent])
+
+    if not self._metrics.enabled:
+      return
+    waited = time.perf_counter()
+    now = time.time()
+    for _, _, enqueued, received in batch:
+      if enqueued is not None:
+        self._queue_seconds.observe(waited - enqueued)
+      if received is not None:
+        self._end_to_end.observe(now - received)
+
+  def stats(self) -> typing.Dict[str, int]:
+    with self._condition:
+      depths = [len(queue) for queue in self._queues.values()]
+      dropped = self.evicted_dropped + sum(queue.dropped for queue in self._queues.values())
+      active = len(self._active)
+    return {
+      'published': self.published,
+      'published_bytes': self.published_bytes,
+      'unsent': self.unsent,
+      'batches': self.batches,
+      'depth': sum(depths),
+      'max_client_depth': max(depths, default=0),
+      'queues': len(depths),
+      'active_clients': active,
+      'dropped': dropped,
+    }
@@ -0,0 +1,231 @@
+import collections
+import enum
+import logging
+import threading
+import time
+import typing
+
+from meshmtx.config import ConfigPipeline
+from meshmtx.metrics import Metrics, NULL_METRICS
+from meshmtx.wire import scan_sender
+
+if typing.TYPE_CHECKING:
+  from meshmtx.mqtt.base import MQTTThreadBase
+
+logger = logging.getLogger('meshmtx:pipeline')
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 10000
+
+# seconds between repeated warnings about dropped messages
+DROP_WARNING_INTERVAL = 10.0
+
+
+class DropPolicy(enum.Enum):
+  OLDEST = 'oldest'
+  NEWEST = 'newest'
+  PORTNUM = 'portnum' # drop the lowest priority portnum first, oldest first within a priority
+
+
+class BoundedQueue:
+  """
+  FIFO with a fixed capacity that sheds items according to a drop policy instead of blocking the producer.
+
+  Items are kept in a deque per priority, tagged with their arrival order, so shedding the oldest item of the lowest priority takes constant time. Dequeuing takes whichever queued priority has the oldest head, and only a few priorities are in use.
+  """
+  name: str
+  _maxsize: int
+  _policy: DropPolicy
+  _items: typing.Dict[int, typing.Deque[typing.Tuple[int, typing.Any]]]
+  _size: int
+  _sequence: int
+  _condition: threading.Condition
+  _closed: bool
+  _last_warning: float
+
+  dropped: int = 0
+  dropped_priorities: typing.Counter[int]
+
+  def __init__(self, name: str, maxsize: int, policy: DropPolicy, condition: typing.Optional[threading.Condition] = None):
+    self.name = name
+    self._maxsize = maxsize
+    self._policy = policy
+    self._items = {}
+    self._size = 0
+    self._sequence = 0
+    # queues sharing a condition can be waited on together, see meshmtx.output
+    self._condition = condition or threading.Condition()
+    self._closed = False
+    self._last_warning = 0.0
+    self.dropped_priorities = collections.Counter()
+
+  def __len__(self) -> int:
+    return self._size
+
+  def put(self, item, priority: int = 0) -> bool:
+    """
+    Enqueues an item. Returns False if it was dropped, either because the queue is closed or by the drop policy.
+    """
+    with self._condition:
+      if self._closed:
+        return False
+      if self._size >= self._maxsize and not self._make_room(priority):
+        self._drop(priority)
+        return False
+      items = self._items.get(priority)
+      if items is None:
+        items = self._items[priority] = collections.deque()
+      items.append((self._sequence, item))
+      self._sequence += 1
+      self._size += 1
+      self._condition.notify()
+    return True
+
+  def get(self, timeout: typing.Optional[float] = None):
+    """
+    Dequeues an item, waiting until one is available. Returns None once the queue is closed and empty, or on timeout.
+    """
+    with self._condition:
+      if timeout is None:
+        while not self._size and not self._closed:
+          self._condition.wait()
+      elif not self._size and not self._closed:
+        self._condition.wait(timeout)
+      if not self._size:
+        return None
+      return self._pop(self._oldest())
+
+  def take(self, limit: int, budget: int, cost: typing.Callable[[typing.Any], int]) -> typing.Tuple[list, int]:
+    """
+    Dequeues items in order without waiting, up to `limit` of them and while their total cost fits the budget. Returns the items and the budget left.
+    """
+    taken = []
+    with self._condition:
+      while self._size and len(taken) < limit:
+        priority = self._oldest()
+        size = cost(self._items[priority][0][1])
+        if size > budget:
+          break
+        budget -= size
+        taken.append(self._pop(priority))
+    return taken, budget
+
+  def close(self):
+    with self._condition:
+      self._closed = True
+      self._condition.notify_all()
+
+  def _oldest(self) -> int:
+    # the priority whose head arrived first
+    if len(self._items) == 1:
+      return next(iter(self._items))
+    return min(self._items, key=lambda priority: self._items[priority][0][0])
+
+  def _pop(self, priority: int):
+    items = self._items[priority]
+    item = items.popleft()[1]
+    if not items:
+      del self._items[priority]
+    self._size -= 1
+    return item
+
+  def _make_room(self, priority: int) -> bool:
+    if self._policy == DropPolicy.NEWEST:
+      return False
+    if self._policy == DropPolicy.OLDEST:
+      lowest = self._oldest()
+    else:
+      # only shed a queued item if it is less important than the new one
+      lowest = min(self._items)
+      if lowest > priority:
+        return False
+    self._pop(lowest)
+    self._drop(lowest)
+    return True
+
+  def _drop(self, priority: int):
+    self.dropped += 1
+    self.dropped_priorities[priority] += 1
+
+    now = time.monotonic()
+    if now - self._last_warning >= DROP_WARNING_INTERVAL:
+      self._last_warning = now
+      logger.warning(f'{self.name} queue is full, {self.dropped} messages dropped so far')
+
+
+class Pipeline:
+  """
+  Decouples the MQTT network loops from message processing.
+
+  MQTT callbacks only enqueue received messages, and a pool of workers decodes and routes them. What they publish goes through the output stage, see `meshmtx.output`. With zero workers everything runs inline on the calling thread.
+
+  Each worker has its own ingest queue, a share of `ingest_queue_size`, and takes the senders hashing to it. The messages of one sender are therefore handled in the order they arrived, and reach the output queues in that order.
+  """
+  _workers: int
+  _threads: typing.List[threading.Thread]
+  _metrics: Metrics
+
+  ingest: typing.List[BoundedQueue]
+
+  def __init__(self, config: ConfigPipeline, metrics: Metrics = NULL_METRICS):
+    self._workers = config.get('workers', DEFAULT_WORKERS)
+    self._threads = []
+    self._metrics = metrics
+
+    policy = DropPolicy(config.get('drop_policy', DropPolicy.OLDEST.value))
+    if policy == DropPolicy.PORTNUM:
+      # the portnum is not known before decryption, so at ingest this is the same as oldest and only the output queues shed by portnum
+      policy = DropPolicy.OLDEST
+    queues = max(self._workers, 1)
+    size = max(config.get('ingest_queue_size', DEFAULT_QUEUE_SIZE) // queues, 1)
+    self.ingest = [BoundedQueue(f'ingest:{i}' if queues > 1 else 'ingest', size, policy) for i in range(queues)]
+
+  @property
+  def inline(self) -> bool:
+    return self._workers <= 0
+
+  def start(self):
+    if self.inline:
+      return
+    for i in range(self._workers):
+      self._threads.append(threading.Thread(target=self._work, args=(self.ingest[i],), name=f'pipeline:worker:{i}', daemon=True))
+    for thread in self._threads:
+      thread.start()
+
+  def stop(self):
+    """
+    Stops accepting messages, then finishes the queued ones.
+    """
+    for ingest in self.ingest:
+      ingest.close()
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+
+  def submit(self, handler: 'MQTTThreadBase', topic: str, payload: bytes) -> bool:
+    received = time.time()
+    if self.inline:
+      handler.handle_message(topic, payload, received)
+      return True
+    # a malformed payload has no sender, any worker can drop it
+    ingest = self.ingest[(scan_sender(payload) or 0) % len(self.ingest)] if len(self.ingest) > 1 else self.ingest[0]
+    return ingest.put((handler, topic, payload, received))
+
+  def stats(self) -> typing.Dict[str, int]:
+    return {
+      'ingest_depth': sum(len(ingest) for ingest in self.ingest),
+      'ingest_dropped': sum(ingest.dropped for ingest in self.ingest),
+    }
+
+  def _work(self, ingest: BoundedQueue):
+    while True:
+      item = ingest.get()
+      if item is None:
+        return
+      handler, topic, payload, received = item
+      if self._metrics.enabled:
+        handler.observe_queue_wait(received)
+      try:
+        handler.handle_message(topic, payload, received)
+      except Exception as e:
+        logger.exception(f'failed to process message on {topic}: {e}')
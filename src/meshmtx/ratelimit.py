@@ -0,0 +1,252 @@
+import array
+import threading
+import time
+import typing
+
+import meshtastic
+import meshtastic.protobuf
+
+from meshmtx.config import ConfigRateLimit, ConfigRateLimitBucket
+from meshmtx.metrics import Counter, Metrics, NULL_METRICS, portnum_label
+
+DEFAULT_SENDER_RATE = 1.0 # messages per second
+DEFAULT_SENDER_BURST = 20.0
+DEFAULT_CLIENT_RATE = 50.0
+DEFAULT_CLIENT_BURST = 500.0
+DEFAULT_RESERVE = 0.5 # share of a bucket only the highest priority portnums may use
+DEFAULT_SWEEP_INTERVAL = 60.0 # seconds
+
+
+class TokenBuckets:
+  """
+  Token buckets keyed by node id, refilled at `rate` tokens per second up to `burst`.
+
+  Buckets are two flat arrays of floats, the tokens left and when they were last updated, with a map from node id to slot, so a table of 100k senders is a few MB. A bucket that has refilled is no different from one never used, so `sweep` frees those and their slots are reused. Not thread safe, see `FloodControl`.
+  """
+  rate: float
+  burst: float
+  _slots: typing.Dict[int, int]
+  _tokens: array.array
+  _stamps: array.array
+  _free: typing.List[int]
+
+  def __init__(self, rate: float, burst: float):
+    self.rate = rate
+    self.burst = max(burst, 1.0)
+    self._slots = {}
+    self._tokens = array.array('d')
+    self._stamps = array.array('d')
+    self._free = []
+
+  def __len__(self) -> int:
+    return len(self._slots)
+
+  def level(self, key: int, now: float) -> float:
+    """
+    Returns the tokens a bucket holds, without taking any.
+    """
+    slot = self._slots.get(key)
+    if slot is None:
+      return self.burst
+    tokens = self._tokens[slot] + (now - self._stamps[slot]) * self.rate
+    return tokens if tokens < self.burst else self.burst
+
+  def take(self, key: int, now: float, floor: float = 0.0) -> bool:
+    """
+    Takes a token, as long as at least `floor` tokens are left behind. Returns False if the bucket is too low.
+    """
+    slot = self._slots.get(key)
+    if slot is None:
+      tokens = self.burst
+      slot = self._allocate(key)
+    else:
+      tokens = self._tokens[slot] + (now - self._stamps[slot]) * self.rate
+      if tokens > self.burst:
+        tokens = self.burst
+    self._stamps[slot] = now
+    if tokens < floor + 1.0:
+      self._tokens[slot] = tokens
+      return False
+    self._tokens[slot] = tokens - 1.0
+    return True
+
+  def take_routes(self, routes: typing.Sequence, now: float, floor: float = 0.0) -> typing.List:
+    """
+    `take` for the bucket of each route, by its `node_id`. Returns the routes that had a token.
+    """
+    # inlined, as this runs once per client a message is forwarded to
+    slots = self._slots
+    tokens = self._tokens
+    stamps = self._stamps
+    rate = self.rate
+    burst = self.burst
+    needed = floor + 1.0
+    admitted = []
+    for route in routes:
+      slot = slots.get(route.node_id)
+      if slot is None:
+        level = burst
+        slot = self._allocate(route.node_id)
+      else:
+        level = tokens[slot] + (now - stamps[slot]) * rate
+        if level > burst:
+          level = burst
+      stamps[slot] = now
+      if level < needed:
+        tokens[slot] = level
+      else:
+        tokens[slot] = level - 1.0
+        admitted.append(route)
+    return admitted
+
+  def _allocate(self, key: int) -> int:
+    if self._free:
+      slot = self._free.pop()
+    else:
+      slot = len(self._tokens)
+      self._tokens.append(0.0)
+      self._stamps.append(0.0)
+    self._slots[key] = slot
+    return slot
+
+  def sweep(self, now: float) -> int:
+    """
+    Frees the buckets that have refilled since they were last used. Returns how many were freed.
+    """
+    tokens = self._tokens
+    stamps = self._stamps
+    burst = self.burst
+    rate = self.rate
+    full = [key for key, slot in self._slots.items() if tokens[slot] + (now - stamps[slot]) * rate >= burst]
+    for key in full:
+      self._free.append(self._slots.pop(key))
+    return len(full)
+
+
+class FloodControl:
+  """
+  Limits how many messages each remote sender may have forwarded, and how many each client is sent, with a token bucket per sender and per client.
+
+  The sender bucket is checked twice: before decryption, where a sender with less than a token left is shed without paying for the decryption, and after it, once the portnum is known. Portnum priorities (`pipeline.priorities` unless set here) decide who gets the last tokens: a portnum below the highest priority leaves part of the bucket, up to `reserve` of it for priority 0, to the ones above, so position and text updates still get through while a node floods telemetry. Buckets that have refilled are swept every `sweep_interval` seconds.
+  """
+  _senders: typing.Optional[TokenBuckets]
+  _clients: typing.Optional[TokenBuckets]
+  _reserves: typing.Dict[int, float]
+  _default_reserve: float
+  _sweep_interval: float
+  _next_sweep: float
+  _lock: threading.Lock
+  _metrics: Metrics
+  _shed: typing.Dict[typing.Tuple[str, typing.Optional[int]], Counter]
+
+  shed_early: int = 0
+  shed_sender: int = 0
+  shed_client: int = 0
+  swept: int = 0
+
+  def __init__(self, config: ConfigRateLimit, priorities: typing.Optional[typing.Dict[str, int]] = None, metrics: Metrics = NULL_METRICS):
+    self._senders = self._buckets(config.get('sender', {}), DEFAULT_SENDER_RATE, DEFAULT_SENDER_BURST)
+    self._clients = self._buckets(config.get('client', {}), DEFAULT_CLIENT_RATE, DEFAULT_CLIENT_BURST)
+    self._sweep_interval = config.get('sweep_interval', DEFAULT_SWEEP_INTERVAL)
+    # the first message schedules the sweeps, on whatever clock the caller uses
+    self._next_sweep = 0.0
+    self._lock = threading.Lock()
+    self._metrics = metrics
+    self._shed = {}
+
+    # the reserve a portnum leaves in the bucket shrinks linearly with its priority, to none at the highest
+    reserve = min(max(config.get('reserve', DEFAULT_RESERVE), 0.0), 1.0)
+    priorities = config.get('priorities', priorities or {})
+    top = max(priorities.values(), default=0)
+    self._default_reserve = reserve if top > 0 else 0.0
+    self._reserves = {}
+    for name, priority in priorities.items():
+      self._reserves[meshtastic.portnums_pb2.PortNum.Value(name)] = reserve * (top - min(max(priority, 0), top)) / top if top > 0 else 0.0
+
+  @staticmethod
+  def _buckets(config: ConfigRateLimitBucket, rate: float, burst: float) -> typing.Optional[TokenBuckets]:
+    rate = config.get('rate', rate)
+    if not rate:
+      return None
+    return TokenBuckets(rate, config.get('burst', burst))
+
+  def reserve(self, portnum: typing.Optional[int]) -> float:
+    """
+    Returns the share of a bucket a portnum has to leave to higher priority ones.
+    """
+    return self._reserves.get(portnum, self._default_reserve)
+
+  def may_send(self, sender: int, now: typing.Optional[float] = None) -> bool:
+    """
+    Checks a sender has a token left for at least its highest priority messages, before the portnum is known. Takes nothing.
+    """
+    senders = self._senders
+    if senders is None:
+      return True
+    if now is None:
+      now = time.monotonic()
+    # only reads, so without the lock: a bucket updated meanwhile is at worst checked against its previous level
+    if senders.level(sender, now) >= 1.0:
+      return True
+    with self._lock:
+      self.shed_early += 1
+    self._count_shed('sender', None)
+    return False
+
+  def admit_sender(self, sender: int, portnum: typing.Optional[int], now: float) -> bool:
+    """
+    Takes a token from a sender's bucket for a message. Returns False if the message is to be shed.
+    """
+    senders = self._senders
+    if senders is None:
+      return True
+    floor = self._reserves.get(portnum, self._default_reserve) * senders.burst
+    with self._lock:
+      if now >= self._next_sweep:
+        self._sweep(now)
+      if senders.take(sender, now, floor):
+        return True
+      self.shed_sender += 1
+    self._count_shed('sender', portnum)
+    return False
+
+  def admit_clients(self, routes: typing.Sequence, portnum: typing.Optional[int], now: float) -> typing.Sequence:
+    """
+    Takes a token from the bucket of each client a message is routed to, returning the routes that had one.
+    """
+    clients = self._clients
+    if clients is None:
+      return routes
+    floor = self._reserves.get(portnum, self._default_reserve) * clients.burst
+    with self._lock:
+      admitted = clients.take_routes(routes, now, floor)
+      shed = len(routes) - len(admitted)
+      if not shed:
+        return routes
+      self.shed_client += shed
+    self._count_shed('client', portnum, shed)
+    return admitted
+
+  def _count_shed(self, bucket: str, portnum: typing.Optional[int], count: int = 1):
+    # floods make this a hot path, so the labelled counters are looked up once
+    counter = self._shed.get((bucket, portnum))
+    if counter is None:
+      counter = self._shed[(bucket, portnum)] = self._metrics.shed.labels(bucket, portnum_label(portnum))
+    counter.inc(count)
+
+  def _sweep(self, now: float):
+    for buckets in (self._senders, self._clients):
+      if buckets is not None:
+        self.swept += buckets.sweep(now)
+    self._next_sweep = now + self._sweep_interval
+
+  def stats(self) -> typing.Dict[str, int]:
+    with self._lock:
+      return {
+        'senders': len(self._senders) if self._senders is not None else 0,
+        'clients': len(self._clients) if self._clients is not None else 0,
+        'shed_early': self.shed_early,
+        'shed_sender': self.shed_sender,
+        'shed_client': self.shed_client,
+        'swept': self.swept,
+      }
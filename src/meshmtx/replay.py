@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import copy
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+
+import sqlalchemy.engine
+import yaml
+
+import meshmtx.storage
+from meshmtx.aio import AsyncEngine
+from meshmtx.capture import CaptureRecord, read_capture
+from meshmtx.config import Config
+from meshmtx.metrics import Metrics, NULL_METRICS
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.mqtt.loopback import LoopbackBroker, LoopbackMessage
+
+logger = logging.getLogger('meshmtx:replay')
+
+# cap on broker deliveries per replayed message, in case loop suppression regresses
+DELIVERY_LIMIT = 10000
+
+
+class ReplayReport:
+  """
+  Results of one replay. Latencies cover processing a message and delivering everything it published.
+
+  Python has no allocation counter, so allocation pressure is reported from tracemalloc when enabled: the peak transient memory per message, and the blocks still allocated after the replay.
+  """
+  messages: int
+  elapsed: float
+  latencies: typing.List[float]
+  published: int
+  transient_bytes: typing.Optional[float]
+  retained_blocks: typing.Optional[int]
+
+  def __init__(self, messages: int, elapsed: float, latencies: typing.List[float], published: int, transient_bytes: typing.Optional[float] = None, retained_blocks: typing.Optional[int] = None):
+    self.messages = messages
+    self.elapsed = elapsed
+    self.latencies = sorted(latencies)
+    self.published = published
+    self.transient_bytes = transient_bytes
+    self.retained_blocks = retained_blocks
+
+  @property
+  def rate(self) -> float:
+    return self.messages / self.elapsed if self.elapsed else 0.0
+
+  def percentile(self, percent: float) -> float:
+    if not self.latencies:
+      return 0.0
+    return self.latencies[min(len(self.latencies) - 1, int(len(self.latencies) * percent / 100))]
+
+  def summary(self) -> str:
+    lines = [
+      f'messages:     {self.messages}',
+      f'published:    {self.published}',
+      f'throughput:   {self.rate:.0f} msgs/s',
+      f'latency p50:  {self.percentile(50) * 1e6:.1f} us',
+      f'latency p99:  {self.percentile(99) * 1e6:.1f} us',
+    ]
+    if self.transient_bytes is not None:
+      lines.append(f'transient:    {self.transient_bytes:.0f} bytes/msg peak')
+    if self.retained_blocks is not None:
+      lines.append(f'retained:     {self.retained_blocks} blocks')
+    return '\n'.join(lines)
+
+
+class ReplayDriver:
+  """
+  Feeds captured messages to the multiplexer with every broker replaced by an in-process loopback broker, through the same entry points the MQTT clients use.
+
+  With the threaded engine processing is forced inline (zero pipeline workers). With the asyncio engine the executor workers are kept and the driver waits for the engine to go idle. Either way each message, and everything it published, is fully handled before the next one is fed.
+  """
+  multiplexer: Multiplexer
+  broker: LoopbackBroker
+  engine: typing.Optional[AsyncEngine]
+  _clients: typing.Dict[str, typing.Any]
+
+  def __init__(self, config: Config, storage: sqlalchemy.engine.Engine, metrics: Metrics = NULL_METRICS, engine: str = 'threads'):
+    config = copy.deepcopy(config)
+    config.setdefault('mqtt', {}).setdefault('local', {})
+    config['mqtt'].setdefault('remote', {})
+
+    self.broker = LoopbackBroker()
+    self._clients = {}
+    self.engine = None
+    if engine == 'asyncio':
+      # prepared and attached once the event loop runs, see _start
+      self.engine = AsyncEngine(config, storage, metrics=metrics)
+      self.multiplexer = self.engine.multiplexer
+      return
+
+    config['pipeline'] = {**config.get('pipeline', {}), 'workers': 0}
+    self.multiplexer = Multiplexer(config, storage, metrics=metrics)
+    self.multiplexer.prepare()
+    # replays measure steady state, not startup
+    self.multiplexer.nodes_loaded.wait()
+    for thread in (self.multiplexer.local, *self.multiplexer.remotes):
+      client = self.broker.client(thread.on_message)
+      thread.attach_client(client)
+      self._clients[thread.key] = client
+
+  def replay(self, records: typing.Iterable[CaptureRecord], paced: bool = False, trace_allocations: bool = False) -> ReplayReport:
+    return asyncio.run(self._replay(records, paced, trace_allocations))
+
+  async def _start(self):
+    if self.engine is None:
+      return
+    await self.engine.start(connect=False)
+    await asyncio.get_running_loop().run_in_executor(None, self.multiplexer.nodes_loaded.wait)
+    for connection in self.engine.connections:
+      client = self.broker.client()
+      connection.attach(client)
+      self._clients[connection.handler.key] = client
+
+  async def _feed(self, record: CaptureRecord):
+    client = self._clients[record.source]
+    client.on_message(client, None, LoopbackMessage(record.topic, record.payload))
+    if self.engine is None:
+      self.broker.drain(DELIVERY_LIMIT)
+      return
+
+    # deliveries can queue more work on the engine, e.g. echoes of our own fan-out
+    while True:
+      await self.engine.idle()
+      if not self.broker.drain(DELIVERY_LIMIT):
+        return
+
+  async def _replay(self, records: typing.Iterable[CaptureRecord], paced: bool, trace_allocations: bool) -> ReplayReport:
+    await self._start()
+    latencies = []
+    transient = 0
+    first_recorded = None
+    published = self.broker.published
+
+    if trace_allocations:
+      tracemalloc.start()
+      blocks = sys.getallocatedblocks()
+
+    start = time.perf_counter()
+    for record in records:
+      if record.source not in self._clients:
+        continue
+
+      if paced:
+        if first_recorded is None:
+          first_recorded = record.timestamp
+        delay = (record.timestamp - first_recorded) - (time.perf_counter() - start)
+        if delay > 0:
+          await asyncio.sleep(delay)
+
+      if trace_allocations:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+      began = time.perf_counter()
+      await self._feed(record)
+      latencies.append(time.perf_counter() - began)
+
+      if trace_allocations:
+        transient += tracemalloc.get_traced_memory()[1] - baseline
+    elapsed = time.perf_counter() - start
+
+    transient_bytes = None
+    retained_blocks = None
+    if trace_allocations:
+      tracemalloc.stop()
+      retained_blocks = sys.getallocatedblocks() - blocks
+      transient_bytes = transient / len(latencies) if latencies else 0.0
+
+    if self.engine is not None:
+      await self.engine.shutdown()
+    return ReplayReport(len(latencies), elapsed, latencies, self.broker.published - published, transient_bytes, retained_blocks)
+
+  def close(self):
+    self.multiplexer.positions.flush()
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    prog='meshmtx.replay',
+    description='Replays a capture recorded with `meshmtx --capture` against in-process brokers and reports throughput and latency',
+  )
+
+  parser.add_argument('capture', type=str, help='The capture file to replay')
+  parser.add_argument('-c', '--config', type=str, default='config.yaml', help='The config file to use')
+  parser.add_argument('-s', '--state', type=str, default=None, help='State database to start from, it is copied and left untouched')
+  parser.add_argument('--paced', action='store_true', help='Replay at the recorded pace instead of as fast as possible')
+  parser.add_argument('--allocations', action='store_true', help='Trace allocations, this slows down the replay considerably')
+  parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads', help='The engine to replay through')
+  parser.add_argument('--metrics', action='store_true', help='Enable instrumentation and print the collected metrics after the replay')
+  parser.add_argument('-v', '--verbose', action='store_true', default=bool(os.getenv('VERBOSE')), help='Enable debug output')
+  args = parser.parse_args()
+
+  with open(args.config, 'r') as f:
+    config: Config = yaml.load(f, yaml.SafeLoader)
+
+  logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+  with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, 'state.db')
+    if args.state:
+      shutil.copyfile(args.state, path)
+    storage = meshmtx.storage.get_engine(path=path)
+    meshmtx.storage.Base.metadata.create_all(storage)
+
+    metrics = Metrics() if args.metrics else NULL_METRICS
+    driver = ReplayDriver(config, storage, metrics, args.engine)
+    report = driver.replay(read_capture(args.capture), paced=args.paced, trace_allocations=args.allocations)
+    driver.close()
+    storage.dispose()
+
+  print(report.summary())
+  if args.metrics:
+    print(metrics.render())
+
+if __name__ == "__main__":
+  main()
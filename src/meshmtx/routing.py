@@ -0,0 +1,284 @@
+import enum
+import itertools
+import logging
+import math
+import threading
+import typing
+
+import meshtastic
+import meshtastic.protobuf
+import numpy as np
+
+from meshmtx.config import ConfigClient, ConfigClientFilter
+from meshmtx.geocoder import NodeEntry, NodeGeocoder
+from meshmtx.spatial import distance
+from meshmtx.utils import PacketUtilities, DEFAULT_MAX_DISTANCE
+
+logger = logging.getLogger('meshmtx:routing')
+
+# nodes per distance matrix when recomputing routes in bulk
+UPDATE_CHUNK_SIZE = 4096
+
+# the hop limit is a 3 bit field
+MAX_HOP_LIMIT = 7
+ALL_HOP_LIMITS = (1 << (MAX_HOP_LIMIT + 1)) - 1
+
+
+class RoutingMode(enum.Enum):
+  CLIENTS = 'clients' # a copy per client within range of the sender
+  GEO = 'geo' # one copy under the sender's region, see meshmtx.topics
+
+
+class ClientFilter:
+  """
+  What a client wants forwarded, compiled at load time: portnums and hop limits into bitmasks, channels and senders into sets. A rule left unset, or an empty list, matches everything. A denied sender is rejected even if `senders` lists it.
+
+  `accepts_header` only reads envelope fields, so it can run before a packet is decrypted. `accepts` also checks the portnum, and a packet whose portnum could not be read does not match a portnum rule.
+  """
+  __slots__ = ('portnums', 'channels', 'hop_limits', 'senders', 'denied')
+
+  portnums: typing.Optional[int]
+  channels: typing.Optional[typing.FrozenSet[str]]
+  hop_limits: int
+  senders: typing.Optional[typing.FrozenSet[int]]
+  denied: typing.FrozenSet[int]
+
+  def __init__(self, config: ConfigClientFilter):
+    self.portnums = None
+    if config.get('portnums'):
+      self.portnums = 0
+      for name in config['portnums']:
+        self.portnums |= 1 << meshtastic.portnums_pb2.PortNum.Value(name)
+    self.channels = frozenset(config['channels']) if config.get('channels') else None
+    low = min(max(config.get('min_hop_limit', 0), 0), MAX_HOP_LIMIT)
+    high = min(max(config.get('max_hop_limit', MAX_HOP_LIMIT), 0), MAX_HOP_LIMIT)
+    # bits low to high set, none if low is above high
+    self.hop_limits = (ALL_HOP_LIMITS >> (MAX_HOP_LIMIT - high)) & ~((1 << low) - 1)
+    self.senders = frozenset(PacketUtilities.node_to_user_id(id) for id in config['senders']) if config.get('senders') else None
+    self.denied = frozenset(PacketUtilities.node_to_user_id(id) for id in config.get('deny') or ())
+
+  def __eq__(self, other) -> bool:
+    return isinstance(other, ClientFilter) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+  def accepts_header(self, sender: int, channel: str, hop_limit: int) -> bool:
+    if sender in self.denied:
+      return False
+    if self.senders is not None and sender not in self.senders:
+      return False
+    if self.channels is not None and channel not in self.channels:
+      return False
+    return bool(self.hop_limits >> min(hop_limit, MAX_HOP_LIMIT) & 1)
+
+  def accepts_portnum(self, portnum: typing.Optional[int]) -> bool:
+    return self.portnums is None or (portnum is not None and bool(self.portnums >> portnum & 1))
+
+  def accepts(self, sender: int, channel: str, hop_limit: int, portnum: typing.Optional[int]) -> bool:
+    return self.accepts_portnum(portnum) and self.accepts_header(sender, channel, hop_limit)
+
+
+class ClientRoute:
+  """
+  A configured client, with its hex id parsed and its filter compiled once at load time.
+  """
+  __slots__ = ('id', 'node_id', 'max_distance', 'filter')
+
+  id: str
+  node_id: int
+  max_distance: int
+  filter: typing.Optional[ClientFilter]
+
+  def __init__(self, client: ConfigClient):
+    self.id = client['id']
+    self.node_id = PacketUtilities.node_to_user_id(client['id'])
+    self.max_distance = client.get('max_distance', DEFAULT_MAX_DISTANCE)
+    self.filter = ClientFilter(client['filter']) if client.get('filter') else None
+
+
+def client_routes(clients: typing.List[ConfigClient]) -> typing.Dict[int, ClientRoute]:
+  """
+  Parses a client list into routes by node id. Raises ValueError on an invalid client, e.g. a filter naming an unknown portnum.
+  """
+  routes: typing.Dict[int, ClientRoute] = {}
+  for client in clients:
+    route = ClientRoute(client)
+    routes[route.node_id] = route
+  return routes
+
+
+def filter_routes(routes: typing.Sequence[ClientRoute], sender: int, channel: str, hop_limit: int, portnum: typing.Optional[int]) -> typing.Sequence[ClientRoute]:
+  """
+  Returns the routes whose client filter accepts a packet, `routes` itself if all do.
+  """
+  accepted = [route for route in routes if route.filter is None or route.filter.accepts(sender, channel, hop_limit, portnum)]
+  return routes if len(accepted) == len(routes) else accepted
+
+
+class RoutingTable:
+  """
+  Maps each known node id to the client queues its packets should be forwarded to.
+
+  Routes are recomputed when a node or a client changes position, so forwarding a packet is a single dictionary lookup.
+  """
+  _geocoder: NodeGeocoder
+  _clients: typing.Dict[int, ClientRoute]
+  _client_list: typing.List[ClientRoute]
+  _client_latitudes: np.ndarray
+  _client_longitudes: np.ndarray
+  _client_distances: np.ndarray
+  _routes: typing.Dict[int, typing.Tuple[ClientRoute, ...]]
+  _members: typing.Dict[int, typing.Set[int]]
+  _lock: threading.Lock
+
+  # whether any client has a filter, so packets skip filtering altogether while none do
+  filtered: bool
+  # whether any filter has a portnum rule, which local packets are only decrypted for
+  filters_portnums: bool
+
+  def __init__(self, clients: typing.List[ConfigClient], geocoder: NodeGeocoder):
+    self._geocoder = geocoder
+    self._clients = {}
+    self._routes = {}
+    self._members = {}
+    self._lock = threading.Lock()
+
+    self._clients = client_routes(clients)
+    self._client_list = list(self._clients.values())
+    self._client_distances = np.array([client.max_distance for client in self._client_list], dtype=np.float64)
+    self._refresh_filters()
+
+    self.rebuild()
+    geocoder.add_listener(self.on_nodes_updated)
+    geocoder.add_eviction_listener(self.on_nodes_evicted)
+
+  def lookup(self, node_id: int) -> typing.Tuple[ClientRoute, ...]:
+    return self._routes.get(node_id, ())
+
+  def routable(self, sender: int, channel: str, hop_limit: int) -> bool:
+    """
+    Whether a packet may be forwarded to any client, judging by its envelope alone.
+    """
+    routes = self._routes.get(sender, ())
+    if not routes or not self.filtered:
+      return bool(routes)
+    return any(route.filter is None or route.filter.accepts_header(sender, channel, hop_limit) for route in routes)
+
+  @property
+  def clients(self) -> typing.List[ClientRoute]:
+    # replaced rather than modified on reload, so a caller may iterate it while clients change
+    return self._client_list
+
+  def update_clients(self, configured: typing.Dict[int, ClientRoute]) -> typing.Tuple[int, int, int]:
+    """
+    Applies a changed client list, parsed with `client_routes`. Only the routes of clients that were added, removed or changed are recomputed. Returns the number of clients added, removed and changed.
+    """
+    with self._lock:
+      merged: typing.Dict[int, ClientRoute] = {}
+      stale: typing.List[ClientRoute] = []
+      fresh: typing.List[ClientRoute] = []
+      refiltered = 0
+      for node_id, route in configured.items():
+        previous = self._clients.get(node_id)
+        if previous is not None and previous.id == route.id and previous.max_distance == route.max_distance:
+          # unchanged clients keep their route objects, which the route sets refer to, so a new filter applies in place
+          if previous.filter != route.filter:
+            previous.filter = route.filter
+            refiltered += 1
+          merged[node_id] = previous
+          continue
+        if previous is not None:
+          stale.append(previous)
+        merged[node_id] = route
+        fresh.append(route)
+      removed = [route for node_id, route in self._clients.items() if node_id not in configured]
+
+      for client in removed + stale:
+        for node_id in list(self._members[client.node_id]):
+          self._routes_without(node_id, client)
+        del self._members[client.node_id]
+      self._clients = merged
+      self._client_list = list(merged.values())
+      self._client_distances = np.array([client.max_distance for client in self._client_list], dtype=np.float64)
+      self._refresh_filters()
+      self._refresh_clients()
+      for client in fresh:
+        self._members[client.node_id] = set()
+        self._update_client(client)
+
+    changed = len(stale)
+    return len(fresh) - changed, len(removed), changed + refiltered
+
+  def rebuild(self):
+    with self._lock:
+      self._refresh_clients()
+      self._routes = {}
+      self._members = {client.node_id: set() for client in self._client_list}
+      for client, latitude, longitude in zip(self._client_list, self._client_latitudes, self._client_longitudes):
+        if math.isnan(latitude):
+          continue
+        for node_id in self._geocoder.index.query_radius(latitude, longitude, client.max_distance).tolist():
+          self._set_routes(node_id, self._routes.get(node_id, ()) + (client,))
+    logger.info(f'built routes for {len(self._routes)} nodes across {len(self._clients)} clients')
+
+  def on_nodes_updated(self, entries: typing.List[NodeEntry]):
+    with self._lock:
+      moved_clients = [self._clients[entry.id] for entry in entries if entry.id in self._clients]
+      if moved_clients:
+        self._refresh_clients()
+
+      self._update_nodes(entries)
+      for client in moved_clients:
+        self._update_client(client)
+
+  def on_nodes_evicted(self, ids: typing.List[int]):
+    # clients are pinned in the node table, so only plain nodes leave and client positions stay valid
+    with self._lock:
+      for node_id in ids:
+        self._set_routes(node_id, ())
+
+  def _refresh_filters(self):
+    self.filtered = any(client.filter is not None for client in self._client_list)
+    self.filters_portnums = any(client.filter is not None and client.filter.portnums is not None for client in self._client_list)
+
+  def _refresh_clients(self):
+    self._client_latitudes, self._client_longitudes = self._geocoder.index.positions([client.node_id for client in self._client_list])
+
+  def _update_nodes(self, entries: typing.List[NodeEntry]):
+    # one distance matrix of nodes x clients per chunk; clients without a position are NaN and never match
+    for start in range(0, len(entries), UPDATE_CHUNK_SIZE):
+      chunk = entries[start:start + UPDATE_CHUNK_SIZE]
+      latitudes = np.array([entry.latitude for entry in chunk], dtype=np.float64)[:, None]
+      longitudes = np.array([entry.longitude for entry in chunk], dtype=np.float64)[:, None]
+      within = distance(latitudes, longitudes, self._client_latitudes, self._client_longitudes) <= self._client_distances
+      for entry, row in zip(chunk, within):
+        self._set_routes(entry.id, tuple(itertools.compress(self._client_list, row)))
+
+  def _update_client(self, client: ClientRoute):
+    # a client moved, so its membership in every other node's route set may have changed
+    row = self._client_list.index(client)
+    latitude = self._client_latitudes[row]
+    longitude = self._client_longitudes[row]
+    if math.isnan(latitude):
+      return
+
+    inside = set(self._geocoder.index.query_radius(latitude, longitude, client.max_distance).tolist())
+    members = self._members[client.node_id]
+    for node_id in inside - members:
+      self._set_routes(node_id, self._routes.get(node_id, ()) + (client,))
+    for node_id in members - inside:
+      self._routes_without(node_id, client)
+
+  def _routes_without(self, node_id: int, client: ClientRoute):
+    self._set_routes(node_id, tuple(route for route in self._routes.get(node_id, ()) if route is not client))
+
+  def _set_routes(self, node_id: int, routes: typing.Tuple[ClientRoute, ...]):
+    previous = self._routes.get(node_id, ())
+    for client in previous:
+      if client not in routes:
+        self._members[client.node_id].discard(node_id)
+    for client in routes:
+      self._members[client.node_id].add(node_id)
+
+    if routes:
+      self._routes[node_id] = routes
+    else:
+      self._routes.pop(node_id, None)
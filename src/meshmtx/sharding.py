@@ -0,0 +1,225 @@
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import typing
+
+from meshmtx.config import Config, ConfigChannel, ConfigSharding
+from meshmtx.crypto import KeyRing, DEFAULT_CHANNELS
+from meshmtx.utils import PacketUtilities
+
+if typing.TYPE_CHECKING:
+  from meshmtx.multiplexer import Multiplexer
+
+logger = logging.getLogger('meshmtx:sharding')
+
+DEFAULT_PROCESSES = 0
+DEFAULT_BATCH_SIZE = 64
+# seconds a partial batch may wait before it is sent on
+BATCH_INTERVAL = 0.01
+# batches waiting for each shard before the remote thread blocks
+SHARD_QUEUE_SIZE = 64
+# batches in flight to the coordinator before shards block
+RESULT_QUEUE_SIZE = 1024
+
+# (topic, payload, received)
+ShardMessage = typing.Tuple[str, bytes, float]
+# (topic, payload, sender, portnum, channel, hop limit, position fix or None, received)
+ShardResult = typing.Tuple[str, bytes, int, int, str, int, typing.Optional[tuple], float]
+
+
+class ShardWorker:
+  """
+  The decrypting half of the first remote broker, running in a worker process. Decodes the messages the remote thread admitted for its shard of the senders and returns compact results to the coordinator, a batch for every batch received.
+  """
+  shard: int
+  _keys: KeyRing
+
+  processed: int = 0
+  undecryptable: int = 0
+
+  def __init__(self, shard: int, channels: typing.List[ConfigChannel]):
+    self.shard = shard
+    self.set_channels(channels)
+
+  def set_channels(self, channels: typing.List[ConfigChannel]):
+    self._keys = KeyRing(channels, default_fallback=True)
+
+  def handle_batch(self, batch: typing.List[ShardMessage]) -> typing.List[ShardResult]:
+    results = []
+    for topic, payload, received in batch:
+      self.processed += 1
+      # scanned again rather than sent along, the envelope is the smaller thing to pickle
+      header = PacketUtilities.scan_envelope(payload)
+      data = PacketUtilities.decode_data(header, self._keys) if header else None
+      if not data:
+        self.undecryptable += 1
+        continue
+      results.append((topic, payload, header.sender, data.portnum, header.channel_id, header.hop_limit, PacketUtilities.position_fix(data), received))
+    return results
+
+
+def _shard_main(shard: int, channels: typing.List[ConfigChannel], messages: multiprocessing.Queue, results: multiprocessing.Queue):
+  # ctrl-c reaches the whole process group, the coordinator shuts the shards down in order instead
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  worker = ShardWorker(shard, channels)
+  results.put(('ready', shard, None))
+  cpu = time.process_time()
+  try:
+    while True:
+      item = messages.get()
+      if item is None:
+        break
+      kind, body = item
+      if kind == 'batch':
+        batch = worker.handle_batch(body)
+        if batch:
+          results.put(('batch', shard, batch))
+      elif kind == 'channels':
+        worker.set_channels(body)
+  finally:
+    results.put(('done', shard, {'processed': worker.processed, 'undecryptable': worker.undecryptable, 'cpu': time.process_time() - cpu}))
+
+
+class ShardedIngest(threading.Thread):
+  """
+  Spreads decryption of the first remote broker's traffic over worker processes, see `ShardWorker`.
+
+  The remote thread still holds the only connection to the broker. It scans each envelope and runs the checks that need no decryption (deduplication, flood control, freshness), then hands what it admits to the shard its sender hashes to through `dispatch`. This thread is the coordinator: it owns the authoritative node positions and routing table, applies the shards' results in arrival order and publishes through the multiplexer's single output stage.
+  """
+  _multiplexer: 'Multiplexer'
+  _processes: typing.List[multiprocessing.Process]
+  _messages: typing.List[multiprocessing.Queue]
+  _results: multiprocessing.Queue
+  _pending: typing.List[typing.List[ShardMessage]]
+  _locks: typing.List[threading.Lock]
+  _batch_size: int
+
+  ready: threading.Event
+  shard_stats: typing.Dict[int, typing.Dict[str, float]]
+  dispatched: int = 0
+  received: int = 0
+  cpu: float = 0.0
+  started_at: typing.Optional[float] = None
+  finished_at: typing.Optional[float] = None
+
+  def __init__(self, config: Config, multiplexer: 'Multiplexer'):
+    threading.Thread.__init__(self, name='sharding:coordinator', daemon=True)
+    sharding_config: ConfigSharding = config.get('sharding', {})
+    processes = sharding_config.get('processes', DEFAULT_PROCESSES)
+    channels = config.get('channels') or DEFAULT_CHANNELS
+
+    self._multiplexer = multiplexer
+    self._batch_size = sharding_config.get('batch_size', DEFAULT_BATCH_SIZE)
+    self.ready = threading.Event()
+    self.shard_stats = {}
+
+    # spawn rather than fork, the parent already runs threads
+    context = multiprocessing.get_context('spawn')
+    self._messages = [context.Queue(SHARD_QUEUE_SIZE) for _ in range(processes)]
+    self._results = context.Queue(RESULT_QUEUE_SIZE)
+    self._pending = [[] for _ in range(processes)]
+    self._locks = [threading.Lock() for _ in range(processes)]
+    self._processes = [
+      context.Process(target=_shard_main, args=(i, channels, self._messages[i], self._results), name=f'shard:{i}', daemon=True)
+      for i in range(processes)
+    ]
+
+  def start(self):
+    for process in self._processes:
+      process.start()
+    threading.Thread.start(self)
+
+  def dispatch(self, topic: str, payload: bytes, sender: int, received: float):
+    """
+    Queues an admitted message for the shard of its sender. Blocks while that shard is a full queue behind.
+    """
+    shard = sender % len(self._processes)
+    with self._locks[shard]:
+      pending = self._pending[shard]
+      pending.append((topic, payload, received))
+      self.dispatched += 1
+      if len(pending) >= self._batch_size:
+        self._pending[shard] = []
+        # under the lock, so a shard gets its batches in the order they were filled
+        self._messages[shard].put(('batch', pending))
+
+  def flush(self, block: bool = True):
+    """
+    Sends the partial batches on. Without blocking, a batch whose shard is a full queue behind is left for the next flush.
+    """
+    for shard, lock in enumerate(self._locks):
+      if not lock.acquire(blocking=block):
+        continue
+      try:
+        pending = self._pending[shard]
+        if not pending:
+          continue
+        try:
+          self._messages[shard].put(('batch', pending), block=block)
+        except queue.Full:
+          continue
+        self._pending[shard] = []
+      finally:
+        lock.release()
+
+  def set_channels(self, channels: typing.List[ConfigChannel]):
+    # queued behind the messages already dispatched, which are still decrypted with the old keys
+    for shard, lock in enumerate(self._locks):
+      with lock:
+        self._messages[shard].put(('channels', channels))
+
+  def run(self):
+    remote = self._multiplexer.remote
+    ready = 0
+    done = 0
+    flushed = time.monotonic()
+    cpu = time.thread_time()
+    while done < len(self._processes):
+      # the coordinator must never wait on a shard, the shard may be waiting on it
+      now = time.monotonic()
+      if now - flushed >= BATCH_INTERVAL:
+        flushed = now
+        self.flush(block=False)
+      try:
+        kind, shard, body = self._results.get(timeout=BATCH_INTERVAL)
+      except queue.Empty:
+        if not any(process.is_alive() for process in self._processes):
+          logger.error('all shard processes exited unexpectedly')
+          return
+        continue
+
+      if kind == 'batch':
+        for topic, payload, sender, portnum, channel, hop_limit, fix, received in body:
+          self.received += 1
+          if fix is not None and not remote.is_redundant_position(sender, fix[0], fix[1]):
+            remote.store_position(sender, *fix)
+          remote.forward(topic, payload, sender, portnum, channel, hop_limit, received, None)
+      elif kind == 'ready':
+        ready += 1
+        if ready == len(self._processes):
+          self.started_at = time.perf_counter()
+          cpu = time.thread_time()
+          self.ready.set()
+          logger.info(f'{ready} shard processes started')
+      elif kind == 'done':
+        done += 1
+        self.shard_stats[shard] = body
+    self.finished_at = time.perf_counter()
+    self.cpu = time.thread_time() - cpu
+
+  def stop(self):
+    """
+    Sends the shards what is still pending and waits until their results are applied. Stop whatever dispatches first.
+    """
+    self.flush()
+    for messages in self._messages:
+      messages.put(None)
+    self.join()
+    for process in self._processes:
+      process.join()
+
+  def stats(self) -> typing.Dict[str, float]:
+    return {'dispatched': self.dispatched, 'received': self.received, 'processes': sum(process.is_alive() for process in self._processes)}
@@ -0,0 +1,222 @@
+import itertools
+import math
+import threading
+import time
+import typing
+
+import numpy as np
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+METRES_PER_DEGREE = 111320.0
+DEFAULT_CELL_DEGREES = 0.5
+
+
+def distance(lat1, lon1, lat2, lon2) -> np.ndarray:
+  """
+  Vectorized ellipsoidal distance in metres between points given in degrees. Inputs are broadcast against each other.
+
+  Uses Lambert's formula, which stays within a few metres of the geodesic over the distances we route across.
+  """
+  lat1 = np.radians(lat1)
+  lat2 = np.radians(lat2)
+  dlon = np.radians(np.subtract(lon2, lon1))
+
+  # reduced latitudes
+  b1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+  b2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+
+  # central angle between the reduced latitudes (haversine)
+  h = np.sin((b2 - b1) / 2) ** 2 + np.cos(b1) * np.cos(b2) * np.sin(dlon / 2) ** 2
+  sigma = 2 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+  p = (b1 + b2) / 2
+  q = (b2 - b1) / 2
+  sin_sigma = np.sin(sigma)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    x = (sigma - sin_sigma) * (np.sin(p) * np.cos(q)) ** 2 / np.cos(sigma / 2) ** 2
+    y = (sigma + sin_sigma) * (np.cos(p) * np.sin(q)) ** 2 / np.sin(sigma / 2) ** 2
+    metres = WGS84_A * (sigma - WGS84_F / 2 * (x + y))
+  return np.where(sigma == 0, 0.0, metres)
+
+
+class NodeIndex:
+  """
+  Columnar store of node positions and last heard times, with a uniform latitude/longitude grid to answer radius queries in bulk.
+  """
+  _cell_degrees: float
+  _lon_cells: int
+  _size: int
+  _ids: np.ndarray
+  _latitudes: np.ndarray
+  _longitudes: np.ndarray
+  _seen: np.ndarray
+  _rows: typing.Dict[int, int]
+  _row_cells: np.ndarray
+  _cells: typing.Dict[int, typing.Set[int]]
+  _lock: threading.RLock
+
+  def __init__(self, capacity: int = 1024, cell_degrees: float = DEFAULT_CELL_DEGREES):
+    self._cell_degrees = cell_degrees
+    self._lon_cells = math.ceil(360 / cell_degrees)
+    self._size = 0
+    self._ids = np.zeros(capacity, dtype=np.int64)
+    self._latitudes = np.zeros(capacity, dtype=np.float64)
+    self._longitudes = np.zeros(capacity, dtype=np.float64)
+    self._seen = np.zeros(capacity, dtype=np.float64)
+    self._rows = {}
+    self._row_cells = np.zeros(capacity, dtype=np.int64)
+    self._cells = {}
+    self._lock = threading.RLock()
+
+  def __len__(self) -> int:
+    return self._size
+
+  def __contains__(self, id: int) -> bool:
+    return id in self._rows
+
+  def _cell(self, latitude: float, longitude: float) -> int:
+    # one int per cell rather than a tuple, so the cell of every row fits in a column
+    return math.floor(latitude / self._cell_degrees) * self._lon_cells + math.floor(longitude / self._cell_degrees) % self._lon_cells
+
+  def _grow(self, needed: int):
+    capacity = len(self._ids)
+    if needed <= capacity:
+      return
+    while capacity < needed:
+      capacity *= 2
+    for name in ('_ids', '_latitudes', '_longitudes', '_seen', '_row_cells'):
+      column = getattr(self, name)
+      grown = np.zeros(capacity, dtype=column.dtype)
+      grown[:self._size] = column[:self._size]
+      setattr(self, name, grown)
+
+  def update(self, id: int, latitude: float, longitude: float, seen: typing.Optional[float] = None):
+    with self._lock:
+      cell = self._cell(latitude, longitude)
+      row = self._rows.get(id)
+      if row is None:
+        self._grow(self._size + 1)
+        row = self._size
+        self._size += 1
+        self._rows[id] = row
+        self._ids[row] = id
+        self._row_cells[row] = cell
+        self._cells.setdefault(cell, set()).add(row)
+      elif self._row_cells[row] != cell:
+        self._move_row(row, cell)
+      self._latitudes[row] = latitude
+      self._longitudes[row] = longitude
+      self._seen[row] = time.monotonic() if seen is None else seen
+
+  def bulk_update(self, ids: typing.Sequence[int], latitudes: typing.Sequence[float], longitudes: typing.Sequence[float], seen: typing.Optional[float] = None):
+    with self._lock:
+      if seen is None:
+        seen = time.monotonic()
+      for id, latitude, longitude in zip(ids, latitudes, longitudes):
+        self.update(id, latitude, longitude, seen)
+
+  def touch(self, id: int, seen: float) -> bool:
+    """
+    Records that a node was heard. Returns False if the node is unknown.
+    """
+    # unlocked, a race with a concurrent removal at worst marks the wrong row, which only skews eviction order
+    row = self._rows.get(id)
+    if row is None:
+      return False
+    self._seen[row] = seen
+    return True
+
+  def seen_before(self, cutoff: float) -> np.ndarray:
+    """
+    Returns the ids of all nodes last heard before the cutoff.
+    """
+    with self._lock:
+      return self._ids[:self._size][self._seen[:self._size] < cutoff]
+
+  def least_recent(self, count: int) -> np.ndarray:
+    """
+    Returns the ids of the `count` nodes heard least recently, oldest first.
+    """
+    with self._lock:
+      seen = self._seen[:self._size]
+      if count < self._size:
+        rows = np.argpartition(seen, count)[:count]
+        rows = rows[np.argsort(seen[rows])]
+      else:
+        rows = np.argsort(seen)
+      return self._ids[rows]
+
+  def remove(self, id: int):
+    with self._lock:
+      row = self._rows.pop(id, None)
+      if row is None:
+        return
+      self._cells[int(self._row_cells[row])].discard(row)
+
+      # swap the last row into the hole to keep the columns dense
+      last = self._size - 1
+      if row != last:
+        last_cell = int(self._row_cells[last])
+        self._cells[last_cell].discard(last)
+        self._cells[last_cell].add(row)
+        self._row_cells[row] = last_cell
+        self._ids[row] = self._ids[last]
+        self._latitudes[row] = self._latitudes[last]
+        self._longitudes[row] = self._longitudes[last]
+        self._seen[row] = self._seen[last]
+        self._rows[int(self._ids[row])] = row
+      self._size = last
+
+  def _move_row(self, row: int, cell: int):
+    self._cells[int(self._row_cells[row])].discard(row)
+    self._cells.setdefault(cell, set()).add(row)
+    self._row_cells[row] = cell
+
+  def _candidate_rows(self, latitude: float, longitude: float, radius_metres: float) -> np.ndarray:
+    span_lat = radius_metres / METRES_PER_DEGREE + self._cell_degrees
+    lat_min = math.floor((latitude - span_lat) / self._cell_degrees)
+    lat_max = math.floor((latitude + span_lat) / self._cell_degrees)
+
+    # longitude degrees shrink towards the poles, so widen the search accordingly
+    edge = min(90.0, abs(latitude) + span_lat)
+    cos_edge = math.cos(math.radians(edge))
+    if cos_edge < 1e-6 or span_lat / cos_edge >= 180:
+      cells = [rows for cell, rows in self._cells.items() if lat_min <= cell // self._lon_cells <= lat_max]
+    else:
+      span_lon = span_lat / cos_edge
+      lon_min = math.floor((longitude - span_lon) / self._cell_degrees)
+      lon_max = math.floor((longitude + span_lon) / self._cell_degrees)
+      cells = []
+      for cell_lat in range(lat_min, lat_max + 1):
+        for cell_lon in range(lon_min, lon_max + 1):
+          rows = self._cells.get(cell_lat * self._lon_cells + cell_lon % self._lon_cells)
+          if rows:
+            cells.append(rows)
+    return np.fromiter(itertools.chain.from_iterable(cells), dtype=np.int64)
+
+  def query_radius(self, latitude: float, longitude: float, radius_metres: float) -> np.ndarray:
+    """
+    Returns the ids of all nodes within the given radius of a point.
+    """
+    with self._lock:
+      rows = self._candidate_rows(latitude, longitude, radius_metres)
+      if not len(rows):
+        return rows
+      metres = distance(latitude, longitude, self._latitudes[rows], self._longitudes[rows])
+      return self._ids[rows[metres <= radius_metres]]
+
+  def positions(self, ids: typing.Sequence[int]) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns latitude and longitude columns for the given ids, NaN where a node is unknown.
+    """
+    with self._lock:
+      rows = np.fromiter((self._rows.get(id, -1) for id in ids), dtype=np.int64, count=len(ids))
+      known = rows >= 0
+      latitudes = np.full(len(ids), np.nan)
+      longitudes = np.full(len(ids), np.nan)
+      latitudes[known] = self._latitudes[rows[known]]
+      longitudes[known] = self._longitudes[rows[known]]
+      return latitudes, longitudes
@@ -0,0 +1,362 @@
+import logging
+import os
+import struct
+import threading
+import time
+import typing
+
+from meshmtx.config import ConfigClient, ConfigSpool
+
+logger = logging.getLogger('meshmtx:spool')
+
+MAGIC = b'MMTXSPL1'
+
+# timestamp, topic length, payload length
+_record = struct.Struct('<dHI')
+
+DEFAULT_SEGMENT_SIZE = 1 << 20 # bytes
+DEFAULT_MAX_BYTES = 64 << 20 # bytes on disk per client
+DEFAULT_TTL = 24 * 3600.0 # seconds
+DEFAULT_DRAIN_RATE = 200.0 # messages per second of catch-up, 0 for no limit
+
+# seconds between checks for expired segments while idle
+IDLE_INTERVAL = 1.0
+# directory for messages whose topic names no client
+OTHER = '_other'
+
+
+class SpoolRecord(typing.NamedTuple):
+  timestamp: float
+  topic: str
+  payload: bytes
+
+
+class ClientSpool:
+  """
+  The spooled messages of one client: numbered segment files in a directory of their own, appended to by the publisher and consumed oldest first by the drainer.
+
+  Segments hold a magic header followed by records of (timestamp, topic, payload), each prefixed by their lengths. A segment is deleted once it has been read to the end, or dropped whole when the client goes over its size cap or the segment is older than the ttl.
+  """
+  id: str
+  _directory: str
+  _segment_size: int
+  _max_bytes: int
+  _ttl: float
+  _segments: typing.List[int]
+  _next_segment: int
+  _writer: typing.Optional[typing.BinaryIO]
+  _written: int
+  _reader: typing.Optional[typing.BinaryIO]
+
+  head: typing.Optional[SpoolRecord]
+  size: int
+  expired: int = 0
+  dropped_bytes: int = 0
+
+  def __init__(self, directory: str, id: str, segment_size: int, max_bytes: int, ttl: float):
+    self.id = id
+    self._directory = directory
+    self._segment_size = segment_size
+    self._max_bytes = max_bytes
+    self._ttl = ttl
+    self._writer = None
+    self._written = 0
+    self._reader = None
+    self.head = None
+
+    os.makedirs(directory, exist_ok=True)
+    self._segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.seg'))
+    self._next_segment = self._segments[-1] + 1 if self._segments else 0
+    self.size = sum(os.path.getsize(self._path(segment)) for segment in self._segments)
+
+  def set_limits(self, max_bytes: int, ttl: float):
+    # a lower cap applies from the next append, a shorter ttl from the next expiry
+    self._max_bytes = max_bytes
+    self._ttl = ttl
+
+  def _path(self, segment: int) -> str:
+    return os.path.join(self._directory, f'{segment:012d}.seg')
+
+  @property
+  def backlog(self) -> bool:
+    return self.head is not None or bool(self._segments)
+
+  @property
+  def segments(self) -> int:
+    return len(self._segments)
+
+  def append(self, timestamp: float, topic: bytes, payload: bytes):
+    if self._writer is None or self._written >= self._segment_size:
+      self._roll()
+    record = _record.pack(timestamp, len(topic), len(payload)) + topic + payload
+    # one unbuffered write per record, so a crash loses at most the record being written
+    self._writer.write(record)
+    self._written += len(record)
+    self.size += len(record)
+    if self.size > self._max_bytes:
+      self._trim()
+
+  def _roll(self):
+    if self._writer is not None:
+      self._writer.close()
+    segment = self._next_segment
+    self._next_segment += 1
+    self._writer = open(self._path(segment), 'wb', buffering=0)
+    self._writer.write(MAGIC)
+    self._written = len(MAGIC)
+    self.size += len(MAGIC)
+    self._segments.append(segment)
+
+  def _trim(self):
+    # the oldest messages go first, never the segment being written
+    dropped = 0
+    while self.size > self._max_bytes and len(self._segments) > 1:
+      dropped += self._remove_oldest()
+    if dropped:
+      self.dropped_bytes += dropped
+      logger.warning(f'spool for {self.id} is over {self._max_bytes} bytes, dropped {dropped} bytes of the oldest messages')
+
+  def _remove_oldest(self) -> int:
+    segment = self._segments.pop(0)
+    path = self._path(segment)
+    if self._reader is not None:
+      self._reader.close()
+      self._reader = None
+      self.head = None
+    if self._writer is not None and not self._segments:
+      self._writer.close()
+      self._writer = None
+    size = os.path.getsize(path)
+    os.remove(path)
+    self.size -= size
+    return size
+
+  def expire(self, now: float) -> int:
+    """
+    Drops the segments last written before the ttl. Returns the bytes dropped.
+    """
+    dropped = 0
+    cutoff = now - self._ttl
+    while self._segments and os.path.getmtime(self._path(self._segments[0])) < cutoff:
+      dropped += self._remove_oldest()
+    self.dropped_bytes += dropped
+    return dropped
+
+  def peek(self) -> typing.Optional[SpoolRecord]:
+    """
+    Returns the oldest unexpired message without consuming it, None if there is none.
+    """
+    cutoff = time.time() - self._ttl
+    while self.head is None:
+      if not self._segments:
+        return None
+      if self._reader is None:
+        self._reader = open(self._path(self._segments[0]), 'rb')
+        if self._reader.read(len(MAGIC)) != MAGIC:
+          logger.error(f'dropping corrupt spool segment {self._path(self._segments[0])}')
+          self.dropped_bytes += self._remove_oldest()
+          continue
+
+      record = self._read()
+      if record is None:
+        # read to the end, or up to a record truncated by a crash
+        self._remove_oldest()
+      elif record.timestamp < cutoff:
+        self.expired += 1
+      else:
+        self.head = record
+    return self.head
+
+  def _read(self) -> typing.Optional[SpoolRecord]:
+    head = self._reader.read(_record.size)
+    if len(head) < _record.size:
+      return None
+    timestamp, topic_length, payload_length = _record.unpack(head)
+    body = self._reader.read(topic_length + payload_length)
+    if len(body) < topic_length + payload_length:
+      return None
+    return SpoolRecord(timestamp, body[:topic_length].decode('utf-8'), body[topic_length:])
+
+  def pop(self, record: SpoolRecord):
+    # the head may have been dropped by a trim while it was being published
+    if self.head is record:
+      self.head = None
+
+  def close(self):
+    for file in (self._reader, self._writer):
+      if file is not None:
+        file.close()
+    self._reader = None
+    self._writer = None
+    self.head = None
+
+
+class Spool(threading.Thread):
+  """
+  Holds messages for the local broker on disk while it is unreachable, and sends them on in their original order once it is back.
+
+  Each client has its own segmented log with its own size cap and ttl, so one busy client cannot push out another's messages. Nothing but the open segment files is held in memory, however long the outage. While a backlog remains, new messages are spooled behind it rather than overtaking it.
+
+  The drain rate only paces catch-up, the messages spooled before the broker came back. Messages spooled behind them since are sent as fast as the broker takes them, so a backlog empties even when live traffic outpaces the drain rate, and the client returns to live publishing.
+
+  Messages are delivered at least once: a segment is only deleted once it has been read to the end, so a crash while draining resends the segment being read from its start.
+  """
+  _directory: str
+  _segment_size: int
+  _max_bytes: int
+  _ttl: float
+  _drain_interval: float
+  _resumed: float
+  _limits: typing.Dict[str, typing.Tuple[int, float]]
+  _clients: typing.Dict[str, ClientSpool]
+  _active: typing.Set[str]
+  _publish: typing.Callable[[str, bytes], bool]
+  _lock: threading.Lock
+  _wakeup: threading.Event
+  _stopping: threading.Event
+
+  spooled: int = 0
+  drained: int = 0
+
+  def __init__(self, config: ConfigSpool, clients: typing.List[ConfigClient], publish: typing.Callable[[str, bytes], bool]):
+    threading.Thread.__init__(self, name='spool:drain', daemon=True)
+    self._directory = config['path']
+    self._segment_size = config.get('segment_size', DEFAULT_SEGMENT_SIZE)
+    self._max_bytes = config.get('max_bytes', DEFAULT_MAX_BYTES)
+    self._ttl = config.get('ttl', DEFAULT_TTL)
+    drain_rate = config.get('drain_rate', DEFAULT_DRAIN_RATE)
+    self._drain_interval = 1 / drain_rate if drain_rate > 0 else 0.0
+    self._resumed = time.time()
+    self._limits = {
+      client['id']: (client.get('spool_max_bytes', self._max_bytes), client.get('spool_ttl', self._ttl))
+      for client in clients
+    }
+    self._publish = publish
+    self._lock = threading.Lock()
+    self._wakeup = threading.Event()
+    self._stopping = threading.Event()
+
+    os.makedirs(self._directory, exist_ok=True)
+    self._clients = {}
+    self._active = set()
+    for name in sorted(os.listdir(self._directory)):
+      if os.path.isdir(os.path.join(self._directory, name)) and self._client(name).backlog:
+        self._active.add(name)
+    backlog = sum(client.size for client in self._clients.values())
+    if backlog:
+      logger.info(f'{backlog} bytes spooled from a previous run will be sent once the local broker is connected')
+
+  def set_clients(self, clients: typing.List[ConfigClient]):
+    """
+    Applies changed per-client limits. Spools of clients no longer configured are still drained.
+    """
+    limits = {
+      client['id']: (client.get('spool_max_bytes', self._max_bytes), client.get('spool_ttl', self._ttl))
+      for client in clients
+    }
+    with self._lock:
+      self._limits = limits
+      for id, client in self._clients.items():
+        client.set_limits(*limits.get(id, (self._max_bytes, self._ttl)))
+
+  def _client(self, id: str) -> ClientSpool:
+    client = self._clients.get(id)
+    if client is None:
+      max_bytes, ttl = self._limits.get(id, (self._max_bytes, self._ttl))
+      client = ClientSpool(os.path.join(self._directory, id), id, self._segment_size, max_bytes, ttl)
+      self._clients[id] = client
+    return client
+
+  @property
+  def backlog(self) -> bool:
+    # checked on every local publish, so this is kept as a set of the clients with spooled messages
+    return bool(self._active)
+
+  def append(self, topic: str, payload: bytes, timestamp: typing.Optional[float] = None):
+    # msh/router/<client id>/...
+    parts = topic.split('/', 3)
+    id = parts[2] if len(parts) > 2 and parts[1] == 'router' else OTHER
+    with self._lock:
+      self._client(id).append(time.time() if timestamp is None else timestamp, topic.encode('utf-8'), payload)
+      self._active.add(id)
+      self.spooled += 1
+
+  def wake(self):
+    """
+    Starts draining, e.g. when the local broker connection comes back. What was spooled until now is caught up at the drain rate.
+    """
+    self._resumed = time.time()
+    self._wakeup.set()
+
+  def run(self):
+    while not self._stopping.is_set():
+      self._wakeup.wait(IDLE_INTERVAL)
+      self._wakeup.clear()
+      self.expire()
+      self.drain()
+
+  def expire(self):
+    now = time.time()
+    with self._lock:
+      for client in self._clients.values():
+        client.expire(now)
+
+  def drain(self) -> int:
+    """
+    Sends spooled messages oldest first across all clients, until the spool is empty or a publish fails. Returns the number of messages sent.
+    """
+    sent = 0
+    next_send = time.monotonic()
+    while not self._stopping.is_set():
+      with self._lock:
+        oldest = None
+        for id in list(self._active):
+          client = self._clients[id]
+          record = client.peek()
+          if record is None:
+            self._active.discard(id)
+          elif oldest is None or record.timestamp < oldest[1].timestamp:
+            oldest = (client, record)
+      if oldest is None:
+        return sent
+
+      client, record = oldest
+      # only catch-up is paced, what arrived since goes out unthrottled
+      catch_up = record.timestamp < self._resumed
+      if catch_up:
+        delay = next_send - time.monotonic()
+        if delay > 0 and self._stopping.wait(delay):
+          return sent
+      if not self._publish(record.topic, record.payload):
+        return sent
+      with self._lock:
+        client.pop(record)
+        self.drained += 1
+      sent += 1
+      if catch_up:
+        next_send = max(next_send + self._drain_interval, time.monotonic())
+    return sent
+
+  def stop(self):
+    """
+    Stops draining. Whatever is left stays on disk for the next run.
+    """
+    self._stopping.set()
+    self._wakeup.set()
+    if self.is_alive():
+      self.join()
+    with self._lock:
+      for client in self._clients.values():
+        client.close()
+
+  def stats(self) -> typing.Dict[str, int]:
+    with self._lock:
+      clients = list(self._clients.values())
+    return {
+      'spooled': self.spooled,
+      'drained': self.drained,
+      'expired': sum(client.expired for client in clients),
+      'dropped_bytes': sum(client.dropped_bytes for client in clients),
+      'bytes': sum(client.size for client in clients),
+      'segments': sum(client.segments for client in clients),
+    }
@@ -1,11 +1,17 @@
 import logging
-from typing import Optional
+import threading
+import time
+from typing import Dict, Optional, Tuple
 from datetime import datetime
-from sqlalchemy import DateTime, Float
+from sqlalchemy import DateTime, Float, String, event
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 from sqlalchemy import create_engine
 
+from meshmtx.metrics import Histogram, Metrics, NULL_METRICS
+
 logger = logging.getLogger('meshmtx:storage')
 
 class Base(DeclarativeBase):
@@ -20,5 +26,184 @@ class NodeState(Base):
   latitude: Mapped[Optional[float]] = mapped_column(Float)
   longitude: Mapped[Optional[float]] = mapped_column(Float)
 
+class GeocodeState(Base):
+  __tablename__ = "geocode"
+
+  # quantized latitude/longitude cell, see meshmtx.gis.CachedBackend
+  cell: Mapped[str] = mapped_column(String(32), primary_key=True)
+  timestamp: Mapped[datetime] = mapped_column(DateTime)
+  address: Mapped[Optional[str]] = mapped_column(String)
+  city: Mapped[Optional[str]] = mapped_column(String)
+  country: Mapped[Optional[str]] = mapped_column(String)
+  country_iso2: Mapped[Optional[str]] = mapped_column(String)
+  country_iso3: Mapped[Optional[str]] = mapped_column(String)
+  neighborhood: Mapped[Optional[str]] = mapped_column(String)
+  postal: Mapped[Optional[str]] = mapped_column(String)
+  region: Mapped[Optional[str]] = mapped_column(String)
+  state: Mapped[Optional[str]] = mapped_column(String)
+
+DEFAULT_FLUSH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 5.0 # seconds
+DEFAULT_MAX_PENDING = 100000 # node positions held while writes fail
+# longest wait between retries of a failing write
+MAX_RETRY_INTERVAL = 60.0 # seconds
+
+def _configure_connection(connection, _record):
+  # WAL lets readers proceed during a flush, and with WAL a NORMAL sync only risks the last
+  # transactions on power loss, which are position updates that will be resent anyway
+  cursor = connection.cursor()
+  cursor.execute('PRAGMA journal_mode=WAL')
+  cursor.execute('PRAGMA synchronous=NORMAL')
+  cursor.close()
+
 def get_engine(path: str = 'state.db', debug: bool = False):
-  return create_engine(f"sqlite:///{path}", echo=debug)
+  engine = create_engine(f"sqlite:///{path}", echo=debug)
+  event.listen(engine, 'connect', _configure_connection)
+  return engine
+
+class PositionWriter(threading.Thread):
+  """
+  Write-behind store for node positions. Updates are coalesced per node in memory, keeping the latest timestamp, and written in a single upsert transaction once enough are pending or the flush interval elapses. A batch that fails to write (e.g. while the database is locked) is merged back and retried after the flush interval, backing off up to `MAX_RETRY_INTERVAL` while writes keep failing. Meanwhile at most `max_pending` nodes are held, positions of further nodes are dropped.
+  """
+  _storage: Engine
+  _flush_size: int
+  _flush_interval: float
+  _max_pending: int
+  _pending: Dict[int, Tuple[datetime, float, float]]
+  _writing: Dict[int, Tuple[datetime, float, float]]
+  _lock: threading.Lock
+  _flushing: threading.Lock
+  _wakeup: threading.Event
+  _stopping: bool
+  _metrics: Metrics
+  _flush_seconds: Histogram
+
+  submitted: int = 0
+  written: int = 0
+  flushes: int = 0
+  failures: int = 0
+  dropped: int = 0
+
+  def __init__(self, storage: Engine, flush_size: int = DEFAULT_FLUSH_SIZE, flush_interval: float = DEFAULT_FLUSH_INTERVAL, max_pending: int = DEFAULT_MAX_PENDING, metrics: Metrics = NULL_METRICS):
+    threading.Thread.__init__(self, name='storage:positions', daemon=True)
+    self._storage = storage
+    self._flush_size = flush_size
+    self._flush_interval = flush_interval
+    self._max_pending = max_pending
+    self._pending = {}
+    self._writing = {}
+    self._lock = threading.Lock()
+    self._flushing = threading.Lock()
+    self._wakeup = threading.Event()
+    self._stopping = False
+    self._metrics = metrics
+    self._flush_seconds = metrics.flush_seconds.labels()
+
+  def submit(self, node_id: int, timestamp: datetime, latitude: float, longitude: float):
+    with self._lock:
+      current = self._pending.get(node_id)
+      if current and current[0] >= timestamp:
+        return
+      if current is None and len(self._pending) >= self._max_pending:
+        # only while writes fail, the node table still has the position
+        self.dropped += 1
+        return
+      self._pending[node_id] = (timestamp, latitude, longitude)
+      self.submitted += 1
+      if len(self._pending) >= self._flush_size:
+        self._wakeup.set()
+
+  def lookup(self, node_id: int) -> Optional[Tuple[datetime, float, float]]:
+    """
+    Returns the pending (timestamp, latitude, longitude) of a node, None if nothing is waiting to be written. A batch being written counts as pending until it is committed.
+    """
+    with self._lock:
+      return self._pending.get(node_id) or self._writing.get(node_id)
+
+  def flush(self) -> bool:
+    """
+    Writes what is pending. Returns False if the write failed and the batch was merged back.
+    """
+    # one batch in flight at a time, so a failed one is merged back before the next is taken
+    with self._flushing:
+      with self._lock:
+        pending = self._pending
+        self._pending = {}
+        self._writing = pending
+      if not pending:
+        return True
+      try:
+        return self._write(pending)
+      finally:
+        with self._lock:
+          self._writing = {}
+
+  def _write(self, pending: Dict[int, Tuple[datetime, float, float]]) -> bool:
+    rows = [{'id': id, 'timestamp': timestamp, 'latitude': latitude, 'longitude': longitude} for id, (timestamp, latitude, longitude) in pending.items()]
+    statement = insert(NodeState)
+    statement = statement.on_conflict_do_update(
+      index_elements=[NodeState.id],
+      set_={'timestamp': statement.excluded.timestamp, 'latitude': statement.excluded.latitude, 'longitude': statement.excluded.longitude},
+      where=NodeState.timestamp < statement.excluded.timestamp,
+    )
+    started = time.perf_counter()
+    try:
+      with self._storage.begin() as connection:
+        connection.execute(statement, rows)
+    except Exception as e:
+      # put back for the next flush, unless a newer position was submitted meanwhile
+      with self._lock:
+        for id, position in pending.items():
+          current = self._pending.get(id)
+          if current is None and len(self._pending) >= self._max_pending:
+            self.dropped += 1
+          elif current is None or current[0] < position[0]:
+            self._pending[id] = position
+        self.failures += 1
+      logger.error(f'failed to store {len(rows)} node positions, {len(self._pending)} now pending, will retry: {e}')
+      return False
+    if self._metrics.enabled:
+      self._flush_seconds.observe(time.perf_counter() - started)
+
+    self.written += len(rows)
+    self.flushes += 1
+    logger.debug(f'stored {len(rows)} node positions')
+    return True
+
+  @property
+  def pending(self) -> int:
+    return len(self._pending)
+
+  @property
+  def flush_size(self) -> int:
+    return self._flush_size
+
+  @property
+  def flush_interval(self) -> float:
+    return self._flush_interval
+
+  def stats(self) -> Dict[str, int]:
+    return {'pending': len(self._pending), 'submitted': self.submitted, 'written': self.written, 'flushes': self.flushes, 'failures': self.failures, 'dropped': self.dropped}
+
+  def run(self):
+    retry = 0.0
+    while not self._stopping:
+      deadline = time.monotonic() + (retry or self._flush_interval)
+      # after a failed write the whole retry interval is waited out, however much is pending
+      while not self._stopping and (retry or len(self._pending) < self._flush_size):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        self._wakeup.wait(remaining)
+        self._wakeup.clear()
+      if self.flush():
+        retry = 0.0
+      else:
+        retry = min(max(retry * 2, self._flush_interval), MAX_RETRY_INTERVAL)
+
+  def stop(self):
+    self._stopping = True
+    self._wakeup.set()
+    if self.is_alive():
+      self.join()
+    self.flush()
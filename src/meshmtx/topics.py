@@ -0,0 +1,160 @@
+import itertools
+import logging
+import typing
+
+from meshmtx.config import ConfigMapping, ConfigQueueImport
+from meshmtx.geocoder import NodeEntry, NodePrecision
+from meshmtx.utils import DEFAULT_FIRMWARE_KEY
+
+logger = logging.getLogger('meshmtx:topics')
+
+# distinct remote topic prefixes remembered before the memo is reset
+DEFAULT_MEMO_SIZE = 8192
+
+# each router tags the region topics it caches on nodes, so a rebuilt router does not read its predecessor's
+_generations = itertools.count(1)
+
+
+class RegionRule:
+  """
+  A node of the import trie, one per region path segment. `channels` maps remote channel names to their local names for topics under exactly this region path.
+  """
+  __slots__ = ('children', 'channels')
+
+  children: typing.Dict[str, 'RegionRule']
+  channels: typing.Dict[str, str]
+
+  def __init__(self):
+    self.children = {}
+    self.channels = {}
+
+
+class TopicPrefix:
+  """
+  A remote topic without its gateway segment, rewritten once. `bases` holds the local topic prefix per client and `regions` per geographic region, filled in as they are published to.
+  """
+  __slots__ = ('suffix', 'bases', 'regions')
+
+  suffix: str
+  bases: typing.Dict[str, str]
+  regions: typing.Dict[str, str]
+
+  def __init__(self, suffix: str):
+    self.suffix = suffix
+    self.bases = {}
+    self.regions = {}
+
+  def base(self, client: str) -> str:
+    base = self.bases.get(client)
+    if base is None:
+      base = self.bases[client] = f'msh/router/{client}/{self.suffix}'
+    return base
+
+  def region_base(self, region: str) -> str:
+    base = self.regions.get(region)
+    if base is None:
+      base = self.regions[region] = f'msh/geo/{region}/{self.suffix}'
+    return base
+
+
+class TopicRouter:
+  """
+  Rewrites remote topics into the local client topics they are forwarded to, and geocoded positions into region topics.
+
+  Imports (region, remote channel, local channel) are compiled into a trie over the region path, so a topic under `msh/EU_868/UK` uses the most specific rule. Topics no import matches keep their channel. The rewrite only depends on the topic without its last (gateway) segment, so it is done once per prefix, and the local prefix once per client, which leaves a split per message and a lookup and concatenation per client.
+
+  Region topics (country/state/city) come from the geocoded position of a node, up to the configured precision. Mappings replace a geocoded state with a short region name, either just the state segment or, with `replace_full`, the whole topic.
+  """
+  _imports: RegionRule
+  _states: typing.Dict[str, typing.Tuple[str, bool]]
+  _precision: NodePrecision
+  _memo: typing.Dict[str, TopicPrefix]
+  _memo_size: int
+
+  generation: int
+
+  def __init__(self, imports: typing.Iterable[ConfigQueueImport] = (), mappings: typing.Iterable[ConfigMapping] = (), precision: NodePrecision = NodePrecision.CITY, memo_size: int = DEFAULT_MEMO_SIZE):
+    self._imports = RegionRule()
+    for rule in imports:
+      node = self._imports
+      for segment in rule['region'].strip('/').split('/'):
+        node = node.children.setdefault(segment, RegionRule())
+      if rule['remote'] in node.channels and node.channels[rule['remote']] != rule['local']:
+        logger.warning(f'import of {rule["region"]}/{rule["remote"]} is configured twice, using {rule["local"]}')
+      node.channels[rule['remote']] = rule['local']
+
+    self._states = {mapping['state']: (mapping['value'], mapping.get('replace_full', False)) for mapping in mappings}
+    self._precision = precision
+    self._memo = {}
+    self._memo_size = memo_size
+    self.generation = next(_generations)
+
+  def resolve(self, topic: str) -> typing.Tuple[TopicPrefix, str]:
+    """
+    Splits a remote topic into its rewritten prefix and the gateway segment. The local topic for a client is `prefix.base(client) + gateway`.
+    """
+    prefix, _, gateway = topic.rpartition('/')
+    rewritten = self._memo.get(prefix)
+    if rewritten is None:
+      rewritten = self._compile(prefix)
+    return rewritten, gateway
+
+  def client_topic(self, client: str, topic: str) -> str:
+    """
+    Returns the local topic a remote topic is forwarded to for a client, e.g. msh/EU_868/2/e/LongFast/!abcdef01 -> msh/router/<client>/2/e/LongFast/!abcdef01.
+    """
+    prefix, gateway = self.resolve(topic)
+    return prefix.base(client) + gateway
+
+  def _compile(self, prefix: str) -> TopicPrefix:
+    segments = prefix.split('/')
+
+    # msh/<region path>/<firmware key>/<type>/<channel>, the deepest region with a rule for the channel wins
+    if DEFAULT_FIRMWARE_KEY in segments[2:]:
+      key = segments.index(DEFAULT_FIRMWARE_KEY, 2)
+      if key + 2 < len(segments):
+        channel = segments[key + 2]
+        local = None
+        rule = self._imports
+        for segment in segments[1:key]:
+          rule = rule.children.get(segment)
+          if rule is None:
+            break
+          local = rule.channels.get(channel, local)
+        if local:
+          segments[key + 2] = local
+
+    # the region prefix is dropped, as the client's queue takes its place
+    rewritten = TopicPrefix(''.join(segment + '/' for segment in segments[2:]))
+    if len(self._memo) >= self._memo_size:
+      self._memo.clear()
+    self._memo[prefix] = rewritten
+    return rewritten
+
+  def geo_topic(self, entry: NodeEntry) -> typing.Optional[str]:
+    """
+    Returns the region topic of a geocoded node, e.g. GB/Scotland/edinburgh, with its state mapped. None if the node is not geocoded.
+
+    The topic is cached on the entry, which drops it when its geocoded location changes. A topic cached by another router, e.g. before mappings were reloaded, is worked out again.
+    """
+    topic = entry.topic
+    if topic is None or entry.topic_generation != self.generation:
+      topic = entry.topic = self._geo_topic(entry)
+      entry.topic_generation = self.generation
+    return topic
+
+  def _geo_topic(self, entry: NodeEntry) -> typing.Optional[str]:
+    topic = entry.get_most_precise_topic(self._precision)
+    if topic is None:
+      return None
+    country = entry.country_iso2 or entry.country_iso3
+    if topic == country:
+      return topic
+    state = entry.state
+    mapping = self._states.get(state) if state else None
+    if mapping is not None:
+      value, replace_full = mapping
+      if replace_full:
+        return value
+      topic = value + topic[len(state):]
+    return f'{country}/{topic}'
@@ -1,34 +1,23 @@
 
 import logging
+import time
 
-import base64
-import cryptography
-import cryptography.hazmat.primitives.ciphers
-import cryptography.hazmat.primitives.ciphers.algorithms
-import cryptography.hazmat.primitives.ciphers.modes
-import cryptography.hazmat.backends
 import meshtastic
 import meshtastic.protobuf
 
-from typing import Optional
+from datetime import datetime
+from typing import Optional, Tuple
+
+from meshmtx.crypto import KeyRing
+from meshmtx.wire import EnvelopeHeader, scan_envelope
 
 logger = logging.getLogger('meshmtx:utils')
 
 
 DEFAULT_FIRMWARE_KEY = "2"
-DEFAULT_CRYPTO_KEY = 'AQ=='
 DEFAULT_MAX_DISTANCE = 80000 # 80 km radius
 
 
-class CryptoUtilities():
-  @staticmethod
-  def expand_key(key: str) -> str:
-    if key == "AQ==":
-      key = "1PG7OiApB1nwvP+rz05pAQ=="
-
-    padded_key = key.ljust(len(key) + ((4 - (len(key) % 4)) % 4), '=')
-    return padded_key.replace('-', '+').replace('_', '/')
-
 class PacketUtilities():
   @staticmethod
   def node_to_user_id(id: str) -> int:
@@ -39,63 +28,75 @@ class PacketUtilities():
     return f'{id:x}'
 
   @staticmethod
-  def decode_envelope(payload: bytes) -> Optional[meshtastic.mqtt_pb2.ServiceEnvelope]:
-    envelope = meshtastic.mqtt_pb2.ServiceEnvelope()
-    try:
-      envelope.ParseFromString(payload)
-    except Exception as e:
-      #logger.error(f"ServiceEnvelope: {str(e)}")
-      return None
-    
+  def scan_envelope(payload: bytes) -> Optional[EnvelopeHeader]:
+    """
+    Reads only the routing fields of an envelope, see `meshmtx.wire`.
+    """
     if len(payload) > meshtastic.mesh_pb2.Constants.DATA_PAYLOAD_LEN:
-      #logger.warn('Message too long: ' + str(len(payload)) + ' bytes long, skipping.')
       return None
-    
-    return envelope
+    return scan_envelope(payload)
   
   @staticmethod
-  def decode_packet(packet, key = DEFAULT_CRYPTO_KEY) -> Optional[meshtastic.mesh_pb2.MeshPacket]:
-    if packet.HasField("encrypted") and not packet.HasField("decoded"):
-      if not PacketUtilities._decode_encrypted_packet(packet, key):
+  def decode_data(header: EnvelopeHeader, keys: KeyRing) -> Optional[meshtastic.mesh_pb2.Data]:
+    """
+    Returns the decoded payload of a packet, decrypting it with the key ring if needed. None if it could not be decrypted or parsed.
+    """
+    if header.encrypted is not None:
+      return keys.decrypt(header.sender, header.id, header.channel, header.encrypted, header.channel_id)
+
+    data = meshtastic.mesh_pb2.Data()
+    if header.decoded is not None:
+      try:
+        data.ParseFromString(header.decoded)
+      except Exception:
         return None
-    return packet
+    return data
   
   @staticmethod
-  def topic_to_node_id(topic: str) -> Optional[str]:
-    topic_split = topic.split('/')[-1]
-    if not topic_split.startswith('!'):
+  def parse_position(data: meshtastic.mesh_pb2.Data) -> Optional[meshtastic.mesh_pb2.Position]:
+    """
+    Returns the position of a position packet. None for other packets, or positions without coordinates.
+    """
+    if data.portnum != meshtastic.portnums_pb2.POSITION_APP:
       return None
-    return topic_split.strip('!')
-
-  @staticmethod
-  def _decode_encrypted_packet(mp, key) -> bool:
-    """Decrypt a meshtastic message."""
-
-    key = CryptoUtilities.expand_key(key)
 
+    position = meshtastic.mesh_pb2.Position()
     try:
-      # Convert key to bytes
-      key_bytes = base64.b64decode(key.encode('ascii'))
-
-      nonce_packet_id = getattr(mp, "id").to_bytes(8, "little")
-      nonce_from_node = getattr(mp, "from").to_bytes(8, "little")
-
-      # Put both parts into a single byte array.
-      nonce = nonce_packet_id + nonce_from_node
+      position.ParseFromString(data.payload)
+    except Exception:
+      return None
 
-      cipher = cryptography.hazmat.primitives.ciphers.Cipher(
-        cryptography.hazmat.primitives.ciphers.algorithms.AES(key_bytes),
-        cryptography.hazmat.primitives.ciphers.modes.CTR(nonce), backend=cryptography.hazmat.backends.default_backend()
-      )
-      decryptor = cipher.decryptor()
-      decrypted_bytes = decryptor.update(getattr(mp, "encrypted")) + decryptor.finalize()
+    # Must have latitude and longitude
+    if position.latitude_i == 0 or position.longitude_i == 0:
+      return None
+    return position
 
-      data = meshtastic.mesh_pb2.Data()
-      data.ParseFromString(decrypted_bytes)
-      mp.decoded.CopyFrom(data)
+  @staticmethod
+  def position_timestamp(position: meshtastic.mesh_pb2.Position) -> datetime:
+    """
+    Returns the best timestamp of a position, now if it has none.
+    """
+    timestamp = time.gmtime()
+    if position.timestamp > 0:
+      timestamp = time.gmtime(position.timestamp)
+    if position.time > 0:
+      timestamp = time.gmtime(position.time)
+    return datetime.fromtimestamp(time.mktime(timestamp))
 
-    except Exception as e:
-      #logger.debug(f'Failed to decrypt packet: {e}\n{mp}')
-      return False
+  @staticmethod
+  def position_fix(data: meshtastic.mesh_pb2.Data) -> Optional[Tuple[float, float, datetime]]:
+    """
+    Returns the latitude, longitude and best timestamp of a position packet. None for other packets, or positions without coordinates.
+    """
+    position = PacketUtilities.parse_position(data)
+    if position is None:
+      return None
+    # Integer to decimal position
+    return position.latitude_i * 1e-7, position.longitude_i * 1e-7, PacketUtilities.position_timestamp(position)
 
-    return True
+  @staticmethod
+  def topic_to_node_id(topic: str) -> Optional[str]:
+    topic_split = topic.split('/')[-1]
+    if not topic_split.startswith('!'):
+      return None
+    return topic_split.strip('!')
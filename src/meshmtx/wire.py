@@ -0,0 +1,238 @@
+import struct
+import typing
+
+import meshtastic
+import meshtastic.protobuf
+from google.protobuf.internal import api_implementation
+
+# protobuf wire types
+VARINT = 0
+I64 = 1
+LEN = 2
+I32 = 5
+
+_fixed32 = struct.Struct('<I')
+
+# with the upb or C++ runtimes a native parse is several times faster than scanning the wire format from Python
+NATIVE_PROTOBUF = api_implementation.Type() != 'python'
+
+
+class EnvelopeHeader:
+  """
+  Routing fields of a ServiceEnvelope and its MeshPacket, as plain attributes so the rest of the pipeline never holds protobuf message objects.
+
+  `encrypted` and `decoded` hold the raw bytes of the respective packet fields, or None if absent. `decoded` is a serialized Data message.
+  """
+  __slots__ = (
+    'channel_id', 'gateway_id',
+    'sender', 'to', 'id', 'channel', 'hop_limit', 'hop_start', 'want_ack', 'via_mqtt', 'rx_time',
+    'encrypted', 'decoded',
+  )
+
+  channel_id: str
+  gateway_id: str
+  sender: int
+  to: int
+  id: int
+  channel: int
+  hop_limit: int
+  hop_start: int
+  want_ack: bool
+  via_mqtt: bool
+  rx_time: int
+  encrypted: typing.Optional[bytes]
+  decoded: typing.Optional[bytes]
+
+  def __init__(self):
+    self.channel_id = ''
+    self.gateway_id = ''
+    self.sender = 0
+    self.to = 0
+    self.id = 0
+    self.channel = 0
+    self.hop_limit = 0
+    self.hop_start = 0
+    self.want_ack = False
+    self.via_mqtt = False
+    self.rx_time = 0
+    self.encrypted = None
+    self.decoded = None
+
+
+def _varint(data: bytes, pos: int) -> typing.Tuple[int, int]:
+  result = 0
+  shift = 0
+  while True:
+    byte = data[pos]
+    pos += 1
+    result |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return result, pos
+    shift += 7
+    if shift >= 64:
+      raise ValueError('varint too long')
+
+
+def _tag(data: bytes, pos: int) -> typing.Tuple[int, int, int]:
+  # like the protobuf runtimes, reject tags that do not fit 32 bits and field number 0
+  tag, pos = _varint(data, pos)
+  if tag >> 32 or tag < 8:
+    raise ValueError(f'invalid tag {tag}')
+  return tag >> 3, tag & 7, pos
+
+
+def _skip(data: bytes, pos: int, wire_type: int) -> int:
+  if wire_type == VARINT:
+    return _varint(data, pos)[1]
+  if wire_type == I64:
+    return pos + 8
+  if wire_type == LEN:
+    length, pos = _varint(data, pos)
+    return pos + length
+  if wire_type == I32:
+    return pos + 4
+  raise ValueError(f'unsupported wire type {wire_type}')
+
+
+def _scan_packet(data: bytes, pos: int, end: int, header: EnvelopeHeader):
+  while pos < end:
+    field, wire_type, pos = _tag(data, pos)
+
+    if wire_type == I32 and field in (1, 2, 6, 7):
+      value = _fixed32.unpack_from(data, pos)[0]
+      pos += 4
+      if field == 1:
+        header.sender = value
+      elif field == 2:
+        header.to = value
+      elif field == 6:
+        header.id = value
+      else:
+        header.rx_time = value
+    elif wire_type == VARINT and field in (3, 9, 10, 14, 15):
+      value, pos = _varint(data, pos)
+      if field == 3:
+        header.channel = value
+      elif field == 9:
+        header.hop_limit = value
+      elif field == 10:
+        header.want_ack = bool(value)
+      elif field == 14:
+        header.via_mqtt = bool(value)
+      else:
+        header.hop_start = value
+    elif wire_type == LEN and field in (4, 5):
+      length, pos = _varint(data, pos)
+      value = data[pos:pos + length]
+      pos += length
+      # decoded and encrypted are a oneof, the last one on the wire wins
+      if field == 4:
+        header.decoded = value
+        header.encrypted = None
+      else:
+        header.encrypted = value
+        header.decoded = None
+    else:
+      pos = _skip(data, pos, wire_type)
+
+  if pos != end:
+    raise ValueError('truncated packet')
+
+
+def scan_envelope_wire(payload: bytes) -> typing.Optional[EnvelopeHeader]:
+  """
+  Scans a serialized ServiceEnvelope for its routing fields in pure Python. Returns None if the payload is malformed.
+
+  Fields it does not read are skipped without being checked, and `decoded` is returned as it is on the wire, so a corrupt Data message is only caught when it is decoded.
+  """
+  header = EnvelopeHeader()
+  end = len(payload)
+  pos = 0
+  try:
+    while pos < end:
+      field, wire_type, pos = _tag(payload, pos)
+
+      if wire_type == LEN and field in (1, 2, 3):
+        length, pos = _varint(payload, pos)
+        if pos + length > end:
+          return None
+        if field == 1:
+          _scan_packet(payload, pos, pos + length, header)
+        elif field == 2:
+          header.channel_id = payload[pos:pos + length].decode('utf-8')
+        else:
+          header.gateway_id = payload[pos:pos + length].decode('utf-8')
+        pos += length
+      else:
+        pos = _skip(payload, pos, wire_type)
+  except (IndexError, ValueError, struct.error, UnicodeDecodeError):
+    return None
+
+  if pos != end:
+    return None
+  return header
+
+
+def scan_sender(payload: bytes) -> typing.Optional[int]:
+  """
+  Reads only the sender of a serialized ServiceEnvelope, None if it has none or the payload is malformed. Far cheaper than a full scan, as the packet and its sender come first in what the firmware sends.
+  """
+  end = len(payload)
+  pos = 0
+  try:
+    while pos < end:
+      field, wire_type, pos = _tag(payload, pos)
+      if wire_type == LEN and field == 1:
+        length, pos = _varint(payload, pos)
+        packet_end = min(pos + length, end)
+        while pos < packet_end:
+          field, wire_type, pos = _tag(payload, pos)
+          if wire_type == I32 and field == 1:
+            return _fixed32.unpack_from(payload, pos)[0]
+          pos = _skip(payload, pos, wire_type)
+      else:
+        pos = _skip(payload, pos, wire_type)
+  except (IndexError, ValueError, struct.error):
+    return None
+  return None
+
+
+def scan_envelope_native(payload: bytes) -> typing.Optional[EnvelopeHeader]:
+  """
+  Reads the routing fields of a serialized ServiceEnvelope through the native protobuf runtime. Returns None if the payload is malformed.
+  """
+  envelope = meshtastic.mqtt_pb2.ServiceEnvelope()
+  try:
+    envelope.ParseFromString(payload)
+  except Exception:
+    return None
+
+  packet = envelope.packet
+  header = EnvelopeHeader()
+  header.channel_id = envelope.channel_id
+  header.gateway_id = envelope.gateway_id
+  header.sender = getattr(packet, 'from')
+  header.to = packet.to
+  header.id = packet.id
+  header.channel = packet.channel
+  header.hop_limit = packet.hop_limit
+  header.hop_start = packet.hop_start
+  header.want_ack = packet.want_ack
+  header.via_mqtt = packet.via_mqtt
+  header.rx_time = packet.rx_time
+
+  variant = packet.WhichOneof('payload_variant')
+  if variant == 'encrypted':
+    header.encrypted = packet.encrypted
+  elif variant == 'decoded':
+    header.decoded = packet.decoded.SerializeToString()
+  return header
+
+
+def scan_envelope(payload: bytes) -> typing.Optional[EnvelopeHeader]:
+  """
+  Reads the routing fields of a serialized ServiceEnvelope, using whichever implementation is faster with the installed protobuf runtime.
+  """
+  if NATIVE_PROTOBUF:
+    return scan_envelope_native(payload)
+  return scan_envelope_wire(payload)
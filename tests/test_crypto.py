@@ -0,0 +1,176 @@
+import base64
+
+import meshtastic
+import meshtastic.protobuf
+import meshtastic.util
+import pytest
+
+from meshmtx.crypto import DEFAULT_KEY_BYTES, MAX_FALLBACK_KEYS, ChannelKey, KeyRing, channel_hash, decode_psk
+
+TEXT = meshtastic.portnums_pb2.TEXT_MESSAGE_APP
+SENDER = 0x10000001
+PACKET_ID = 0x2a
+
+
+def psk(value: str) -> str:
+  """
+  A PSK as the Meshtastic apps write it, built by meshtastic's own parsing of the `--ch-set psk` values.
+  """
+  return base64.b64encode(meshtastic.util.fromPSK(value)).decode()
+
+
+def firmware_key(raw: bytes) -> bytes:
+  # the firmware's expansion of the single byte keys, as meshtastic hashes them
+  if len(raw) == 1:
+    return meshtastic.util.DEFAULT_KEY[:-1] + raw
+  return raw
+
+
+def encrypted_text(key: ChannelKey, text: bytes = b'hello') -> bytes:
+  data = meshtastic.mesh_pb2.Data(portnum=TEXT, payload=text)
+  return key.crypt(SENDER, PACKET_ID, data.SerializeToString())
+
+
+def test_default_key_matches_meshtastic():
+  assert DEFAULT_KEY_BYTES == meshtastic.util.DEFAULT_KEY
+  assert decode_psk(psk('default')) == DEFAULT_KEY_BYTES
+  assert decode_psk('AQ==') == DEFAULT_KEY_BYTES
+
+
+def test_index_zero_is_unencrypted():
+  assert psk('none') == 'AA=='
+  assert decode_psk(psk('none')) == b''
+  key = ChannelKey('LongFast', decode_psk('AA=='))
+  assert key.crypt(SENDER, PACKET_ID, b'plain') == b'plain'
+  # no key bytes, only the name goes into the hash
+  assert key.hash == meshtastic.util.generate_channel_hash('LongFast', b'')
+
+
+@pytest.mark.parametrize('index', [0, 1, 2, 9, 254])
+def test_simple_keys_expand_like_the_firmware(index):
+  value = psk(f'simple{index}')
+  raw = meshtastic.util.fromPSK(f'simple{index}')
+  assert raw == bytes([index + 1])
+  assert decode_psk(value) == firmware_key(raw)
+  assert channel_hash('MediumFast', decode_psk(value)) == meshtastic.util.generate_channel_hash('MediumFast', value)
+
+
+@pytest.mark.parametrize('length, expanded', [(2, 16), (5, 16), (15, 16), (16, 16), (17, 32), (24, 32), (31, 32), (32, 32)])
+def test_short_keys_are_zero_padded(length, expanded):
+  raw = bytes(range(1, length + 1))
+  key = decode_psk(base64.b64encode(raw).decode())
+  assert len(key) == expanded
+  assert key == raw + bytes(expanded - length)
+  # padding with zero bytes leaves the hash as meshtastic computes it
+  assert channel_hash('Private', key) == meshtastic.util.generate_channel_hash('Private', raw)
+
+
+def test_random_keys_pass_through():
+  raw = meshtastic.util.fromPSK('random')
+  assert len(raw) == 32
+  assert meshtastic.util.pskToString(raw) == 'secret'
+  assert decode_psk(base64.b64encode(raw).decode()) == raw
+  assert channel_hash('Private', raw) == meshtastic.util.generate_channel_hash('Private', raw)
+
+
+def test_unpadded_and_url_safe_keys():
+  raw = bytes([0xfb, 0xff, 0xfe]) + bytes(range(13))
+  standard = base64.b64encode(raw).decode()
+  url_safe = base64.urlsafe_b64encode(raw).decode().rstrip('=')
+  assert url_safe != standard.rstrip('=')
+  assert decode_psk(standard) == raw
+  assert decode_psk(standard.rstrip('=')) == raw
+  assert decode_psk(url_safe) == raw
+  assert channel_hash('Private', raw) == meshtastic.util.generate_channel_hash('Private', url_safe + '==')
+
+
+@pytest.mark.parametrize('name, expected', [('LongFast', 8), ('MediumFast', 31)])
+def test_preset_channel_hashes(name, expected):
+  # the hashes meshtastic's own tests pin for the default key
+  assert ChannelKey(name, decode_psk('AQ==')).hash == expected
+
+
+def test_configured_key_decrypts():
+  ring = KeyRing([{'name': 'Private', 'key': psk('simple4')}])
+  key = ChannelKey('Private', decode_psk(psk('simple4')))
+  data = ring.decrypt(SENDER, PACKET_ID, key.hash, encrypted_text(key))
+  assert data.portnum == TEXT and data.payload == b'hello'
+  assert ring.stats() == {'attempts': 1, 'skipped': 0, 'failures': 0}
+
+
+def test_unknown_hash_is_skipped_without_an_attempt():
+  ring = KeyRing([{'name': 'LongFast', 'key': 'AQ=='}])
+  key = ChannelKey('Private', decode_psk(psk('simple4')))
+  assert key.hash not in (ChannelKey('LongFast', DEFAULT_KEY_BYTES).hash,)
+  assert ring.decrypt(SENDER, PACKET_ID, key.hash, encrypted_text(key), 'Private') is None
+  assert ring.stats() == {'attempts': 0, 'skipped': 1, 'failures': 0}
+
+
+def test_default_fallback_for_unconfigured_channel():
+  key = ChannelKey('MyMesh', DEFAULT_KEY_BYTES)
+  assert key.hash == meshtastic.util.generate_channel_hash('MyMesh', 'AQ==')
+  ring = KeyRing([{'name': 'LongFast', 'key': 'AQ=='}], default_fallback=True)
+  assert ring.decrypt(SENDER, PACKET_ID, key.hash, encrypted_text(key), 'MyMesh').payload == b'hello'
+  # the hash must be that of the envelope's channel name under the default key
+  assert ring.decrypt(SENDER, PACKET_ID, key.hash ^ 1, encrypted_text(key), 'MyMesh') is None
+  # and without a channel name there is nothing to fall back to
+  assert ring.decrypt(SENDER, PACKET_ID, key.hash, encrypted_text(key)) is None
+  assert ring.stats() == {'attempts': 1, 'skipped': 2, 'failures': 0}
+
+  strict = KeyRing([{'name': 'LongFast', 'key': 'AQ=='}])
+  assert strict.decrypt(SENDER, PACKET_ID, key.hash, encrypted_text(key), 'MyMesh') is None
+  assert strict.stats() == {'attempts': 0, 'skipped': 1, 'failures': 0}
+
+
+def colliding_private_key(name: str, hash: int) -> str:
+  # a 16 byte key whose last byte is chosen so the channel hashes to `hash`
+  raw = bytes(range(1, 16))
+  last = hash ^ channel_hash(name, raw)
+  assert last
+  return base64.b64encode(raw + bytes([last])).decode()
+
+
+def test_colliding_configured_keys_are_each_tried():
+  first = ChannelKey('Alpha', decode_psk(psk('simple4')))
+  second_psk = colliding_private_key('Beta', first.hash)
+  second = ChannelKey('Beta', decode_psk(second_psk))
+  assert second.hash == first.hash == meshtastic.util.generate_channel_hash('Beta', second_psk)
+
+  ring = KeyRing([{'name': 'Alpha', 'key': psk('simple4')}, {'name': 'Beta', 'key': second_psk}])
+  assert len(ring.keys_for(first.hash)) == 2
+  assert ring.decrypt(SENDER, PACKET_ID, first.hash, encrypted_text(first, b'alpha')).payload == b'alpha'
+  assert ring.decrypt(SENDER, PACKET_ID, first.hash, encrypted_text(second, b'beta')).payload == b'beta'
+
+
+def test_default_fallback_on_a_hash_collision():
+  # an unconfigured default key channel whose hash collides with a configured private channel
+  public = ChannelKey('MyMesh', DEFAULT_KEY_BYTES)
+  private_psk = colliding_private_key('Private', public.hash)
+  private = ChannelKey('Private', decode_psk(private_psk))
+  assert private.hash == public.hash == meshtastic.util.generate_channel_hash('MyMesh', 'AQ==')
+
+  ring = KeyRing([{'name': 'Private', 'key': private_psk}], default_fallback=True)
+  assert ring.decrypt(SENDER, PACKET_ID, public.hash, encrypted_text(private, b'private'), 'Private').payload == b'private'
+  assert ring.decrypt(SENDER, PACKET_ID, public.hash, encrypted_text(public, b'public'), 'MyMesh').payload == b'public'
+  # the configured key is tried first, then the default key once
+  assert ring.stats() == {'attempts': 3, 'skipped': 0, 'failures': 0}
+
+  strict = KeyRing([{'name': 'Private', 'key': private_psk}])
+  assert strict.decrypt(SENDER, PACKET_ID, public.hash, encrypted_text(public, b'public'), 'MyMesh') is None
+  assert strict.stats() == {'attempts': 1, 'skipped': 0, 'failures': 1}
+
+
+def test_configured_default_key_channel_is_not_tried_twice():
+  ring = KeyRing([{'name': 'LongFast', 'key': 'AQ=='}], default_fallback=True)
+  key = ChannelKey('LongFast', DEFAULT_KEY_BYTES)
+  assert ring.decrypt(SENDER, PACKET_ID, key.hash, b'garbage', 'LongFast') is None
+  assert ring.stats() == {'attempts': 1, 'skipped': 0, 'failures': 1}
+
+
+def test_fallback_keys_are_capped():
+  ring = KeyRing([], default_fallback=True)
+  for i in range(MAX_FALLBACK_KEYS + 10):
+    name = f'Mesh{i}'
+    key = ChannelKey(name, DEFAULT_KEY_BYTES)
+    assert ring.decrypt(SENDER, PACKET_ID, key.hash, encrypted_text(key), name).payload == b'hello'
+  assert len(ring._fallback) == MAX_FALLBACK_KEYS
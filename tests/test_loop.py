@@ -0,0 +1,107 @@
+import time
+
+import meshtastic
+import meshtastic.protobuf
+import pytest
+
+import meshmtx.dedup
+import meshmtx.storage
+from meshmtx.crypto import ChannelKey, decode_psk
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.mqtt.loopback import LoopbackBroker
+from meshmtx.utils import PacketUtilities
+
+PACKETS = 20
+CLIENT_BASE = 0x10000000
+REMOTE_SENDER = 0x7ffffff0
+# cap on broker deliveries, so a loop fails the test instead of hanging it
+DELIVERY_LIMIT = 100000
+
+
+def envelope(sender: int, packet_id: int, channel: str = 'LongFast') -> bytes:
+  key = ChannelKey(channel, decode_psk('AQ=='))
+  packet = meshtastic.mesh_pb2.MeshPacket()
+  setattr(packet, 'from', sender)
+  packet.id = packet_id
+  packet.to = 0xffffffff
+  packet.channel = key.hash
+  data = meshtastic.mesh_pb2.Data(portnum=meshtastic.portnums_pb2.TEXT_MESSAGE_APP, payload=b'hello')
+  packet.encrypted = key.crypt(sender, packet_id, data.SerializeToString())
+  return meshtastic.mqtt_pb2.ServiceEnvelope(packet=packet, channel_id=channel, gateway_id=f'!{sender:08x}').SerializeToString()
+
+
+def make_multiplexer(tmp_path, client_count: int, protocol: int, spool: bool = False) -> Multiplexer:
+  config = {
+    'clients': [{'id': PacketUtilities.user_to_node_id(CLIENT_BASE + i), 'max_distance': 10000} for i in range(client_count)],
+    'telemetry': {'id': 'Telemetry', 'key': 'AQ=='},
+    'imports': [],
+    'mqtt': {'local': {'protocol': protocol}, 'remote': {}},
+    'geocoder': {'cache': {'enabled': False}},
+    'pipeline': {'workers': 0},
+  }
+  if spool:
+    config['spool'] = {'path': str(tmp_path / 'spool'), 'drain_rate': 0}
+  storage = meshmtx.storage.get_engine(str(tmp_path / 'state.db'))
+  meshmtx.storage.Base.metadata.create_all(storage)
+  multiplexer = Multiplexer(config, storage)
+  multiplexer.prepare()
+  # clients spread 50 km apart, the remote sender is only in range of the first one
+  for i in range(client_count):
+    multiplexer._geocoder.maybe_update_node(CLIENT_BASE + i, 55.0 + i * 0.5, -3.0)
+  multiplexer._geocoder.maybe_update_node(REMOTE_SENDER, 55.0, -3.0)
+  return multiplexer
+
+
+@pytest.mark.parametrize('protocol', [3, 5])
+@pytest.mark.parametrize('client_count', [2, 10])
+def test_local_uplink_is_fanned_out_once(tmp_path, client_count, protocol):
+  multiplexer = make_multiplexer(tmp_path, client_count, protocol)
+  broker = LoopbackBroker()
+  multiplexer.local.attach_client(broker.client(multiplexer.local.on_message))
+  device = broker.client()
+
+  uplink = PacketUtilities.user_to_node_id(CLIENT_BASE)
+  for i in range(PACKETS):
+    device.publish(f'msh/router/{uplink}/2/e/LongFast/!{uplink}', envelope(CLIENT_BASE, i + 1))
+  ingress = broker.published
+  broker.drain(DELIVERY_LIMIT)
+
+  # one copy to every other client, and the copies coming back are recognised as our own
+  assert broker.published - ingress == PACKETS * (client_count - 1)
+  assert not broker._queue
+
+
+@pytest.mark.parametrize('protocol', [3, 5])
+def test_remote_packet_is_forwarded_once(tmp_path, protocol):
+  multiplexer = make_multiplexer(tmp_path, 10, protocol)
+  broker = LoopbackBroker()
+  multiplexer.local.attach_client(broker.client(multiplexer.local.on_message))
+
+  for i in range(PACKETS):
+    multiplexer.remote.handle_message('msh/EU_868/2/e/LongFast/!abcdef01', envelope(REMOTE_SENDER, i + 1), 0)
+  broker.drain(DELIVERY_LIMIT)
+
+  assert broker.published == PACKETS
+  assert broker.published_topics.keys() == {f'msh/router/{PacketUtilities.user_to_node_id(CLIENT_BASE)}/2/e/LongFast/!abcdef01'}
+
+
+def test_spooled_packet_drained_after_echo_window_is_not_looped(tmp_path, monkeypatch):
+  multiplexer = make_multiplexer(tmp_path, 10, 3, spool=True)
+  broker = LoopbackBroker()
+  multiplexer.local.attach_client(broker.client(multiplexer.local.on_message))
+
+  # the local broker is down, so what is forwarded is spooled
+  multiplexer.local.connected = False
+  for i in range(PACKETS):
+    multiplexer.remote.handle_message('msh/EU_868/2/e/LongFast/!abcdef01', envelope(REMOTE_SENDER, i + 1), 0)
+  assert broker.published == 0
+
+  # back well after the echo window
+  later = time.monotonic() + meshmtx.dedup.DEFAULT_ECHO_WINDOW * 2
+  monkeypatch.setattr(meshmtx.dedup.time, 'monotonic', lambda: later)
+  multiplexer.local.connected = True
+  assert multiplexer.spool.drain() == PACKETS
+  broker.drain(DELIVERY_LIMIT)
+
+  assert broker.published == PACKETS
+  multiplexer.spool.stop()
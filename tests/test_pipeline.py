@@ -0,0 +1,56 @@
+import random
+import threading
+import time
+
+import meshtastic
+import meshtastic.protobuf
+
+from meshmtx.pipeline import Pipeline
+
+
+def envelope(sender: int, packet_id: int) -> bytes:
+  packet = meshtastic.mesh_pb2.MeshPacket(encrypted=b'x')
+  setattr(packet, 'from', sender)
+  packet.id = packet_id
+  return meshtastic.mqtt_pb2.ServiceEnvelope(packet=packet, channel_id='LongFast').SerializeToString()
+
+
+class RecordingHandler:
+  def __init__(self):
+    self.handled = []
+    self.threads = {}
+    self._lock = threading.Lock()
+    self._random = random.Random(1)
+
+  def handle_message(self, topic: str, payload: bytes, received: float):
+    envelope = meshtastic.mqtt_pb2.ServiceEnvelope.FromString(payload)
+    sender = getattr(envelope.packet, 'from')
+    # uneven processing times, so unrelated messages overtake each other
+    time.sleep(self._random.random() * 0.0005)
+    with self._lock:
+      self.handled.append((sender, envelope.packet.id))
+      self.threads.setdefault(sender, set()).add(threading.current_thread().name)
+
+
+def test_messages_of_a_sender_are_handled_in_order():
+  pipeline = Pipeline({'workers': 4})
+  handler = RecordingHandler()
+  pipeline.start()
+  senders = [0x10000000 + i for i in range(16)]
+  for i in range(50):
+    for sender in senders:
+      assert pipeline.submit(handler, 'msh/EU_868/2/e/LongFast/!abcdef01', envelope(sender, i + 1))
+  pipeline.stop()
+
+  assert len(handler.handled) == 50 * len(senders)
+  for sender in senders:
+    assert [id for handled, id in handler.handled if handled == sender] == list(range(1, 51))
+    assert len(handler.threads[sender]) == 1
+  # and the senders are spread over all the workers
+  assert len(set.union(*handler.threads.values())) == 4
+
+
+def test_ingest_queue_size_is_shared_between_workers():
+  pipeline = Pipeline({'workers': 4, 'ingest_queue_size': 100})
+  assert [len(ingest) for ingest in pipeline.ingest] == [0] * 4
+  assert sum(ingest._maxsize for ingest in pipeline.ingest) == 100
@@ -0,0 +1,58 @@
+import pytest
+
+import meshmtx.storage
+from meshmtx.multiplexer import Multiplexer
+from meshmtx.utils import PacketUtilities
+
+CLIENT_BASE = 0x10000000
+
+
+def client(i: int, **settings) -> dict:
+  return {'id': PacketUtilities.user_to_node_id(CLIENT_BASE + i), 'max_distance': 10000, **settings}
+
+
+def make_multiplexer(tmp_path, clients) -> Multiplexer:
+  config = {
+    'clients': clients,
+    'telemetry': {'id': 'Telemetry', 'key': 'AQ=='},
+    'imports': [],
+    'mqtt': {'local': {}, 'remote': {}},
+    'geocoder': {'cache': {'enabled': False}},
+    'pipeline': {'workers': 2},
+  }
+  storage = meshmtx.storage.get_engine(str(tmp_path / 'state.db'))
+  meshmtx.storage.Base.metadata.create_all(storage)
+  multiplexer = Multiplexer(config, storage)
+  multiplexer.prepare()
+  return multiplexer
+
+
+def test_reload_updates_output_clients(tmp_path):
+  multiplexer = make_multiplexer(tmp_path, [client(0), client(1)])
+  output = multiplexer.output
+  config = multiplexer._config
+  added, kept = client(2), client(0)
+
+  multiplexer.reload({**config, 'clients': [kept, added]})
+  # a new client's queue is kept while idle, a removed client's queue is gone
+  assert output._clients == {kept['id'], added['id']}
+  assert set(output._queues) == {kept['id'], added['id']}
+
+  output.publish(added['id'], f'msh/router/{added["id"]}', b'x')
+  output._take()
+  assert added['id'] in output._queues
+  assert output.evicted_dropped == 0
+
+
+def test_invalid_client_leaves_the_running_config(tmp_path):
+  multiplexer = make_multiplexer(tmp_path, [client(0), client(1)])
+  config = multiplexer._config
+  pinned = set(multiplexer._geocoder.pinned)
+  routes = list(multiplexer.routing.clients)
+
+  with pytest.raises(ValueError):
+    multiplexer.reload({**config, 'clients': [client(0), client(2, filter={'portnums': ['NOT_A_PORTNUM']})]})
+  assert set(multiplexer._geocoder.pinned) == pinned
+  assert list(multiplexer.routing.clients) == routes
+  assert multiplexer.output._clients == {client(0)['id'], client(1)['id']}
+  assert multiplexer._config is config
@@ -0,0 +1,98 @@
+import meshtastic
+import meshtastic.protobuf
+import pytest
+
+from meshmtx.routing import MAX_HOP_LIMIT, ClientFilter, ClientRoute, filter_routes
+from meshmtx.utils import PacketUtilities
+
+TEXT = meshtastic.portnums_pb2.TEXT_MESSAGE_APP
+POSITION = meshtastic.portnums_pb2.POSITION_APP
+TELEMETRY = meshtastic.portnums_pb2.TELEMETRY_APP
+SENDER = 0x10000001
+OTHER = 0x10000002
+
+
+def accepted_hop_limits(config) -> list:
+  rule = ClientFilter(config)
+  return [hop_limit for hop_limit in range(MAX_HOP_LIMIT + 3) if rule.accepts(SENDER, 'LongFast', hop_limit, TEXT)]
+
+
+@pytest.mark.parametrize('config, expected', [
+  ({}, list(range(MAX_HOP_LIMIT + 3))),
+  ({'min_hop_limit': 2}, list(range(2, MAX_HOP_LIMIT + 3))),
+  ({'max_hop_limit': 3}, [0, 1, 2, 3]),
+  ({'min_hop_limit': 2, 'max_hop_limit': 4}, [2, 3, 4]),
+  ({'min_hop_limit': 3, 'max_hop_limit': 3}, [3]),
+  ({'min_hop_limit': 0, 'max_hop_limit': 0}, [0]),
+  ({'min_hop_limit': MAX_HOP_LIMIT}, [MAX_HOP_LIMIT, MAX_HOP_LIMIT + 1, MAX_HOP_LIMIT + 2]),
+  # bounds out of range are clamped, and an empty range accepts nothing
+  ({'min_hop_limit': -1, 'max_hop_limit': 20}, list(range(MAX_HOP_LIMIT + 3))),
+  ({'min_hop_limit': 5, 'max_hop_limit': 2}, []),
+])
+def test_hop_limit_bounds(config, expected):
+  # hop limits above the maximum count as the maximum
+  assert accepted_hop_limits(config) == expected
+
+
+@pytest.mark.parametrize('rule', ['portnums', 'channels', 'senders'])
+def test_empty_rule_is_the_same_as_unset(rule):
+  unset = ClientFilter({})
+  empty = ClientFilter({rule: []})
+  assert empty == unset
+  assert empty.accepts(SENDER, 'LongFast', 3, TEXT)
+  assert empty.accepts(SENDER, 'LongFast', 3, None)
+
+
+def test_portnum_rule():
+  rule = ClientFilter({'portnums': ['TEXT_MESSAGE_APP', 'POSITION_APP']})
+  assert rule.accepts(SENDER, 'LongFast', 3, TEXT)
+  assert rule.accepts(SENDER, 'LongFast', 3, POSITION)
+  assert not rule.accepts(SENDER, 'LongFast', 3, TELEMETRY)
+  # a packet that could not be decrypted has no portnum, and does not match
+  assert not rule.accepts(SENDER, 'LongFast', 3, None)
+  assert rule.accepts_header(SENDER, 'LongFast', 3)
+
+
+def test_unknown_portnum_is_rejected():
+  with pytest.raises(ValueError):
+    ClientFilter({'portnums': ['NOT_A_PORTNUM']})
+
+
+def test_channel_and_sender_rules():
+  rule = ClientFilter({'channels': ['LongFast'], 'senders': [PacketUtilities.user_to_node_id(SENDER)]})
+  assert rule.accepts(SENDER, 'LongFast', 3, TEXT)
+  assert not rule.accepts(SENDER, 'MediumFast', 3, TEXT)
+  assert not rule.accepts(OTHER, 'LongFast', 3, TEXT)
+
+
+def test_deny_takes_precedence_over_allow():
+  denied = PacketUtilities.user_to_node_id(SENDER)
+  rule = ClientFilter({'senders': [denied, PacketUtilities.user_to_node_id(OTHER)], 'deny': [denied]})
+  assert not rule.accepts(SENDER, 'LongFast', 3, TEXT)
+  assert not rule.accepts_header(SENDER, 'LongFast', 3)
+  assert rule.accepts(OTHER, 'LongFast', 3, TEXT)
+
+  # and without an allow list, everyone else gets through
+  rule = ClientFilter({'deny': [denied]})
+  assert not rule.accepts(SENDER, 'LongFast', 3, TEXT)
+  assert rule.accepts(OTHER, 'LongFast', 3, TEXT)
+
+
+def make_routes():
+  return (
+    ClientRoute({'id': '00000001'}),
+    ClientRoute({'id': '00000002', 'filter': {'portnums': ['TEXT_MESSAGE_APP']}}),
+    ClientRoute({'id': '00000003', 'filter': {'max_hop_limit': 2}}),
+  )
+
+
+def test_filter_routes_returns_the_same_sequence_when_all_accept():
+  routes = make_routes()
+  assert filter_routes(routes, SENDER, 'LongFast', 1, TEXT) is routes
+
+
+def test_filter_routes_keeps_the_accepting_routes_in_order():
+  routes = make_routes()
+  assert [route.id for route in filter_routes(routes, SENDER, 'LongFast', 3, TEXT)] == ['00000001', '00000002']
+  assert [route.id for route in filter_routes(routes, SENDER, 'LongFast', 1, POSITION)] == ['00000001', '00000003']
+  assert [route.id for route in filter_routes(routes, SENDER, 'LongFast', 3, None)] == ['00000001']
@@ -0,0 +1,74 @@
+import random
+
+import geopy.distance
+import numpy as np
+import pytest
+
+from meshmtx.spatial import NodeIndex, distance
+
+
+def random_pairs(seed: int, count: int, spread: float):
+  rng = random.Random(seed)
+  for _ in range(count):
+    lat1, lon1 = rng.uniform(-80, 80), rng.uniform(-180, 180)
+    lat2 = max(-89.0, min(89.0, lat1 + rng.uniform(-spread, spread)))
+    lon2 = lon1 + rng.uniform(-spread, spread)
+    yield lat1, lon1, lat2, lon2
+
+
+def test_regional_distances_match_geodesic():
+  # the distances clients are routed across, within a metre
+  for lat1, lon1, lat2, lon2 in random_pairs(1, 1000, 2):
+    expected = geopy.distance.geodesic((lat1, lon1), (lat2, lon2)).meters
+    assert float(distance(lat1, lon1, lat2, lon2)) == pytest.approx(expected, abs=1.0)
+
+
+def test_long_distances_match_geodesic():
+  for lat1, lon1, lat2, lon2 in random_pairs(2, 1000, 60):
+    expected = geopy.distance.geodesic((lat1, lon1), (lat2, lon2)).meters
+    assert float(distance(lat1, lon1, lat2, lon2)) == pytest.approx(expected, rel=1e-5)
+
+
+@pytest.mark.parametrize('a, b', [
+  ((10.0, 179.9), (10.0, -179.9)), # across the antimeridian
+  ((0.0, 0.0), (0.0, 0.5)), # along the equator
+  ((0.0, 10.0), (1.0, 10.0)), # along a meridian
+  ((89.5, 0.0), (89.5, 90.0)), # near a pole
+])
+def test_edge_cases_match_geodesic(a, b):
+  expected = geopy.distance.geodesic(a, b).meters
+  assert float(distance(a[0], a[1], b[0], b[1])) == pytest.approx(expected, abs=1.0)
+
+
+def test_same_point_is_zero():
+  assert float(distance(55.95, -3.19, 55.95, -3.19)) == 0.0
+
+
+def test_distance_broadcasts():
+  latitudes = np.array([55.0, 56.0, 57.0])[:, None]
+  longitudes = np.array([-3.0, -3.0, -3.0])[:, None]
+  result = distance(latitudes, longitudes, np.array([55.0, 60.0]), np.array([-3.0, -3.0]))
+  assert result.shape == (3, 2)
+  for i in range(3):
+    for j, (latitude, longitude) in enumerate([(55.0, -3.0), (60.0, -3.0)]):
+      expected = geopy.distance.geodesic((latitudes[i, 0], longitudes[i, 0]), (latitude, longitude)).meters
+      assert result[i, j] == pytest.approx(expected, abs=1.0)
+
+
+def test_query_radius_matches_geodesic_scan():
+  rng = np.random.default_rng(3)
+  count = 2000
+  latitudes = rng.uniform(54, 57, count)
+  longitudes = rng.uniform(-5, -1, count)
+  index = NodeIndex()
+  index.bulk_update(list(range(count)), latitudes.tolist(), longitudes.tolist())
+
+  radius = 30000
+  for origin in range(0, count, 200):
+    center = (latitudes[origin], longitudes[origin])
+    expected = {id for id in range(count) if geopy.distance.geodesic(center, (latitudes[id], longitudes[id])).meters <= radius - 1}
+    found = set(index.query_radius(center[0], center[1], radius).tolist())
+    # nodes within a metre of the edge may fall either way
+    assert expected <= found
+    for id in found - expected:
+      assert geopy.distance.geodesic(center, (latitudes[id], longitudes[id])).meters <= radius + 1
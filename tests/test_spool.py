@@ -0,0 +1,184 @@
+import os
+import time
+
+from meshmtx.spool import MAGIC, ClientSpool, Spool
+
+NOW = time.time()
+
+
+def make_client(tmp_path, segment_size: int = 1 << 20, max_bytes: int = 1 << 30, ttl: float = 3600.0) -> ClientSpool:
+  return ClientSpool(str(tmp_path / 'client'), 'client', segment_size, max_bytes, ttl)
+
+
+def read_all(client: ClientSpool) -> list:
+  records = []
+  while True:
+    record = client.peek()
+    if record is None:
+      return records
+    records.append(record)
+    client.pop(record)
+
+
+def test_records_are_read_back_in_order(tmp_path):
+  client = make_client(tmp_path)
+  for i in range(10):
+    client.append(NOW + i, f'msh/router/client/{i}'.encode(), bytes([i]) * i)
+
+  # peeking does not consume
+  assert client.peek() is client.peek()
+  records = read_all(client)
+  assert [(record.timestamp, record.topic, record.payload) for record in records] == [(NOW + i, f'msh/router/client/{i}', bytes([i]) * i) for i in range(10)]
+  assert not client.backlog
+  assert client.segments == 0
+
+
+def test_segments_survive_a_restart(tmp_path):
+  client = make_client(tmp_path, segment_size=64)
+  for i in range(10):
+    client.append(NOW + i, b'topic', b'payload')
+  client.close()
+  assert make_client(tmp_path).segments > 1
+
+  reopened = make_client(tmp_path, segment_size=64)
+  assert reopened.backlog
+  assert [record.timestamp for record in read_all(reopened)] == [NOW + i for i in range(10)]
+
+
+def test_size_cap_drops_the_oldest_segments(tmp_path):
+  client = make_client(tmp_path, segment_size=100, max_bytes=300)
+  for i in range(20):
+    client.append(NOW + i, b'topic', b'x' * 20)
+
+  assert client.size <= 300
+  assert client.dropped_bytes > 0
+  assert client.size == sum(os.path.getsize(os.path.join(tmp_path, 'client', name)) for name in os.listdir(tmp_path / 'client'))
+  # what is left is the newest messages, still in order
+  timestamps = [record.timestamp for record in read_all(client)]
+  assert timestamps == sorted(timestamps)
+  assert timestamps[-1] == NOW + 19
+  assert timestamps[0] > NOW
+
+
+def test_size_cap_keeps_the_segment_being_written(tmp_path):
+  client = make_client(tmp_path, segment_size=1 << 20, max_bytes=10)
+  client.append(NOW, b'topic', b'x' * 100)
+  assert client.segments == 1
+  assert [record.payload for record in read_all(client)] == [b'x' * 100]
+
+
+def test_expired_segments_and_records_are_dropped(tmp_path):
+  # a segment per record
+  client = make_client(tmp_path, segment_size=30, ttl=60.0)
+  client.append(NOW - 120, b'old', b'payload')
+  client.append(NOW - 120, b'old', b'payload')
+  client.append(NOW, b'new', b'payload')
+
+  # segments last written before the ttl go whole
+  directory = tmp_path / 'client'
+  oldest = sorted(os.listdir(directory))[0]
+  os.utime(directory / oldest, (NOW - 120, NOW - 120))
+  assert client.expire(NOW) > 0
+  assert client.segments == 2
+
+  # and records older than the ttl are skipped when read
+  assert [record.topic for record in read_all(client)] == ['new']
+  assert client.expired == 1
+
+
+def test_record_truncated_by_a_crash_is_dropped(tmp_path):
+  client = make_client(tmp_path)
+  for i in range(3):
+    client.append(NOW + i, b'topic', b'payload')
+  client.close()
+  [segment] = os.listdir(tmp_path / 'client')
+  path = tmp_path / 'client' / segment
+  os.truncate(path, os.path.getsize(path) - 3)
+
+  reopened = make_client(tmp_path)
+  assert [record.timestamp for record in read_all(reopened)] == [NOW, NOW + 1]
+  assert not reopened.backlog
+
+
+def test_corrupt_segment_is_dropped(tmp_path):
+  directory = tmp_path / 'client'
+  os.makedirs(directory)
+  (directory / f'{0:012d}.seg').write_bytes(b'NOTASPOOL' + bytes(20))
+  client = make_client(tmp_path)
+  client.append(NOW, b'topic', b'payload')
+
+  assert (directory / f'{1:012d}.seg').read_bytes().startswith(MAGIC)
+  assert [record.topic for record in read_all(client)] == ['topic']
+  assert client.dropped_bytes > 0
+
+
+def make_spool(tmp_path, published: list, drain_rate: float = 0, fail_after: int = -1) -> Spool:
+  def publish(topic: str, payload: bytes) -> bool:
+    if len(published) == fail_after:
+      return False
+    published.append((topic, payload))
+    return True
+  return Spool({'path': str(tmp_path / 'spool'), 'drain_rate': drain_rate}, [{'id': 'a'}, {'id': 'b', 'spool_max_bytes': 1 << 20}], publish)
+
+
+def test_drain_sends_oldest_first_across_clients(tmp_path):
+  published = []
+  spool = make_spool(tmp_path, published)
+  order = [('a', 1), ('b', 2), ('b', 3), ('a', 4), ('c', 5), ('a', 6)]
+  for id, i in order:
+    spool.append(f'msh/router/{id}/{i}', bytes([i]), timestamp=NOW - 10 + i)
+  # not a client topic
+  spool.append('msh/other', b'\x07', timestamp=NOW - 10 + 7)
+
+  assert spool.backlog
+  assert spool.drain() == 7
+  assert [payload[0] for _, payload in published] == [1, 2, 3, 4, 5, 6, 7]
+  assert not spool.backlog
+  assert spool.stats()['drained'] == 7
+  spool.stop()
+
+
+def test_failed_publish_stops_draining_and_keeps_the_message(tmp_path):
+  published = []
+  spool = make_spool(tmp_path, published, fail_after=2)
+  for i in range(5):
+    spool.append('msh/router/a', bytes([i]), timestamp=NOW - 10 + i)
+
+  assert spool.drain() == 2
+  assert spool.backlog
+  published.clear()
+  assert spool.drain() == 2
+  assert [payload[0] for _, payload in published] == [2, 3]
+  spool.stop()
+
+
+def test_only_catch_up_is_paced(tmp_path):
+  published = []
+  spool = make_spool(tmp_path, published, drain_rate=100)
+  spool.wake()
+  # spooled before the broker came back, at most 100 per second
+  for i in range(10):
+    spool.append('msh/router/a', b'x', timestamp=time.time() - 1)
+  started = time.monotonic()
+  assert spool.drain() == 10
+  assert time.monotonic() - started >= 0.08
+
+  # spooled behind them since, sent as fast as the broker takes them
+  for i in range(50):
+    spool.append('msh/router/a', b'x')
+  started = time.monotonic()
+  assert spool.drain() == 50
+  assert time.monotonic() - started < 0.25
+  spool.stop()
+
+
+def test_spool_from_a_previous_run_is_drained(tmp_path):
+  published = []
+  spool = make_spool(tmp_path, published)
+  spool.append('msh/router/a', b'x', timestamp=NOW)
+  spool.stop()
+
+  restarted = make_spool(tmp_path, published)
+  assert restarted.backlog
+  assert restarted.drain() == 1
+  restarted.stop()
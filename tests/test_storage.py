@@ -0,0 +1,43 @@
+import time
+from datetime import datetime, timedelta
+
+import meshmtx.storage
+from meshmtx.storage import PositionWriter
+
+NOW = datetime(2026, 1, 1)
+
+
+def test_failed_write_is_retried_after_the_interval(tmp_path):
+  # no tables yet, so every write fails
+  storage = meshmtx.storage.get_engine(str(tmp_path / 'state.db'))
+  writer = PositionWriter(storage, flush_size=1, flush_interval=0.05, max_pending=10)
+  writer.start()
+  for id in range(20):
+    writer.submit(id, NOW, 55.0, -3.0)
+  time.sleep(0.5)
+
+  # 0.05, 0.1, 0.2 and so on rather than as fast as the database fails, however much is pending
+  assert 1 <= writer.failures <= 5
+  assert writer.pending == 10
+  assert writer.dropped == 10
+
+  meshmtx.storage.Base.metadata.create_all(storage)
+  writer.stop()
+  assert writer.pending == 0
+  assert writer.written == 10
+
+
+def test_newer_position_submitted_during_a_failure_is_kept(tmp_path):
+  storage = meshmtx.storage.get_engine(str(tmp_path / 'state.db'))
+  writer = PositionWriter(storage)
+  writer.submit(1, NOW, 55.0, -3.0)
+  writer.submit(2, NOW, 56.0, -3.0)
+  assert not writer.flush()
+  writer.submit(1, NOW + timedelta(minutes=1), 57.0, -3.0)
+  assert writer.lookup(1) == (NOW + timedelta(minutes=1), 57.0, -3.0)
+  assert writer.lookup(2) == (NOW, 56.0, -3.0)
+
+  meshmtx.storage.Base.metadata.create_all(storage)
+  assert writer.flush()
+  assert writer.lookup(1) is None
+  assert writer.written == 2
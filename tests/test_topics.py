@@ -0,0 +1,91 @@
+import pytest
+
+from meshmtx.geocoder import NodeEntry, NodePrecision
+from meshmtx.gis import GeocodeResult
+from meshmtx.topics import TopicRouter
+
+IMPORTS = [
+  {'region': 'EU_868', 'remote': 'LongFast', 'local': 'Europe'},
+  {'region': 'EU_868/UK', 'remote': 'LongFast', 'local': 'Britain'},
+  {'region': 'EU_868/UK', 'remote': 'MediumFast', 'local': 'BritainMedium'},
+]
+
+
+def node(**fields) -> NodeEntry:
+  entry = NodeEntry(1, 55.95, -3.19)
+  entry.gis = GeocodeResult(**fields)
+  return entry
+
+
+@pytest.mark.parametrize('topic, expected', [
+  # the region segment is replaced by the client's queue, and the channel renamed by the most specific import
+  ('msh/EU_868/2/e/LongFast/!abcdef01', 'msh/router/!client/2/e/Europe/!abcdef01'),
+  ('msh/EU_868/UK/2/e/LongFast/!abcdef01', 'msh/router/!client/UK/2/e/Britain/!abcdef01'),
+  # a nested region without a rule of its own uses its parent's
+  ('msh/EU_868/DE/2/e/LongFast/!abcdef01', 'msh/router/!client/DE/2/e/Europe/!abcdef01'),
+  # and a nested rule for another channel does not hide the parent's
+  ('msh/EU_868/UK/2/e/MediumFast/!abcdef01', 'msh/router/!client/UK/2/e/BritainMedium/!abcdef01'),
+  ('msh/EU_868/2/e/MediumFast/!abcdef01', 'msh/router/!client/2/e/MediumFast/!abcdef01'),
+  # channels and regions no import matches pass through unchanged
+  ('msh/EU_868/2/e/ShortFast/!abcdef01', 'msh/router/!client/2/e/ShortFast/!abcdef01'),
+  ('msh/US/2/e/LongFast/!abcdef01', 'msh/router/!client/2/e/LongFast/!abcdef01'),
+  ('msh/EU_868/2/json/LongFast/!abcdef01', 'msh/router/!client/2/json/Europe/!abcdef01'),
+  # without the firmware key segment there is no channel to rename
+  ('msh/EU_868/LongFast/!abcdef01', 'msh/router/!client/LongFast/!abcdef01'),
+  ('msh/EU_868/2/e', 'msh/router/!client/2/e'),
+])
+def test_client_topic(topic, expected):
+  router = TopicRouter(IMPORTS)
+  assert router.client_topic('!client', topic) == expected
+  # and again from the memo
+  assert router.client_topic('!client', topic) == expected
+
+
+def test_resolve_splits_off_the_gateway():
+  router = TopicRouter(IMPORTS)
+  prefix, gateway = router.resolve('msh/EU_868/2/e/LongFast/!abcdef01')
+  assert gateway == '!abcdef01'
+  assert prefix.base('!a') == 'msh/router/!a/2/e/Europe/'
+  assert prefix.region_base('GB/Scot') == 'msh/geo/GB/Scot/2/e/Europe/'
+  assert router.resolve('msh/EU_868/2/e/LongFast/!12345678')[0] is prefix
+
+
+def test_memo_is_bounded():
+  router = TopicRouter(IMPORTS, memo_size=4)
+  for region in 'ABCDEFGHIJ':
+    assert router.client_topic('!client', f'msh/EU_868/{region}/2/e/LongFast/!abcdef01') == f'msh/router/!client/{region}/2/e/Europe/!abcdef01'
+  assert len(router._memo) <= 4
+
+
+@pytest.mark.parametrize('precision, fields, expected', [
+  (NodePrecision.CITY, {'country_iso2': 'GB', 'state': 'Scotland', 'city': 'Edinburgh'}, 'GB/Scotland/edinburgh'),
+  (NodePrecision.STATE, {'country_iso2': 'GB', 'state': 'Scotland', 'city': 'Edinburgh'}, 'GB/Scotland'),
+  (NodePrecision.COUNTRY, {'country_iso2': 'GB', 'state': 'Scotland', 'city': 'Edinburgh'}, 'GB'),
+  # the most precise level available, up to the configured precision
+  (NodePrecision.CITY, {'country_iso2': 'GB', 'state': 'Scotland'}, 'GB/Scotland'),
+  (NodePrecision.CITY, {'country_iso3': 'GBR'}, 'GBR'),
+  (NodePrecision.CITY, {}, None),
+])
+def test_geo_topic_without_mappings(precision, fields, expected):
+  assert TopicRouter(precision=precision).geo_topic(node(**fields)) == expected
+
+
+@pytest.mark.parametrize('replace_full, precision, expected', [
+  (False, NodePrecision.CITY, 'GB/Scot/edinburgh'),
+  (False, NodePrecision.STATE, 'GB/Scot'),
+  (True, NodePrecision.CITY, 'Scot'),
+  (True, NodePrecision.STATE, 'Scot'),
+  # a country-level topic has no state to map
+  (True, NodePrecision.COUNTRY, 'GB'),
+])
+def test_geo_topic_with_state_mapping(replace_full, precision, expected):
+  router = TopicRouter(mappings=[{'state': 'Scotland', 'value': 'Scot', 'replace_full': replace_full}], precision=precision)
+  assert router.geo_topic(node(country_iso2='GB', state='Scotland', city='Edinburgh')) == expected
+  # other states are left alone
+  assert router.geo_topic(node(country_iso2='GB', state='Wales', city='Cardiff')) == {NodePrecision.CITY: 'GB/Wales/cardiff', NodePrecision.STATE: 'GB/Wales', NodePrecision.COUNTRY: 'GB'}[precision]
+
+
+def test_geo_topic_of_a_replaced_router_is_not_reused():
+  entry = node(country_iso2='GB', state='Scotland', city='Edinburgh')
+  assert TopicRouter().geo_topic(entry) == 'GB/Scotland/edinburgh'
+  assert TopicRouter(mappings=[{'state': 'Scotland', 'value': 'Scot'}]).geo_topic(entry) == 'GB/Scot/edinburgh'
@@ -0,0 +1,132 @@
+import random
+
+import meshtastic
+import meshtastic.protobuf
+import pytest
+
+import meshmtx.wire
+from meshmtx.wire import scan_envelope, scan_envelope_native, scan_envelope_wire
+
+SCANNERS = [scan_envelope_wire, scan_envelope_native]
+FIELDS = ('channel_id', 'gateway_id', 'sender', 'to', 'id', 'channel', 'hop_limit', 'hop_start', 'want_ack', 'via_mqtt', 'rx_time', 'encrypted')
+
+
+def random_envelope(rng: random.Random) -> meshtastic.mqtt_pb2.ServiceEnvelope:
+  packet = meshtastic.mesh_pb2.MeshPacket()
+  setattr(packet, 'from', rng.getrandbits(32))
+  packet.to = rng.choice([0xffffffff, rng.getrandbits(32)])
+  packet.id = rng.getrandbits(32)
+  packet.channel = rng.getrandbits(8)
+  packet.hop_limit = rng.randrange(8)
+  packet.hop_start = rng.randrange(8)
+  packet.want_ack = rng.random() < 0.5
+  packet.via_mqtt = rng.random() < 0.5
+  packet.rx_time = rng.getrandbits(32)
+  # fields the scanner skips
+  packet.rx_snr = rng.uniform(-20, 10)
+  packet.rx_rssi = rng.randrange(-120, 0)
+  packet.priority = meshtastic.mesh_pb2.MeshPacket.Priority.RELIABLE
+  if rng.random() < 0.5:
+    packet.encrypted = rng.randbytes(rng.randrange(0, 200))
+  else:
+    packet.decoded.portnum = rng.choice([meshtastic.portnums_pb2.TEXT_MESSAGE_APP, meshtastic.portnums_pb2.POSITION_APP])
+    packet.decoded.payload = rng.randbytes(rng.randrange(0, 200))
+    packet.decoded.want_response = rng.random() < 0.5
+  return meshtastic.mqtt_pb2.ServiceEnvelope(packet=packet, channel_id=rng.choice(['LongFast', 'MediumFast', 'Telemetry', 'ünïcode']), gateway_id=f'!{rng.getrandbits(32):08x}')
+
+
+def assert_matches(header, payload: bytes):
+  expected = meshtastic.mqtt_pb2.ServiceEnvelope()
+  expected.ParseFromString(payload)
+  packet = expected.packet
+  values = {
+    'channel_id': expected.channel_id,
+    'gateway_id': expected.gateway_id,
+    'sender': getattr(packet, 'from'),
+    'to': packet.to,
+    'id': packet.id,
+    'channel': packet.channel,
+    'hop_limit': packet.hop_limit,
+    'hop_start': packet.hop_start,
+    'want_ack': packet.want_ack,
+    'via_mqtt': packet.via_mqtt,
+    'rx_time': packet.rx_time,
+    'encrypted': packet.encrypted if packet.WhichOneof('payload_variant') == 'encrypted' else None,
+  }
+  for field in FIELDS:
+    assert getattr(header, field) == values[field], field
+
+  if packet.WhichOneof('payload_variant') == 'decoded':
+    data = meshtastic.mesh_pb2.Data()
+    data.ParseFromString(header.decoded)
+    assert data == packet.decoded
+  else:
+    assert header.decoded is None
+
+
+@pytest.mark.parametrize('scan', SCANNERS)
+def test_matches_protobuf_decoder(scan):
+  rng = random.Random(1)
+  for _ in range(500):
+    payload = random_envelope(rng).SerializeToString()
+    assert_matches(scan(payload), payload)
+
+
+@pytest.mark.parametrize('scan', SCANNERS)
+def test_empty_envelope_has_defaults(scan):
+  header = scan(b'')
+  assert_matches(header, b'')
+  assert header.encrypted is None and header.decoded is None
+
+
+@pytest.mark.parametrize('scan', SCANNERS)
+def test_last_payload_variant_wins(scan):
+  # decoded and encrypted are a oneof, a later field on the wire replaces an earlier one
+  first = meshtastic.mesh_pb2.MeshPacket(encrypted=b'secret')
+  second = meshtastic.mesh_pb2.MeshPacket()
+  second.decoded.portnum = meshtastic.portnums_pb2.TEXT_MESSAGE_APP
+  payload = meshtastic.mqtt_pb2.ServiceEnvelope(packet=first).SerializeToString() + meshtastic.mqtt_pb2.ServiceEnvelope(packet=second).SerializeToString()
+  assert_matches(scan(payload), payload)
+
+
+@pytest.mark.parametrize('scan', SCANNERS)
+def test_unknown_fields_are_skipped(scan):
+  envelope = random_envelope(random.Random(2))
+  # field 15 varint, field 16 fixed64, field 17 length delimited, field 18 fixed32
+  extra = bytes([0x78, 0x96, 0x01]) + bytes([0x81, 0x01]) + bytes(8) + bytes([0x8a, 0x01, 0x03]) + b'abc' + bytes([0x95, 0x01]) + bytes(4)
+  payload = envelope.SerializeToString() + extra
+  assert_matches(scan(payload), payload)
+
+
+def test_malformed_payloads_are_rejected_like_the_decoder():
+  rng = random.Random(3)
+  for _ in range(2000):
+    payload = random_envelope(rng).SerializeToString()
+    # truncated anywhere, or with a corrupted byte
+    cut = rng.randrange(1, len(payload))
+    corrupted = bytearray(payload)
+    corrupted[rng.randrange(len(payload))] = rng.getrandbits(8)
+    for candidate in (payload[:cut], bytes(corrupted)):
+      expected = meshtastic.mqtt_pb2.ServiceEnvelope()
+      try:
+        expected.ParseFromString(candidate)
+      except Exception:
+        assert scan_envelope_native(candidate) is None
+        header = scan_envelope_wire(candidate)
+        if header is not None:
+          # the scanner leaves the Data message to whoever decodes it
+          assert header.decoded is not None
+          with pytest.raises(Exception):
+            meshtastic.mesh_pb2.Data().ParseFromString(header.decoded)
+        continue
+      # still a valid envelope, e.g. cut at a field boundary
+      header = scan_envelope_wire(candidate)
+      if header is not None:
+        assert_matches(header, candidate)
+
+
+@pytest.mark.parametrize('native', [True, False])
+def test_scan_envelope_uses_either_implementation(monkeypatch, native):
+  monkeypatch.setattr(meshmtx.wire, 'NATIVE_PROTOBUF', native)
+  payload = random_envelope(random.Random(4)).SerializeToString()
+  assert_matches(scan_envelope(payload), payload)